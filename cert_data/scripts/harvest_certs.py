@@ -19,10 +19,20 @@ What it does:
        cert_data/raw/<sha256>.pem
 5. Updates index.json so it can resume later.
 
+Downloads run concurrently behind an adaptive limiter and a per-host circuit
+breaker (see harvest_control.py), so the harvester runs as fast as crt.sh
+tolerates and backs off when it starts throttling. Set CRTSH_BASE_URL to point
+it at a stand-in server (standin_server.py) instead of the real crt.sh.
+
+With --pipeline, downloaded certs skip raw/ entirely: they are handed, already
+parsed, through a bounded queue to labeling workers (label_certs.py) and land
+directly in cert_data/labeled/<sha256>.json.
+
 Typical usage:
 --------------
 > conda activate cert-poc
 > python3 harvest_certs.py
+> python3 harvest_certs.py --pipeline --label-workers 4
 
 Author:
 -------
@@ -31,15 +41,22 @@ For AI Certificate Service POC (PKISecOPS project)
 ================================================================================
 """
 
+import argparse
 import requests
 import os
 import json
 import hashlib
+import threading
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 import time
 
+from harvest_control import AdaptiveFetcher, IdClaims, map_adaptive
+from harvest_session import HarvestSession
+from pipeline_metrics import PARSE_SECONDS, add_metrics_args, export_metrics, record_write, start_metrics
+from label_certs import LabelingPipeline
+
 # Expanded domain list to collect 10k-15k certificates
 DOMAINS = [
     # Major tech companies
@@ -145,6 +162,7 @@ DOMAINS = [
 
 OUTPUT_DIR = "../raw"
 INDEX_FILE = "../raw/index.json"
+CRTSH_BASE_URL = os.environ.get("CRTSH_BASE_URL", "https://crt.sh").rstrip("/")
 
 # ensure output dir exists
 os.makedirs(OUTPUT_DIR, exist_ok=True)
@@ -156,82 +174,156 @@ if os.path.exists(INDEX_FILE):
 else:
     cert_index = {}
 
+# Downloads run on several threads; guards cert_index and known_hashes
+index_lock = threading.Lock()
+# Some index files carry {"hash": ...} records rather than bare hashes
+known_hashes = {
+    info.get("hash") if isinstance(info, dict) else info
+    for info in cert_index.values()
+}
+# Cert IDs being downloaded right now
+claims = IdClaims(index_lock, cert_index)
+
+fetcher = AdaptiveFetcher()
+
+# Live counters; every hash in the index is a stored cert, so no directory scan
+session = HarvestSession("harvest_certs", initial_stored=len(known_hashes), status=fetcher.status_line)
+
+# Set by main() in --pipeline mode
+pipeline = None
+
 def get_cert_hash(cert):
     der_bytes = cert.public_bytes(encoding=serialization.Encoding.DER)
     return hashlib.sha256(der_bytes).hexdigest()
 
 def fetch_crtsh_certs(domain_pattern):
-    base_url = f"https://crt.sh/?q={domain_pattern}&output=json"
+    base_url = f"{CRTSH_BASE_URL}/?q={domain_pattern}&output=json"
     print(f"\nFetching list from crt.sh for domain pattern: {domain_pattern}")
     
-    # Just try once with a reasonable timeout
     try:
-        response = requests.get(base_url, timeout=30)
+        response = fetcher.get(base_url, timeout=30)
         response.raise_for_status()
-        return response.json()
+        certs = response.json()
+        session.incr("found", len(certs))
+        return certs
     except requests.exceptions.RequestException as e:
         print(f"Request failed for {domain_pattern}: {e}")
         return None  # Return None instead of raising an exception
 
+def store_cert(index_key, pem_data, cert, on_labeled=None):
+    """
+    Dedup a parsed certificate by the SHA256 of its DER bytes and store it,
+    recording index_key -> sha256 in the index. Returns the hash, or None if
+    the certificate was a duplicate.
+
+    In --pipeline mode the index entry is only recorded once the cert has
+    been labeled, so one that fails labeling, or is still queued when the
+    harvest stops, is fetched again by the next run. on_labeled(ok) is then
+    passed on to LabelingPipeline.submit.
+    """
+    sha256 = get_cert_hash(cert)
+
+    # Skip if we already have this cert under a different ID
+    with index_lock:
+        if sha256 in known_hashes:
+            print(f"Skipping cert ID {index_key} (duplicate)")
+            session.incr("duplicate")
+            return None
+        known_hashes.add(sha256)
+
+    # Hand straight to the labelers, or save to raw/ for label_certs.py
+    if pipeline:
+        def labeled(ok):
+            if ok:
+                with index_lock:
+                    cert_index[index_key] = sha256
+            if on_labeled:
+                on_labeled(ok)
+
+        pipeline.submit(sha256, pem_data, cert, labeled)
+    else:
+        output_path = os.path.join(OUTPUT_DIR, f"{sha256}.pem")
+        with open(output_path, "w") as f:
+            f.write(pem_data)
+        record_write("raw", output_path)
+
+        # Update index
+        with index_lock:
+            cert_index[index_key] = sha256
+    session.incr("downloaded")
+    print(f"Saved cert {sha256}")
+
+    return sha256
+
 def download_and_save(cert_id):
-    # Skip if already downloaded
-    if str(cert_id) in cert_index:
+    # Skip if already downloaded, or being downloaded by another worker
+    if not claims.claim(str(cert_id)):
         print(f"Skipping cert ID {cert_id} (already downloaded)")
+        session.incr("duplicate")
         return
 
-    # Download PEM - just try once
+    # Download PEM (retried by the fetcher if crt.sh throttles us)
     try:
         print(f"Downloading cert ID {cert_id}...")
-        response = requests.get(f"https://crt.sh/?d={cert_id}", timeout=15)
+        response = fetcher.get(f"{CRTSH_BASE_URL}/?d={cert_id}", timeout=15)
         response.raise_for_status()
         pem_data = response.text
+        session.incr("bytes", len(response.content))
         
         # Verify it's actually a certificate
         if "-----BEGIN CERTIFICATE-----" not in pem_data:
             print(f"Warning: Downloaded content for {cert_id} doesn't appear to be a certificate")
+            session.incr("failed")
             return
             
-        # Parse and hash
+        # Parse
         try:
-            cert = x509.load_pem_x509_certificate(pem_data.encode(), default_backend())
-            sha256 = get_cert_hash(cert)
+            with PARSE_SECONDS.time():
+                cert = x509.load_pem_x509_certificate(pem_data.encode(), default_backend())
         except Exception as e:
             print(f"Error parsing certificate {cert_id}: {e}")
+            session.incr("failed")
             return
 
-        # Skip if we already have this cert under a different ID
-        for existing_id, existing_hash in cert_index.items():
-            if existing_hash == sha256:
-                print(f"Skipping cert ID {cert_id} (duplicate of {existing_id})")
-                return
-
-        # Save to file
-        output_path = os.path.join(OUTPUT_DIR, f"{sha256}.pem")
-        with open(output_path, "w") as f:
-            f.write(pem_data)
-
-        # Update index
-        cert_index[str(cert_id)] = sha256
-        print(f"Saved cert {sha256}")
-        
-        # Count files periodically
-        if len(cert_index) % 100 == 0:
-            file_count = len([f for f in os.listdir(OUTPUT_DIR) if f.endswith(".pem")])
-            print(f"\n>>> Current certificate count: {file_count} <<<\n")
-            
-        # Polite delay to avoid rate limiting
-        time.sleep(1.0)  # reduced delay
+        store_cert(str(cert_id), pem_data, cert)
         
     except requests.exceptions.RequestException as e:
         print(f"Download failed for cert ID {cert_id}: {e}")
+        session.incr("failed")
         return
     except Exception as e:
         print(f"Unexpected error for cert ID {cert_id}: {e}")
+        session.incr("failed")
         return
+    finally:
+        # Stored certs are in the index by now; failed ones may be retried
+        claims.release(str(cert_id))
+
+def save_index():
+    with index_lock:
+        snapshot = dict(cert_index)
+    with open(INDEX_FILE, "w") as f:
+        json.dump(snapshot, f)
 
 def main():
-    start_time = time.time()
-    total_certs_found = 0
+    global pipeline
+
+    parser = argparse.ArgumentParser(description='Harvest real-world certificates from crt.sh')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Label certificates as they are downloaded instead of saving them to raw/')
+    parser.add_argument('--label-workers', type=int, default=4, help='Labeling threads in --pipeline mode')
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='Certificates buffered between downloaders and labelers in --pipeline mode')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between progress lines')
+    parser.add_argument('--summary-file', default=None, help='Also write the final JSON summary to this file')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+
+    session.progress_interval = args.progress_interval
+    if args.pipeline:
+        pipeline = LabelingPipeline(workers=args.label_workers, queue_size=args.queue_size, session=session)
+
     domains_processed = 0
     domains_skipped = 0
     
@@ -241,7 +333,7 @@ def main():
     try:
         for domain in DOMAINS:
             # Check if we've reached our target
-            current_count = len([f for f in os.listdir(OUTPUT_DIR) if f.endswith(".pem")])
+            current_count = session.stored
             if current_count >= 15000:
                 print(f"\n>>> Target reached: {current_count} certificates collected <<<")
                 break
@@ -256,7 +348,6 @@ def main():
                 continue
                 
             print(f"Found {len(certs)} cert records for {domain}.")
-            total_certs_found += len(certs)
             
             # Process a subset of certificates if there are too many
             # This helps ensure we get a diverse set across domains
@@ -265,45 +356,44 @@ def main():
                 print(f"Limiting to {max_certs_per_domain} certificates for {domain}")
                 certs = certs[:max_certs_per_domain]
 
-            # Process each certificate
+            # Process each certificate, as many at once as crt.sh tolerates
+            cert_ids = [entry.get("id") for entry in certs if entry.get("id")]
             certs_processed = 0
-            for entry in certs:
-                cert_id = entry.get("id")
-                if not cert_id:
-                    continue
-                    
-                download_and_save(cert_id)
+            for _ in map_adaptive(download_and_save, cert_ids, fetcher):
                 certs_processed += 1
+                session.maybe_progress()
                 
                 # Save index more frequently for large domains
                 if certs_processed % 100 == 0:
-                    with open(INDEX_FILE, "w") as f:
-                        json.dump(cert_index, f)
+                    save_index()
                     
             domains_processed += 1
-            print(f"Completed domain {domains_processed}/{len(DOMAINS)}: {domain} - Processed {certs_processed} certs")
+            print(f"Completed domain {domains_processed}/{len(DOMAINS)}: {domain} - Processed {certs_processed} certs ({fetcher.status_line()})")
             
             # Save index after each domain
-            with open(INDEX_FILE, "w") as f:
-                json.dump(cert_index, f)
+            save_index()
             print("Saved index file checkpoint")
                 
             # Add a delay between domains to be polite
             time.sleep(2)
     finally:
+        # Drain whatever the labelers still have queued; their certs only
+        # enter the index once labeled
+        if pipeline:
+            pipeline.close()
+
         # Always save the index when done or interrupted
-        with open(INDEX_FILE, "w") as f:
-            json.dump(cert_index, f)
+        save_index()
         
         # Print summary
-        elapsed_time = time.time() - start_time
-        final_count = len([f for f in os.listdir(OUTPUT_DIR) if f.endswith(".pem")])
+        final_count = session.stored
         print(f"\n=== Harvest Summary ===")
         print(f"Domains processed successfully: {domains_processed}/{len(DOMAINS)}")
         print(f"Domains skipped due to errors: {domains_skipped}")
-        print(f"Total certificates found in CT logs: {total_certs_found}")
-        print(f"Unique certificates downloaded: {final_count}")
-        print(f"Time elapsed: {elapsed_time:.1f} seconds ({elapsed_time/60:.1f} minutes)")
+        if pipeline:
+            print(f"Labeled this run: {pipeline.labeled} (failed: {pipeline.failed})")
+        session.write_summary(args.summary_file)
+        export_metrics(args)
         
         if final_count >= 10000:
             print("\n✅ SUCCESS: Target of 10,000+ certificates reached!")
@@ -8,24 +8,34 @@ This script:
 2. Evaluates each certificate against flaw criteria
 3. Only saves certificates that have no flaws
 4. Continues until reaching the target number of clean certificates
+
+Downloads run concurrently under the adaptive limiter and circuit breaker in
+harvest_control.py. Set CRTSH_BASE_URL to harvest from a stand-in server.
 """
 
+import argparse
 import requests
 import os
 import json
 import hashlib
 import time
 import datetime
+import threading
 from cryptography import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.x509.oid import NameOID, ExtensionOID
 
+from harvest_control import AdaptiveFetcher, IdClaims, map_adaptive
+from harvest_session import HarvestSession
+from pipeline_metrics import PARSE_SECONDS, add_metrics_args, export_metrics, record_write, start_metrics
+
 # Configuration
 OUTPUT_DIR = "../clean"
 INDEX_FILE = "../clean/index.json"
 TARGET_CLEAN_CERTS = 1800
+CRTSH_BASE_URL = os.environ.get("CRTSH_BASE_URL", "https://crt.sh").rstrip("/")
 
 # Expanded domain list with domains more likely to have clean certificates
 # Including financial, government, and major tech companies known for good security practices
@@ -118,6 +128,27 @@ if os.path.exists(INDEX_FILE):
 else:
     cert_index = {}
 
+# Downloads run on several threads; guards cert_index and known_hashes
+index_lock = threading.Lock()
+known_hashes = {
+    info.get("hash") if isinstance(info, dict) else info
+    for info in cert_index.values()
+}
+# Cert IDs being downloaded right now
+claims = IdClaims(index_lock, cert_index)
+
+fetcher = AdaptiveFetcher()
+
+# Live counters; clean certs already stored are counted from the index, not the directory
+session = HarvestSession(
+    "harvest_clean_certs",
+    initial_stored=sum(
+        1 for info in cert_index.values()
+        if not (isinstance(info, dict) and info.get("skipped"))
+    ),
+    status=fetcher.status_line
+)
+
 def get_cert_hash(cert):
     """Generate SHA256 hash of certificate DER bytes"""
     der_bytes = cert.public_bytes(encoding=serialization.Encoding.DER)
@@ -164,13 +195,15 @@ def has_flaws(cert):
 
 def fetch_crtsh_certs(domain_pattern):
     """Fetch certificate metadata from crt.sh for a domain pattern"""
-    base_url = f"https://crt.sh/?q={domain_pattern}&output=json"
+    base_url = f"{CRTSH_BASE_URL}/?q={domain_pattern}&output=json"
     print(f"\nFetching list from crt.sh for domain pattern: {domain_pattern}")
     
     try:
-        response = requests.get(base_url, timeout=30)
+        response = fetcher.get(base_url, timeout=30)
         response.raise_for_status()
-        return response.json()
+        certs = response.json()
+        session.incr("found", len(certs))
+        return certs
     except requests.exceptions.RequestException as e:
         print(f"Request failed for {domain_pattern}: {e}")
         return None
@@ -180,39 +213,43 @@ def download_and_check_cert(cert_id):
     Download certificate by ID from crt.sh and check if it's clean
     Returns: (bool is_clean, str sha256) or (False, None) if error
     """
-    # Skip if already downloaded
-    if str(cert_id) in cert_index:
+    # Skip if already processed, or being downloaded by another worker
+    if not claims.claim(str(cert_id)):
         print(f"Skipping cert ID {cert_id} (already processed)")
+        session.incr("duplicate")
         return (False, None)
 
     # Download PEM
     try:
         print(f"Downloading cert ID {cert_id}...")
-        response = requests.get(f"https://crt.sh/?d={cert_id}", timeout=15)
+        response = fetcher.get(f"{CRTSH_BASE_URL}/?d={cert_id}", timeout=15)
         response.raise_for_status()
         pem_data = response.text
+        session.incr("bytes", len(response.content))
         
         # Verify it's actually a certificate
         if "-----BEGIN CERTIFICATE-----" not in pem_data:
             print(f"Warning: Downloaded content for {cert_id} doesn't appear to be a certificate")
+            session.incr("failed")
             return (False, None)
             
         # Parse and hash
         try:
-            cert = x509.load_pem_x509_certificate(pem_data.encode(), default_backend())
+            with PARSE_SECONDS.time():
+                cert = x509.load_pem_x509_certificate(pem_data.encode(), default_backend())
             sha256 = get_cert_hash(cert)
         except Exception as e:
             print(f"Error parsing certificate {cert_id}: {e}")
+            session.incr("failed")
             return (False, None)
 
         # Check if we already have this cert under a different ID
-        for existing_id, existing_info in cert_index.items():
-            if isinstance(existing_info, dict) and existing_info.get("hash") == sha256:
-                print(f"Skipping cert ID {cert_id} (duplicate of {existing_id})")
-                return (False, None)
-            elif isinstance(existing_info, str) and existing_info == sha256:
-                print(f"Skipping cert ID {cert_id} (duplicate of {existing_id})")
+        with index_lock:
+            if sha256 in known_hashes:
+                print(f"Skipping cert ID {cert_id} (duplicate)")
+                session.incr("duplicate")
                 return (False, None)
+            known_hashes.add(sha256)
 
         # Check for flaws
         has_any_flaws, flaws = has_flaws(cert)
@@ -222,53 +259,70 @@ def download_and_check_cert(cert_id):
             output_path = os.path.join(OUTPUT_DIR, f"{sha256}.pem")
             with open(output_path, "w") as f:
                 f.write(pem_data)
+            record_write("clean", output_path)
             
             # Update index with more info
-            cert_index[str(cert_id)] = {
-                "hash": sha256,
-                "subject": cert.subject.rfc4514_string(),
-                "issuer": cert.issuer.rfc4514_string(),
-                "not_before": cert.not_valid_before.isoformat(),
-                "not_after": cert.not_valid_after.isoformat()
-            }
+            with index_lock:
+                cert_index[str(cert_id)] = {
+                    "hash": sha256,
+                    "subject": cert.subject.rfc4514_string(),
+                    "issuer": cert.issuer.rfc4514_string(),
+                    "not_before": cert.not_valid_before.isoformat(),
+                    "not_after": cert.not_valid_after.isoformat()
+                }
             
+            session.incr("downloaded")
             print(f"✅ Saved CLEAN cert {sha256}")
             return (True, sha256)
         else:
             # Still record in index that we've seen this cert, but mark as having flaws
-            cert_index[str(cert_id)] = {
-                "hash": sha256,
-                "flaws": flaws,
-                "skipped": True
-            }
+            with index_lock:
+                cert_index[str(cert_id)] = {
+                    "hash": sha256,
+                    "flaws": flaws,
+                    "skipped": True
+                }
+            session.incr("flawed")
             print(f"❌ Skipping cert with flaws: {flaws}")
             return (False, sha256)
             
     except requests.exceptions.RequestException as e:
         print(f"Download failed for cert ID {cert_id}: {e}")
+        session.incr("failed")
         return (False, None)
     except Exception as e:
         print(f"Unexpected error for cert ID {cert_id}: {e}")
+        session.incr("failed")
         return (False, None)
+    finally:
+        # Processed certs are in the index by now; failed ones may be retried
+        claims.release(str(cert_id))
+
+def save_index():
+    with index_lock:
+        snapshot = dict(cert_index)
+    with open(INDEX_FILE, "w") as f:
+        json.dump(snapshot, f, indent=2)
 
 def main():
-    start_time = time.time()
-    total_certs_found = 0
+    parser = argparse.ArgumentParser(description='Harvest flaw-free certificates from crt.sh')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between progress lines')
+    parser.add_argument('--summary-file', default=None, help='Also write the final JSON summary to this file')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+
+    session.progress_interval = args.progress_interval
     domains_processed = 0
-    clean_certs_count = 0
-    
-    # Count existing clean certs
-    existing_clean_certs = len([f for f in os.listdir(OUTPUT_DIR) if f.endswith(".pem")])
-    clean_certs_count = existing_clean_certs
     
-    print(f"Starting with {existing_clean_certs} existing clean certificates")
+    print(f"Starting with {session.initial_stored} existing clean certificates")
     print(f"Target: {TARGET_CLEAN_CERTS} clean certificates")
     
     try:
         for domain in DOMAINS:
             # Check if we've reached our target
-            if clean_certs_count >= TARGET_CLEAN_CERTS:
-                print(f"\n>>> Target reached: {clean_certs_count} clean certificates collected <<<")
+            if session.stored >= TARGET_CLEAN_CERTS:
+                print(f"\n>>> Target reached: {session.stored} clean certificates collected <<<")
                 break
                 
             # Fetch certificates for this domain
@@ -280,71 +334,57 @@ def main():
                 continue
                 
             print(f"Found {len(certs)} cert records for {domain}.")
-            total_certs_found += len(certs)
             
             # Process certificates
             certs_processed = 0
             clean_certs_this_domain = 0
             
-            for entry in certs:
-                # Check if we've reached our target
-                if clean_certs_count >= TARGET_CLEAN_CERTS:
-                    print(f"\n>>> Target reached: {clean_certs_count} clean certificates collected <<<")
-                    break
-                    
-                cert_id = entry.get("id")
-                if not cert_id:
-                    continue
-                    
-                is_clean, _ = download_and_check_cert(cert_id)
+            def enough_from_domain():
+                # Stop at the target, or once we've processed enough certs from
+                # this domain; this ensures we get diversity across domains
+                return (session.stored >= TARGET_CLEAN_CERTS
+                        or certs_processed >= 100 or clean_certs_this_domain >= 20)
+            
+            cert_ids = [entry.get("id") for entry in certs if entry.get("id")]
+            for _, (is_clean, _) in map_adaptive(download_and_check_cert, cert_ids, fetcher,
+                                                 should_stop=enough_from_domain):
                 certs_processed += 1
                 
                 if is_clean:
-                    clean_certs_count += 1
                     clean_certs_this_domain += 1
-                    
-                    # Show progress
-                    remaining = TARGET_CLEAN_CERTS - clean_certs_count
-                    print(f"Progress: {clean_certs_count}/{TARGET_CLEAN_CERTS} clean certs ({remaining} remaining)")
+                
+                # Show progress
+                session.maybe_progress()
                 
                 # Save index periodically
                 if certs_processed % 20 == 0:
-                    with open(INDEX_FILE, "w") as f:
-                        json.dump(cert_index, f, indent=2)
-                
-                # Polite delay to avoid rate limiting
-                time.sleep(0.5)
-                
-                # If we've processed enough certs from this domain, move on
-                # This ensures we get diversity across domains
-                if certs_processed >= 100 or clean_certs_this_domain >= 20:
-                    print(f"Processed enough from {domain}, moving to next domain")
-                    break
+                    save_index()
+            
+            if session.stored >= TARGET_CLEAN_CERTS:
+                print(f"\n>>> Target reached: {session.stored} clean certificates collected <<<")
+            elif enough_from_domain():
+                print(f"Processed enough from {domain}, moving to next domain")
             
             domains_processed += 1
             print(f"Completed domain {domains_processed}/{len(DOMAINS)}: {domain} - Found {clean_certs_this_domain} clean certs")
             
             # Save index after each domain
-            with open(INDEX_FILE, "w") as f:
-                json.dump(cert_index, f, indent=2)
+            save_index()
                 
             # Add a delay between domains to be polite
             time.sleep(2)
             
     finally:
         # Always save the index when done or interrupted
-        with open(INDEX_FILE, "w") as f:
-            json.dump(cert_index, f, indent=2)
+        save_index()
         
         # Print summary
-        elapsed_time = time.time() - start_time
-        final_count = len([f for f in os.listdir(OUTPUT_DIR) if f.endswith(".pem")])
+        final_count = session.stored
         
         print(f"\n=== Clean Certificate Harvest Summary ===")
         print(f"Domains processed: {domains_processed}/{len(DOMAINS)}")
-        print(f"Total certificates found in CT logs: {total_certs_found}")
-        print(f"Clean certificates collected: {final_count}")
-        print(f"Time elapsed: {elapsed_time:.1f} seconds ({elapsed_time/60:.1f} minutes)")
+        session.write_summary(args.summary_file)
+        export_metrics(args)
         
         if final_count >= TARGET_CLEAN_CERTS:
             print(f"\n✅ SUCCESS: Target of {TARGET_CLEAN_CERTS} clean certificates reached!")
@@ -0,0 +1,325 @@
+#!/usr/bin/env python3
+
+"""
+harvest_control.py - Adaptive concurrency and circuit breaking for the harvesters
+
+The harvesters talk to a single upstream (crt.sh or a CT log) that throttles
+aggressively. Instead of a fixed sleep between requests, every request goes
+through an AdaptiveFetcher which:
+
+1. Gates in-flight requests with an AIMD limiter: the limit grows by one for
+   every window of healthy responses and is halved on 429/5xx or timeouts.
+2. Keeps a circuit breaker per host: after repeated consecutive failures the
+   breaker opens and requests wait out an exponential backoff before a single
+   probe is let through again.
+3. Retries throttled requests a few times before giving up, honouring
+   Retry-After when the upstream sends one.
+
+map_adaptive runs the harvesters' fetches on a thread pool sized by the
+limiter, and IdClaims keeps two of those threads from fetching the same ID.
+
+The base URL of the upstream is configurable in each harvester, so the control
+loop can be exercised against standin_server.py on localhost.
+"""
+
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from urllib.parse import urlsplit
+
+import requests
+
+from pipeline_metrics import CONCURRENCY_LIMIT, DOWNLOAD_SECONDS, ERROR_RATE
+
+# Status codes that mean "slow down" rather than "this request is wrong"
+THROTTLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+class AIMDLimiter:
+    """Additive-increase / multiplicative-decrease concurrency limit"""
+
+    def __init__(self, initial=4, minimum=1, maximum=32, window=100):
+        self.limit = initial
+        self.minimum = minimum
+        self.maximum = maximum
+        self.in_flight = 0
+        self._successes = 0
+        self._last_decrease = 0.0
+        self._outcomes = deque(maxlen=window)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        """Wait for a free slot; returns the start time to report back with"""
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+            return time.monotonic()
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify_all()
+
+    def on_success(self):
+        with self._cond:
+            self._outcomes.append(True)
+            self._successes += 1
+            # One full window of healthy responses at the current limit
+            # buys one more slot
+            if self._successes >= self.limit and self.limit < self.maximum:
+                self.limit += 1
+                self._successes = 0
+                self._cond.notify_all()
+
+    def on_throttle(self, started):
+        with self._cond:
+            self._outcomes.append(False)
+            self._successes = 0
+            # Requests that were already in flight when the limit was last
+            # halved fail together; only react to ones sent after it
+            if started >= self._last_decrease:
+                self.limit = max(self.minimum, self.limit // 2)
+                self._last_decrease = time.monotonic()
+
+    @property
+    def error_rate(self):
+        with self._cond:
+            if not self._outcomes:
+                return 0.0
+            return self._outcomes.count(False) / len(self._outcomes)
+
+
+class CircuitBreaker:
+    """Consecutive-failure circuit breaker with exponential backoff"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, failure_threshold=10, base_backoff=5.0, max_backoff=300.0):
+        self.failure_threshold = failure_threshold
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        self.state = self.CLOSED
+        self._failures = 0
+        self._trips = 0
+        self._open_until = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def wait_time(self):
+        """
+        Return 0 if a request may go ahead now, otherwise how many seconds to
+        wait before asking again
+        """
+        with self._lock:
+            if self.state == self.CLOSED:
+                return 0.0
+            now = time.monotonic()
+            if self.state == self.OPEN:
+                if now < self._open_until:
+                    return self._open_until - now
+                self.state = self.HALF_OPEN
+            # Half-open: exactly one probe request at a time
+            if self._probe_in_flight:
+                return min(1.0, self.base_backoff)
+            self._probe_in_flight = True
+            return 0.0
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self._failures = 0
+            self._trips = 0
+            self._probe_in_flight = False
+
+    def record_failure(self, retry_after=None):
+        with self._lock:
+            if self.state == self.OPEN:
+                # A request that was already in flight when the breaker
+                # opened; that trip is counted, so only honour Retry-After
+                if retry_after:
+                    self._open_until = max(self._open_until, time.monotonic() + retry_after)
+                return
+            self._failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                backoff = min(self.max_backoff, self.base_backoff * (2 ** self._trips))
+                if retry_after:
+                    backoff = max(backoff, retry_after)
+                self._trips += 1
+                self._open_until = time.monotonic() + backoff
+                self.state = self.OPEN
+
+
+def parse_retry_after(response):
+    """Retry-After in seconds, or None if absent/unparseable"""
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        return None
+
+
+class AdaptiveFetcher:
+    """requests.get replacement that adapts to upstream throttling"""
+
+    def __init__(self, limiter=None, max_retries=3, breaker_kwargs=None):
+        self.limiter = limiter or AIMDLimiter()
+        self.max_retries = max_retries
+        self.breaker_kwargs = breaker_kwargs or {}
+        self.session = requests.Session()
+        # One pooled connection per possible in-flight request
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.limiter.maximum)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._breakers = {}
+        self._breakers_lock = threading.Lock()
+
+    def breaker_for(self, url):
+        host = urlsplit(url).netloc
+        with self._breakers_lock:
+            if host not in self._breakers:
+                self._breakers[host] = CircuitBreaker(**self.breaker_kwargs)
+            return self._breakers[host]
+
+    def get(self, url, timeout=15):
+        """
+        GET url under the limiter and the host's circuit breaker.
+        Returns the response for anything that isn't throttling; raises a
+        requests exception once retries are exhausted.
+        """
+        breaker = self.breaker_for(url)
+        attempt = 0
+        while True:
+            delay = breaker.wait_time()
+            while delay > 0:
+                time.sleep(delay)
+                delay = breaker.wait_time()
+
+            started = self.limiter.acquire()
+            try:
+                response = self.session.get(url, timeout=timeout)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                DOWNLOAD_SECONDS.labels(outcome="error").observe(time.monotonic() - started)
+                self.limiter.on_throttle(started)
+                self._export_state()
+                breaker.record_failure()
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                response = None
+            finally:
+                self.limiter.release()
+
+            if response is None:
+                # Back off with the slot released, so retries against a stalled host don't starve the rest
+                self._backoff(attempt)
+                continue
+
+            elapsed = time.monotonic() - started
+            if response.status_code in THROTTLE_STATUSES:
+                DOWNLOAD_SECONDS.labels(outcome="throttled").observe(elapsed)
+                retry_after = parse_retry_after(response)
+                self.limiter.on_throttle(started)
+                self._export_state()
+                breaker.record_failure(retry_after)
+                attempt += 1
+                if attempt > self.max_retries:
+                    response.raise_for_status()
+                self._backoff(attempt, retry_after)
+                continue
+
+            DOWNLOAD_SECONDS.labels(outcome="ok").observe(elapsed)
+            self.limiter.on_success()
+            breaker.record_success()
+            self._export_state()
+            return response
+
+    def _export_state(self):
+        CONCURRENCY_LIMIT.set(self.limiter.limit)
+        ERROR_RATE.set(self.limiter.error_rate)
+
+    def _backoff(self, attempt, retry_after=None):
+        # Jittered exponential backoff so retries don't arrive in lockstep
+        delay = 0.5 * (2 ** (attempt - 1)) * random.uniform(0.5, 1.5)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        time.sleep(delay)
+
+    def status_line(self):
+        """Short description of the control loop state for progress output"""
+        with self._breakers_lock:
+            states = {b.state for b in self._breakers.values()}
+        if CircuitBreaker.OPEN in states:
+            breaker = CircuitBreaker.OPEN
+        elif CircuitBreaker.HALF_OPEN in states:
+            breaker = CircuitBreaker.HALF_OPEN
+        else:
+            breaker = CircuitBreaker.CLOSED
+        return (f"limit={self.limiter.limit} in_flight={self.limiter.in_flight} "
+                f"error_rate={self.limiter.error_rate:.1%} breaker={breaker}")
+
+
+class IdClaims:
+    """
+    IDs some worker thread is fetching right now. map_adaptive runs fetches
+    concurrently, so "is it already in the index?" and "then I'll take it"
+    must happen under one lock, or two workers can both fetch the same ID.
+    """
+
+    def __init__(self, lock, index):
+        # The harvester's index lock and the index (anything supporting `in`) it guards
+        self._lock = lock
+        self._index = index
+        self._claimed = set()
+
+    def claim(self, key):
+        """Reserve key for the caller; False if it is already indexed or claimed"""
+        with self._lock:
+            if key in self._index or key in self._claimed:
+                return False
+            self._claimed.add(key)
+            return True
+
+    def release(self, key):
+        """Drop the reservation once the fetch is over, whether or not it stored anything"""
+        with self._lock:
+            self._claimed.discard(key)
+
+
+def map_adaptive(fn, items, fetcher, should_stop=None):
+    """
+    Call fn(item) for every item on a thread pool, never queueing more work
+    than the fetcher's current concurrency limit. Yields (item, result) as
+    calls complete; stops submitting new items once should_stop() is true.
+    """
+    items = iter(items)
+    pending = {}
+    exhausted = False
+    with ThreadPoolExecutor(max_workers=fetcher.limiter.maximum) as executor:
+        while True:
+            while (not exhausted and len(pending) < fetcher.limiter.limit
+                   and not (should_stop and should_stop())):
+                try:
+                    item = next(items)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[executor.submit(fn, item)] = item
+
+            if not pending:
+                break
+
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = pending.pop(future)
+                yield item, future.result()
+
+            if should_stop and should_stop():
+                exhausted = True
@@ -0,0 +1,266 @@
+#!/usr/bin/env python3
+
+"""
+================================================================================
+harvest_ct_log.py
+
+Purpose:
+--------
+Bulk-ingests certificates straight from an RFC 6962 Certificate Transparency
+log. Where harvest_certs.py downloads one certificate per crt.sh request, this
+reads whole get-entries ranges, so a single request yields hundreds of certs.
+
+What it does:
+-------------
+1. Reads the log's tree size from get-sth.
+2. Splits [start, end] into fixed-size chunks and fetches them in parallel
+   through the adaptive limiter / circuit breaker (harvest_control.py). Logs
+   may return fewer entries than asked for; the rest of a chunk is re-requested
+   until it is complete.
+3. Decodes each MerkleTreeLeaf in the batch: x509_entry leaves carry the
+   certificate itself, precert_entry leaves take the precertificate from
+   extra_data.
+4. Feeds every certificate through harvest_certs.store_cert, i.e. the same
+   SHA256 dedup, raw/ output and index.json as the crt.sh harvester, or with
+   --pipeline straight into the labeled store. index.json keys are
+   ct:<log id>:<leaf index>, the log id being a short hash of the log URL,
+   since leaf indexes are only unique within one log.
+5. Records finished chunks in a state file so an interrupted run resumes
+   where it stopped. In --pipeline mode a chunk only counts as finished once
+   all of its new certs are labeled.
+
+Typical usage:
+--------------
+> python3 harvest_ct_log.py --log-url https://ct.googleapis.com/logs/us1/argon2025h2 --count 100000
+> python3 standin_server.py --pem-dir ../raw --port 8080
+> python3 harvest_ct_log.py --log-url http://127.0.0.1:8080 --pipeline
+================================================================================
+"""
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import struct
+import threading
+
+import requests
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+import harvest_certs
+from harvest_control import map_adaptive
+from label_certs import LabelingPipeline, PendingLabels
+from pipeline_metrics import PARSE_SECONDS, add_metrics_args, export_metrics, start_metrics
+
+X509_ENTRY = 0
+PRECERT_ENTRY = 1
+
+
+def read_length_prefixed(data, offset, length_bytes):
+    """Read a TLS opaque<..> vector; returns (value, new_offset)"""
+    length = int.from_bytes(data[offset:offset + length_bytes], "big")
+    start = offset + length_bytes
+    end = start + length
+    if end > len(data):
+        raise ValueError("truncated TLS vector")
+    return data[start:end], end
+
+
+def decode_entry(entry):
+    """
+    Decode one get-entries item into (entry_type, certificate DER).
+    For precerts this is the precertificate (with its poison extension) from
+    the PrecertChainEntry in extra_data, which unlike the TBSCertificate in the
+    leaf is a complete, parseable certificate.
+    """
+    leaf = base64.b64decode(entry["leaf_input"])
+    version, leaf_type, _timestamp, entry_type = struct.unpack(">BBQH", leaf[:12])
+    if version != 0 or leaf_type != 0:
+        raise ValueError(f"unsupported MerkleTreeLeaf version={version} type={leaf_type}")
+
+    if entry_type == X509_ENTRY:
+        der, _ = read_length_prefixed(leaf, 12, 3)
+    elif entry_type == PRECERT_ENTRY:
+        extra = base64.b64decode(entry["extra_data"])
+        der, _ = read_length_prefixed(extra, 0, 3)
+    else:
+        raise ValueError(f"unknown LogEntryType {entry_type}")
+    return entry_type, der
+
+
+def decode_entries(entries):
+    """Decode a whole get-entries batch; returns a list of (entry_type, cert) or exceptions"""
+    decoded = []
+    for entry in entries:
+        try:
+            entry_type, der = decode_entry(entry)
+            with PARSE_SECONDS.time():
+                cert = x509.load_der_x509_certificate(der, default_backend())
+            decoded.append((entry_type, cert))
+        except Exception as e:
+            decoded.append(e)
+    return decoded
+
+
+def log_id(log_url):
+    """Short stable id for a log, used in index.json keys and the state file name"""
+    return hashlib.sha256(log_url.encode()).hexdigest()[:16]
+
+
+class RangeState:
+    """Resumable record of which chunks of the log have been ingested"""
+
+    def __init__(self, path, log_url, chunk_size):
+        self.path = path
+        self.done = set()
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                saved = json.load(f)
+            if saved.get("log_url") == log_url and saved.get("chunk_size") == chunk_size:
+                self.done = set(saved.get("done", []))
+            else:
+                print(f"Ignoring state file {path}: it was written for a different log or chunk size")
+        self.log_url = log_url
+        self.chunk_size = chunk_size
+
+    def mark_done(self, chunk_start):
+        with self._lock:
+            self.done.add(chunk_start)
+            snapshot = {
+                "log_url": self.log_url,
+                "chunk_size": self.chunk_size,
+                "done": sorted(self.done)
+            }
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_path, self.path)
+
+
+def get_tree_size(log_url):
+    response = harvest_certs.fetcher.get(f"{log_url}/ct/v1/get-sth", timeout=30)
+    response.raise_for_status()
+    return response.json()["tree_size"]
+
+
+def ingest_chunk(log_url, chunk_start, chunk_end):
+    """Fetch and store entries [chunk_start, chunk_end]; returns (stored, duplicates, errors)"""
+    session = harvest_certs.session
+    key_prefix = f"ct:{log_id(log_url)}"
+    labels = PendingLabels() if harvest_certs.pipeline else None
+    stored = duplicates = errors = 0
+    position = chunk_start
+    while position <= chunk_end:
+        response = harvest_certs.fetcher.get(
+            f"{log_url}/ct/v1/get-entries?start={position}&end={chunk_end}", timeout=60)
+        response.raise_for_status()
+        entries = response.json().get("entries", [])
+        if not entries:
+            raise ValueError(f"log returned no entries for [{position}, {chunk_end}]")
+        session.incr("found", len(entries))
+        session.incr("bytes", len(response.content))
+
+        for offset, item in enumerate(decode_entries(entries)):
+            leaf_index = position + offset
+            if isinstance(item, Exception):
+                print(f"Error decoding entry {leaf_index}: {item}")
+                session.incr("failed")
+                errors += 1
+                continue
+            _, cert = item
+            pem_data = cert.public_bytes(serialization.Encoding.PEM).decode()
+            on_labeled = labels.track() if labels else None
+            if harvest_certs.store_cert(f"{key_prefix}:{leaf_index}", pem_data, cert, on_labeled):
+                stored += 1
+            else:
+                duplicates += 1
+                if on_labeled:
+                    # Nothing was queued for a duplicate
+                    on_labeled(True)
+
+        position += len(entries)
+
+    # Don't let the chunk be checkpointed before its certs are labeled
+    if labels and labels.wait():
+        raise ValueError(f"certificates in [{chunk_start}, {chunk_end}] failed labeling")
+    return stored, duplicates, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk-ingest certificates from an RFC 6962 CT log')
+    parser.add_argument('--log-url', required=True, help='Log base URL (without /ct/v1)')
+    parser.add_argument('--start', type=int, default=0, help='First leaf index to ingest')
+    parser.add_argument('--count', type=int, default=None, help='Number of entries to ingest (default: to the end of the tree)')
+    parser.add_argument('--chunk-size', type=int, default=1000,
+                        help='Entries per scheduled range; logs may serve each range in several smaller batches')
+    parser.add_argument('--state-file', default=None, help='Resume state (default: ../raw/ct_<log id>.state.json)')
+    parser.add_argument('--pipeline', action='store_true',
+                        help='Label certificates as they are decoded instead of saving them to raw/')
+    parser.add_argument('--label-workers', type=int, default=4, help='Labeling threads in --pipeline mode')
+    parser.add_argument('--queue-size', type=int, default=256,
+                        help='Certificates buffered between decoding and labeling in --pipeline mode')
+    parser.add_argument('--progress-interval', type=float, default=10.0, help='Seconds between progress lines')
+    parser.add_argument('--summary-file', default=None, help='Also write the final JSON summary to this file')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+
+    log_url = args.log_url.rstrip("/")
+    state_file = args.state_file or os.path.join(
+        harvest_certs.OUTPUT_DIR, f"ct_{log_id(log_url)}.state.json")
+    state = RangeState(state_file, log_url, args.chunk_size)
+
+    session = harvest_certs.session
+    session.name = "harvest_ct_log"
+    session.progress_interval = args.progress_interval
+    if args.pipeline:
+        harvest_certs.pipeline = LabelingPipeline(workers=args.label_workers, queue_size=args.queue_size,
+                                                  session=session)
+
+    tree_size = get_tree_size(log_url)
+    end = tree_size - 1 if args.count is None else min(tree_size, args.start + args.count) - 1
+    chunks = [
+        (chunk_start, min(chunk_start + args.chunk_size - 1, end))
+        for chunk_start in range(args.start, end + 1, args.chunk_size)
+        if chunk_start not in state.done
+    ]
+    print(f"Log {log_url}: tree size {tree_size}, ingesting [{args.start}, {end}] "
+          f"in {len(chunks)} chunks ({len(state.done)} already done)")
+
+    failed_chunks = 0
+
+    def run_chunk(chunk):
+        try:
+            return ingest_chunk(log_url, *chunk)
+        except (requests.exceptions.RequestException, ValueError) as e:
+            print(f"Chunk [{chunk[0]}, {chunk[1]}] failed: {e}")
+            return None
+
+    try:
+        for chunk, result in map_adaptive(run_chunk, chunks, harvest_certs.fetcher):
+            if result is None:
+                failed_chunks += 1
+                continue
+            stored, duplicates, errors = result
+            # Only checkpoint once the chunk's certs are safely stored
+            harvest_certs.save_index()
+            state.mark_done(chunk[0])
+            print(f"Chunk [{chunk[0]}, {chunk[1]}] done: {stored} new, {duplicates} duplicates, {errors} undecodable")
+            session.maybe_progress()
+    finally:
+        if harvest_certs.pipeline:
+            harvest_certs.pipeline.close()
+        harvest_certs.save_index()
+
+        print("\n=== CT Log Ingest Summary ===")
+        print(f"Chunks failed (will be retried on the next run): {failed_chunks}")
+        session.write_summary(args.summary_file)
+        export_metrics(args)
+
+
+if __name__ == "__main__":
+    main()
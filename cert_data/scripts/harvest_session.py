@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+harvest_session.py - Live counters and progress reporting for the harvesters
+
+A HarvestSession is updated incrementally as certificates are found,
+downloaded, deduplicated or rejected, so progress and the final summary never
+need to scan the output directory (which holds tens of thousands of files).
+
+Counters:
+    found       cert records listed by the upstream
+    downloaded  new unique certificates stored this run
+    duplicate   certificates skipped because we already have them
+    flawed      certificates that have at least one flaw
+    failed      downloads or parses that failed
+    bytes       PEM bytes received
+"""
+
+import json
+import threading
+import time
+
+from pipeline_metrics import BYTES_DOWNLOADED, CERTS
+
+COUNTERS = ("found", "downloaded", "duplicate", "flawed", "failed", "bytes")
+
+
+class HarvestSession:
+    def __init__(self, name, initial_stored=0, progress_interval=10.0, status=None):
+        """
+        initial_stored: certificates already stored before this run, taken from
+            the harvester's index rather than from a directory listing
+        status: optional callable whose string is appended to progress lines
+        """
+        self.name = name
+        self.initial_stored = initial_stored
+        self.progress_interval = progress_interval
+        self.status = status
+        self.counts = dict.fromkeys(COUNTERS, 0)
+        self.start_time = time.time()
+        self._last_progress = self.start_time
+        self._lock = threading.Lock()
+
+    def incr(self, counter, amount=1):
+        with self._lock:
+            self.counts[counter] += amount
+        # Mirror into Prometheus so rates show up on dashboards
+        if counter == "bytes":
+            BYTES_DOWNLOADED.inc(amount)
+        else:
+            CERTS.labels(result=counter).inc(amount)
+
+    @property
+    def stored(self):
+        """Certificates in the store, including those from earlier runs"""
+        with self._lock:
+            return self.initial_stored + self.counts["downloaded"]
+
+    def progress_line(self):
+        with self._lock:
+            counts = dict(self.counts)
+            elapsed = max(time.time() - self.start_time, 1e-9)
+        line = (f"[{self.name}] stored={self.initial_stored + counts['downloaded']} "
+                f"new={counts['downloaded']} dup={counts['duplicate']} flawed={counts['flawed']} "
+                f"failed={counts['failed']} {counts['downloaded'] / elapsed:.1f} certs/s "
+                f"{counts['bytes'] / elapsed / 1024:.1f} KiB/s")
+        if self.status:
+            line += f" | {self.status()}"
+        return line
+
+    def maybe_progress(self):
+        """Print a progress line, at most once per progress_interval seconds"""
+        now = time.time()
+        with self._lock:
+            if now - self._last_progress < self.progress_interval:
+                return
+            self._last_progress = now
+        print(f"\n>>> {self.progress_line()} <<<\n")
+
+    def summary(self):
+        with self._lock:
+            counts = dict(self.counts)
+        elapsed = time.time() - self.start_time
+        return {
+            "harvester": self.name,
+            "elapsed_seconds": round(elapsed, 1),
+            "initial_stored": self.initial_stored,
+            "stored": self.initial_stored + counts["downloaded"],
+            **counts,
+            "certs_per_second": round(counts["downloaded"] / elapsed, 2) if elapsed else 0.0
+        }
+
+    def write_summary(self, path=None):
+        """Print the final summary as JSON, and save it to path if given"""
+        summary = self.summary()
+        print(json.dumps(summary, indent=2))
+        if path:
+            with open(path, "w") as f:
+                json.dump(summary, f, indent=2)
+        return summary
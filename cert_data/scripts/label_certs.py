@@ -1,13 +1,18 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import json
 import datetime
 import hashlib
+import queue
+import threading
 from cryptography import x509
 from cryptography.hazmat.primitives.asymmetric import rsa
 from cryptography.hazmat.backends import default_backend
 from cryptography.x509.oid import NameOID, ExtensionOID
 
+from pipeline_metrics import LABEL_RULE_SECONDS, PARSE_SECONDS, add_metrics_args, export_metrics, record_write, start_metrics
+
 RAW_DIR = "../raw"
 LABELED_DIR = "../labeled"
 
@@ -46,40 +51,160 @@ def has_low_entropy_serial(cert):
         
     return False
 
-def get_flaws(cert):
-    flaws = []
+def is_expired(cert):
+    not_after = getattr(cert, "not_valid_after_utc", None)
+    if not_after is None:
+        return cert.not_valid_after < datetime.datetime.utcnow()
+    return not_after < datetime.datetime.now(datetime.timezone.utc)
 
-    # Expired
-    if cert.not_valid_after < datetime.datetime.utcnow():
-        flaws.append("expired")
-
-    # Short key
+def has_short_key(cert):
     pub_key = cert.public_key()
-    if isinstance(pub_key, rsa.RSAPublicKey):
-        if pub_key.key_size < 2048:
-            flaws.append("short_key")
+    return isinstance(pub_key, rsa.RSAPublicKey) and pub_key.key_size < 2048
 
-    # SHA1 signature
-    sig_algo = cert.signature_hash_algorithm.name.lower()
-    if "sha1" in sig_algo:
-        flaws.append("sha1_signature")
+def has_sha1_signature(cert):
+    # None for signature algorithms without a separate hash, such as Ed25519
+    algorithm = cert.signature_hash_algorithm
+    return algorithm is not None and "sha1" in algorithm.name.lower()
 
-    # Missing SAN
+def is_missing_san(cert):
     try:
         ext = cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
         san = ext.value.get_values_for_type(x509.DNSName)
-        if not san:
-            flaws.append("missing_SAN")
+        return not san
     except x509.ExtensionNotFound:
-        flaws.append("missing_SAN")
+        return True
 
-    # Low entropy serial
-    if has_low_entropy_serial(cert):
-        flaws.append("low_entropy_serial")
+# Flaw label -> rule, in the order labels are reported. The RAG service's
+# app/cert_flaws.py has the same rules; tests/test_flaw_rules.py checks
+# that both label certs alike
+FLAW_RULES = [
+    ("expired", is_expired),
+    ("short_key", has_short_key),
+    ("sha1_signature", has_sha1_signature),
+    ("missing_SAN", is_missing_san),
+    ("low_entropy_serial", has_low_entropy_serial),
+]
 
+def get_flaws(cert):
+    flaws = []
+    for flaw, rule in FLAW_RULES:
+        with LABEL_RULE_SECONDS.labels(rule=flaw).time():
+            if rule(cert):
+                flaws.append(flaw)
     return flaws
 
+def save_labeled(name, pem_data, cert):
+    """Label an already-parsed certificate and write <name>.json to LABELED_DIR"""
+    flaws = get_flaws(cert)
+
+    labeled_json = {
+        "pem": pem_data,
+        "flaws": flaws
+    }
+
+    out_file = os.path.join(LABELED_DIR, f"{name}.json")
+    with open(out_file, "w") as out:
+        json.dump(labeled_json, out, indent=2)
+    record_write("labeled", out_file)
+
+    return flaws
+
+class LabelingPipeline:
+    """
+    Streams certificates from the harvesters straight into the labeled store.
+
+    Producers hand over the PEM text together with the x509 object they already
+    parsed to compute the hash, so each certificate is parsed exactly once.
+    The queue is bounded: when labeling falls behind, submit() blocks and the
+    downloaders slow down instead of piling certificates up in memory.
+    If a HarvestSession is given, flawed and failed certs are counted on it.
+    """
+
+    def __init__(self, workers=4, queue_size=256, session=None):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.session = session
+        self.labeled = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._threads = [
+            threading.Thread(target=self._worker, name=f"labeler-{i}", daemon=True)
+            for i in range(workers)
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    def submit(self, name, pem_data, cert, on_done=None):
+        """
+        Queue a certificate for labeling. on_done(ok), if given, is called
+        from the labeling thread once it is labeled (True) or failed (False).
+        """
+        self.queue.put((name, pem_data, cert, on_done))
+
+    def close(self):
+        """Wait for everything queued so far to be labeled, then stop the workers"""
+        for _ in self._threads:
+            self.queue.put(None)
+        for thread in self._threads:
+            thread.join()
+
+    def _worker(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            name, pem_data, cert, on_done = item
+            try:
+                flaws = save_labeled(name, pem_data, cert)
+                with self._lock:
+                    self.labeled += 1
+                if flaws and self.session:
+                    self.session.incr("flawed")
+                print(f"Labeled {name}: {flaws}")
+                ok = True
+            except Exception as e:
+                with self._lock:
+                    self.failed += 1
+                if self.session:
+                    self.session.incr("failed")
+                print(f"Failed {name}: {e}")
+                ok = False
+            if on_done:
+                on_done(ok)
+
+class PendingLabels:
+    """Certificates submitted to a LabelingPipeline that a caller waits on as a group"""
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._pending = 0
+        self._failed = 0
+
+    def track(self):
+        """Count one more certificate; returns the on_done callback to submit it with"""
+        with self._cond:
+            self._pending += 1
+        return self._done
+
+    def _done(self, ok):
+        with self._cond:
+            self._pending -= 1
+            if not ok:
+                self._failed += 1
+            self._cond.notify_all()
+
+    def wait(self):
+        """Block until every tracked certificate is done; returns how many failed"""
+        with self._cond:
+            while self._pending:
+                self._cond.wait()
+            return self._failed
+
 def main():
+    parser = argparse.ArgumentParser(description='Label the certificates in raw/ with their flaws')
+    add_metrics_args(parser)
+    args = parser.parse_args()
+    start_metrics(args)
+
     files = [f for f in os.listdir(RAW_DIR) if f.endswith(".pem")]
     print(f"Found {len(files)} PEM files to label.")
 
@@ -89,22 +214,16 @@ def main():
             with open(path, "rb") as f:
                 pem_data = f.read()
 
-            cert = x509.load_pem_x509_certificate(pem_data, default_backend())
-            flaws = get_flaws(cert)
-
-            labeled_json = {
-                "pem": pem_data.decode(),
-                "flaws": flaws
-            }
-
-            out_file = os.path.join(LABELED_DIR, f"{fname.replace('.pem','.json')}")
-            with open(out_file, "w") as out:
-                json.dump(labeled_json, out, indent=2)
+            with PARSE_SECONDS.time():
+                cert = x509.load_pem_x509_certificate(pem_data, default_backend())
+            flaws = save_labeled(fname.replace('.pem', ''), pem_data.decode(), cert)
 
             print(f"Labeled {fname}: {flaws}")
 
         except Exception as e:
             print(f"Failed {fname}: {e}")
 
+    export_metrics(args)
+
 if __name__ == "__main__":
     main()
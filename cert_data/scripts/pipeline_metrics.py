@@ -0,0 +1,100 @@
+#!/usr/bin/env python3
+
+"""
+pipeline_metrics.py - Prometheus instrumentation for the certificate data pipeline
+
+All metrics live in one registry shared by the harvesters and label_certs.py.
+Long-running jobs expose it over HTTP (--metrics-port, scraped by the
+prometheus/ config); batch jobs write it out once at the end in the node
+exporter textfile format (--metrics-textfile, picked up by node-exporter's
+textfile collector).
+
+Certs/sec and bytes/sec are rates of the counters, e.g.
+    rate(pkisecops_certs_total{result="downloaded"}[5m])
+"""
+
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram, start_http_server, write_to_textfile
+
+REGISTRY = CollectorRegistry()
+
+DOWNLOAD_SECONDS = Histogram(
+    "pkisecops_download_seconds",
+    "Latency of requests to crt.sh / CT logs",
+    ["outcome"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    registry=REGISTRY,
+)
+CERTS = Counter(
+    "pkisecops_certs_total",
+    "Certificates seen by the harvesters, by result",
+    ["result"],
+    registry=REGISTRY,
+)
+BYTES_DOWNLOADED = Counter(
+    "pkisecops_downloaded_bytes_total",
+    "Bytes received from crt.sh / CT logs",
+    registry=REGISTRY,
+)
+PARSE_SECONDS = Histogram(
+    "pkisecops_parse_seconds",
+    "Time to parse one certificate",
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1),
+    registry=REGISTRY,
+)
+LABEL_RULE_SECONDS = Histogram(
+    "pkisecops_label_rule_seconds",
+    "Time spent in one flaw rule for one certificate",
+    ["rule"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01),
+    registry=REGISTRY,
+)
+FILES_WRITTEN = Counter(
+    "pkisecops_files_written_total",
+    "Files written to the certificate stores",
+    ["store"],
+    registry=REGISTRY,
+)
+BYTES_WRITTEN = Counter(
+    "pkisecops_written_bytes_total",
+    "Bytes written to the certificate stores",
+    ["store"],
+    registry=REGISTRY,
+)
+CONCURRENCY_LIMIT = Gauge(
+    "pkisecops_harvest_concurrency_limit",
+    "Current adaptive concurrency limit of the harvester",
+    registry=REGISTRY,
+)
+ERROR_RATE = Gauge(
+    "pkisecops_harvest_error_rate",
+    "Fraction of recent upstream requests that were throttled or timed out",
+    registry=REGISTRY,
+)
+
+
+def record_write(store, path):
+    """Count a file just written to one of the stores (raw, labeled, clean)"""
+    FILES_WRITTEN.labels(store=store).inc()
+    BYTES_WRITTEN.labels(store=store).inc(os.path.getsize(path))
+
+
+def add_metrics_args(parser):
+    parser.add_argument('--metrics-port', type=int, default=None,
+                        help='Serve Prometheus metrics on this port while running')
+    parser.add_argument('--metrics-textfile', default=None,
+                        help='Write metrics to this .prom file when done (node-exporter textfile collector)')
+
+
+def start_metrics(args):
+    if args.metrics_port:
+        start_http_server(args.metrics_port, registry=REGISTRY)
+        print(f"Serving Prometheus metrics on :{args.metrics_port}/metrics")
+
+
+def export_metrics(args):
+    if args.metrics_textfile:
+        os.makedirs(os.path.dirname(os.path.abspath(args.metrics_textfile)), exist_ok=True)
+        write_to_textfile(args.metrics_textfile, REGISTRY)
+        print(f"Wrote Prometheus metrics to {args.metrics_textfile}")
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+
+"""
+standin_server.py - Local stand-in for crt.sh and a CT log, used to exercise the harvesters
+
+Serves the PEM files of a local directory through the two crt.sh endpoints
+harvest_certs.py uses:
+
+    /?q=<pattern>&output=json   -> [{"id": 1}, {"id": 2}, ...]
+    /?d=<id>                    -> PEM text
+
+and as an RFC 6962 log for harvest_ct_log.py:
+
+    /ct/v1/get-sth                       -> {"tree_size": N, ...}
+    /ct/v1/get-entries?start=S&end=E     -> {"entries": [...]}
+
+The log serves x509_entry leaves built from the PEM files, or a recorded tree
+(--ct-record: a JSON list of get-entries items captured from a real log, so
+precert entries can be replayed too). Like real logs it caps the number of
+entries per response (--max-entries).
+
+Every endpoint throttles like a real upstream would, so the adaptive limiter and circuit
+breaker in harvest_control.py can be watched reacting:
+
+    --capacity N     answer 429 once more than N requests are in flight
+    --error-rate P   answer 503 for a random fraction P of requests
+    --latency-ms MS  add this much latency to every response
+
+Typical usage:
+    python3 standin_server.py --pem-dir ../raw --capacity 8 --port 8080
+    CRTSH_BASE_URL=http://127.0.0.1:8080 python3 harvest_certs.py
+    python3 harvest_ct_log.py --log-url http://127.0.0.1:8080
+"""
+
+import argparse
+import base64
+import json
+import os
+import random
+import struct
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit, parse_qs
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+
+
+def x509_leaf_entry(der, timestamp_ms):
+    """get-entries item for an x509_entry MerkleTreeLeaf with an empty chain"""
+    leaf = struct.pack(">BBQH", 0, 0, timestamp_ms, 0)
+    leaf += len(der).to_bytes(3, "big") + der
+    leaf += b"\x00\x00"  # no CtExtensions
+    return {
+        "leaf_input": base64.b64encode(leaf).decode(),
+        "extra_data": base64.b64encode(b"\x00\x00\x00").decode()
+    }
+
+
+def build_ct_entries(paths, record_file):
+    if record_file:
+        with open(record_file, "r") as f:
+            return json.load(f)
+    entries = []
+    timestamp_ms = int(time.time() * 1000)
+    for path in paths:
+        with open(path, "rb") as f:
+            cert = x509.load_pem_x509_certificate(f.read(), default_backend())
+        entries.append(x509_leaf_entry(cert.public_bytes(serialization.Encoding.DER), timestamp_ms))
+    return entries
+
+
+class StandinState:
+    def __init__(self, pem_dir, capacity, error_rate, latency_ms, limit, ct_record=None, max_entries=256):
+        files = sorted(f for f in os.listdir(pem_dir) if f.endswith(".pem"))[:limit]
+        # crt.sh ids are positive integers; number the files from 1
+        self.paths = {i + 1: os.path.join(pem_dir, f) for i, f in enumerate(files)}
+        self.ct_entries = build_ct_entries(self.paths.values(), ct_record)
+        self.max_entries = max_entries
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.latency = latency_ms / 1000.0
+        self.in_flight = 0
+        self.counts = {"ok": 0, "throttled": 0, "errors": 0}
+        self.lock = threading.Lock()
+
+
+def make_handler(state):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            with state.lock:
+                state.in_flight += 1
+                over_capacity = state.capacity and state.in_flight > state.capacity
+            try:
+                if state.latency:
+                    time.sleep(state.latency)
+                if over_capacity:
+                    self._count("throttled")
+                    self._send(429, "text/plain", b"Too Many Requests", {"Retry-After": "1"})
+                    return
+                if random.random() < state.error_rate:
+                    self._count("errors")
+                    self._send(503, "text/plain", b"Service Unavailable")
+                    return
+                self._serve()
+            finally:
+                with state.lock:
+                    state.in_flight -= 1
+
+        def _serve(self):
+            url = urlsplit(self.path)
+            query = parse_qs(url.query)
+            if url.path.startswith("/ct/v1/"):
+                self._serve_ct(url.path, query)
+                return
+            if "q" in query:
+                body = json.dumps([{"id": cert_id} for cert_id in state.paths]).encode()
+                self._count("ok")
+                self._send(200, "application/json", body)
+                return
+            if "d" in query:
+                try:
+                    path = state.paths[int(query["d"][0])]
+                except (KeyError, ValueError):
+                    self._send(404, "text/plain", b"Not Found")
+                    return
+                with open(path, "rb") as f:
+                    body = f.read()
+                self._count("ok")
+                self._send(200, "application/x-pem-file", body)
+                return
+            self._send(400, "text/plain", b"Bad Request")
+
+        def _serve_ct(self, path, query):
+            if path == "/ct/v1/get-sth":
+                body = json.dumps({
+                    "tree_size": len(state.ct_entries),
+                    "timestamp": int(time.time() * 1000),
+                    "sha256_root_hash": "",
+                    "tree_head_signature": ""
+                }).encode()
+            elif path == "/ct/v1/get-entries":
+                try:
+                    start = int(query["start"][0])
+                    end = int(query["end"][0])
+                except (KeyError, ValueError):
+                    self._send(400, "text/plain", b"Bad Request")
+                    return
+                if start < 0 or end < start or start >= len(state.ct_entries):
+                    self._send(400, "text/plain", b"Bad Request")
+                    return
+                end = min(end, start + state.max_entries - 1, len(state.ct_entries) - 1)
+                body = json.dumps({"entries": state.ct_entries[start:end + 1]}).encode()
+            else:
+                self._send(404, "text/plain", b"Not Found")
+                return
+            self._count("ok")
+            self._send(200, "application/json", body)
+
+        def _count(self, key):
+            with state.lock:
+                state.counts[key] += 1
+
+        def _send(self, status, content_type, body, headers=None):
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            for name, value in (headers or {}).items():
+                self.send_header(name, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # Per-request logging drowns out the periodic summary
+            pass
+
+    return Handler
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local crt.sh / CT log stand-in with configurable throttling')
+    parser.add_argument('--pem-dir', default='../raw', help='Directory of PEM files to serve')
+    parser.add_argument('--limit', type=int, default=1000, help='Serve at most this many certificates')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--capacity', type=int, default=8,
+                        help='Answer 429 above this many concurrent requests (0 = unlimited)')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='Fraction of requests answered with 503')
+    parser.add_argument('--latency-ms', type=float, default=50.0, help='Latency added to every response')
+    parser.add_argument('--ct-record', default=None,
+                        help='JSON list of recorded get-entries items to serve as the CT log (default: built from --pem-dir)')
+    parser.add_argument('--max-entries', type=int, default=256, help='Most entries returned per get-entries call')
+    args = parser.parse_args()
+
+    state = StandinState(args.pem_dir, args.capacity, args.error_rate, args.latency_ms, args.limit,
+                         args.ct_record, args.max_entries)
+    server = ThreadingHTTPServer((args.host, args.port), make_handler(state))
+    server.daemon_threads = True
+    print(f"Serving {len(state.paths)} certificates from {args.pem_dir} and a CT log of "
+          f"{len(state.ct_entries)} entries on http://{args.host}:{args.port}")
+
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        while True:
+            time.sleep(5)
+            with state.lock:
+                print(f"in_flight={state.in_flight} ok={state.counts['ok']} "
+                      f"throttled={state.counts['throttled']} errors={state.counts['errors']}")
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,8 @@
+import os
+import sys
+
+SCRIPTS_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "../scripts"))
+sys.path.insert(0, SCRIPTS_DIR)
+# The scripts resolve ../raw, ../labeled and ../clean against the working
+# directory, as when they are run from scripts/
+os.chdir(SCRIPTS_DIR)
@@ -0,0 +1,61 @@
+"""label_certs.py and the RAG service label certificates alike"""
+
+import datetime
+import os
+import sys
+
+import pytest
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ed25519, rsa
+from cryptography.x509.oid import NameOID
+
+import label_certs
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "../../rag_service_python")))
+from app import cert_flaws  # noqa: E402
+
+SAMPLE_DIRS = ["../raw", "../synthetic", "../sha1_flawed", "../short_key_flawed", "../missing_san_flawed",
+               "../low_entropy_flawed", "../clean"]
+PER_DIR = 200
+
+
+def sample_pems():
+    for directory in SAMPLE_DIRS:
+        if not os.path.isdir(directory):
+            continue
+        names = sorted(name for name in os.listdir(directory) if name.endswith(".pem"))
+        for name in names[:PER_DIR]:
+            yield os.path.join(directory, name)
+
+
+def test_rules_are_the_same_list():
+    assert [flaw for flaw, _ in label_certs.FLAW_RULES] == [flaw for flaw, _ in cert_flaws.FLAW_RULES]
+
+
+def test_both_label_the_sample_certs_alike():
+    checked = 0
+    for path in sample_pems():
+        with open(path, "rb") as f:
+            try:
+                cert = x509.load_pem_x509_certificate(f.read())
+            except ValueError:
+                continue
+        assert label_certs.get_flaws(cert) == cert_flaws.get_flaws(cert), path
+        checked += 1
+    if not checked:
+        pytest.skip("no sample certificates under cert_data")
+
+
+@pytest.mark.parametrize("key", [ed25519.Ed25519PrivateKey.generate(), rsa.generate_private_key(65537, 1024)])
+def test_both_label_generated_certs_alike(key):
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, "flaws.example")])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    # Ed25519 has no separate hash; cryptography no longer signs with SHA-1
+    algorithm = None if isinstance(key, ed25519.Ed25519PrivateKey) else hashes.SHA256()
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(1234).not_valid_before(now - datetime.timedelta(days=30))
+            .not_valid_after(now - datetime.timedelta(days=1)).sign(key, algorithm))
+    flaws = label_certs.get_flaws(cert)
+    assert flaws == cert_flaws.get_flaws(cert)
+    assert "expired" in flaws and "missing_SAN" in flaws and "low_entropy_serial" in flaws
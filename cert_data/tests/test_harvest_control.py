@@ -0,0 +1,111 @@
+"""AIMD limiter, circuit breaker and ID claim state transitions"""
+
+import threading
+
+import pytest
+
+import harvest_control
+from harvest_control import AIMDLimiter, CircuitBreaker, IdClaims
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(harvest_control.time, "monotonic", clock)
+    return clock
+
+
+def test_limiter_grows_by_one_per_window_of_successes(clock):
+    limiter = AIMDLimiter(initial=4, maximum=5)
+    for _ in range(3):
+        limiter.on_success()
+    assert limiter.limit == 4
+    limiter.on_success()
+    assert limiter.limit == 5
+    for _ in range(10):
+        limiter.on_success()
+    assert limiter.limit == 5
+
+
+def test_limiter_halves_once_per_burst_of_throttles(clock):
+    limiter = AIMDLimiter(initial=16, minimum=2)
+    started = [limiter.acquire() for _ in range(3)]
+    clock.now += 1
+    for start in started:
+        limiter.on_throttle(start)
+    # The other two were in flight before the decrease
+    assert limiter.limit == 8
+
+    clock.now += 1
+    limiter.on_throttle(clock.now)
+    limiter.on_throttle(clock.now + 1)
+    assert limiter.limit == 2
+    assert limiter.error_rate == 1.0
+
+
+def test_limiter_blocks_at_the_limit_until_a_release():
+    limiter = AIMDLimiter(initial=1)
+    limiter.acquire()
+    acquired = threading.Event()
+    thread = threading.Thread(target=lambda: (limiter.acquire(), acquired.set()))
+    thread.start()
+    assert not acquired.wait(0.1)
+    limiter.release()
+    assert acquired.wait(1)
+    thread.join()
+    assert limiter.in_flight == 1
+
+
+def test_breaker_opens_at_the_threshold_and_ignores_failures_in_flight(clock):
+    breaker = CircuitBreaker(failure_threshold=3, base_backoff=5.0)
+    for _ in range(2):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.CLOSED and breaker.wait_time() == 0.0
+
+    for _ in range(10):
+        breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.wait_time() == pytest.approx(5.0)
+
+    breaker.record_failure(retry_after=30)
+    assert breaker.wait_time() == pytest.approx(30.0)
+
+
+def test_breaker_lets_one_probe_through_and_doubles_the_backoff_per_trip(clock):
+    breaker = CircuitBreaker(failure_threshold=1, base_backoff=5.0)
+    breaker.record_failure()
+    clock.now += 5
+    assert breaker.wait_time() == 0.0
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # Only the probe goes ahead
+    assert breaker.wait_time() > 0
+
+    breaker.record_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert breaker.wait_time() == pytest.approx(10.0)
+
+    clock.now += 10
+    assert breaker.wait_time() == 0.0
+    breaker.record_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record_failure()
+    assert breaker.wait_time() == pytest.approx(5.0)
+
+
+def test_id_claims_let_one_worker_take_an_id():
+    lock = threading.Lock()
+    index = {"done": "hash"}
+    claims = IdClaims(lock, index)
+    assert not claims.claim("done")
+    assert claims.claim("new")
+    assert not claims.claim("new")
+    claims.release("new")
+    assert claims.claim("new")
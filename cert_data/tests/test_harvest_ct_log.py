@@ -0,0 +1,82 @@
+"""Decoding RFC 6962 get-entries items, and resuming a range"""
+
+import base64
+import datetime
+import struct
+
+from cryptography import x509
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+
+from harvest_ct_log import PRECERT_ENTRY, X509_ENTRY, RangeState, decode_entries, decode_entry, log_id
+
+
+def make_cert(common_name):
+    key = ec.generate_private_key(ec.SECP256R1())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, common_name)])
+    now = datetime.datetime(2025, 1, 1)
+    cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now).not_valid_after(now + datetime.timedelta(days=90))
+            .sign(key, hashes.SHA256()))
+    return cert.public_bytes(serialization.Encoding.DER)
+
+
+def opaque24(data):
+    return len(data).to_bytes(3, "big") + data
+
+
+def leaf(entry_type, body):
+    # MerkleTreeLeaf v1 / timestamped_entry: version, leaf type, timestamp, entry type
+    return struct.pack(">BBQH", 0, 0, 1700000000000, entry_type) + body + b"\x00\x00"
+
+
+def b64(data):
+    return base64.b64encode(data).decode()
+
+
+def test_decode_x509_entry():
+    der = make_cert("leaf.example")
+    entry = {"leaf_input": b64(leaf(X509_ENTRY, opaque24(der))),
+             "extra_data": b64(opaque24(opaque24(make_cert("issuer.example"))))}
+    assert decode_entry(entry) == (X509_ENTRY, der)
+
+
+def test_decode_precert_entry_takes_the_precertificate_from_extra_data():
+    precert = make_cert("precert.example")
+    issuer_key_hash = b"\x11" * 32
+    # The leaf only has the TBSCertificate, which isn't a parseable certificate
+    tbs = b"\x30\x03\x02\x01\x01"
+    entry = {"leaf_input": b64(leaf(PRECERT_ENTRY, issuer_key_hash + opaque24(tbs))),
+             "extra_data": b64(opaque24(precert) + opaque24(b""))}
+    assert decode_entry(entry) == (PRECERT_ENTRY, precert)
+
+    [(entry_type, cert)] = decode_entries([entry])
+    assert entry_type == PRECERT_ENTRY
+    assert cert.subject.get_attributes_for_oid(NameOID.COMMON_NAME)[0].value == "precert.example"
+
+
+def test_decode_entries_reports_bad_entries_in_place():
+    good = {"leaf_input": b64(leaf(X509_ENTRY, opaque24(make_cert("leaf.example")))), "extra_data": ""}
+    truncated = {"leaf_input": b64(leaf(X509_ENTRY, b"\x00\x10\x00abc")), "extra_data": ""}
+    unknown_type = {"leaf_input": b64(leaf(7, b"")), "extra_data": ""}
+    decoded = decode_entries([good, truncated, unknown_type])
+    assert decoded[0][0] == X509_ENTRY
+    assert isinstance(decoded[1], ValueError) and isinstance(decoded[2], ValueError)
+
+
+def test_range_state_resumes_only_the_same_log_and_chunk_size(tmp_path):
+    path = str(tmp_path / "state.json")
+    state = RangeState(path, "https://log.example/a", 1000)
+    state.mark_done(0)
+    state.mark_done(2000)
+
+    assert RangeState(path, "https://log.example/a", 1000).done == {0, 2000}
+    assert RangeState(path, "https://log.example/b", 1000).done == set()
+    assert RangeState(path, "https://log.example/a", 500).done == set()
+
+
+def test_log_ids_tell_logs_apart():
+    assert log_id("https://log.example/a") != log_id("https://log.example/b")
+    assert len(log_id("https://log.example/a")) == 16
@@ -7,20 +7,90 @@ Downloads RFCs + CA/B documents directly from the web using WebBaseLoader,
 splits into clean paragraphs, encodes them with SentenceTransformer,
 and builds a FAISS index for fast similarity search.
 
-Also writes a metadata.json that maps index IDs to their paragraph + source.
+Also writes a metadata.sqlite store that maps index IDs to their paragraph +
+source (read lazily by id by the service), a BM25 index of the paragraphs in
+lexical/ for exact section/OID/identifier lookups, the source id of every
+vector (source_ids.npy, for source-filtered queries), and a manifest.json
+recording the index type and its parameters, which the RAG service reads to
+know how to search the index.
+
+Each build goes into a new version directory under faiss_index/ and is then
+published by pointing faiss_index/CURRENT at it, so a running service never
+sees a half-written index and picks the new one up without a restart (see
+rag_service_python/app/knowledge_base.py). The newest --keep-versions builds
+are kept.
+
+Paragraphs added or deleted through the service's admin endpoints since the
+last build are not part of a new build from the web (it warns about
+them); --from-embeddings refuses to run over them, since the saved
+embeddings no longer match the paragraphs.
+
+Index types (see rag_service_python/app/indexes.py):
+    flat      exact brute-force search (default)
+    ivf_flat  --nlist cells, --nprobe scanned per query
+    ivf_pq    as ivf_flat with --pq-m x --pq-nbits product quantization
+    hnsw      --hnsw-m links per node, --ef-construction / --ef-search
+
+--metric cosine L2-normalizes the embeddings and searches by inner product
+(the service normalizes its queries to match). --storage fp16 / sq8 keeps
+the vectors as float16 / 8-bit scalar-quantized codes, for half / a quarter
+of the index memory; --recall-report shows what that costs against exact
+float32 search.
+
+--shards N splits the index into N shards (shards/shard-NNN.index) that the
+service searches in parallel, one process per shard, merging their top-k
+(see rag_service_python/app/shards.py). IVF / SQ training is shared by all
+shards. The recall report and citations search the shards in-process.
 
 Run:
     python3 build_faiss.py
+    python3 build_faiss.py --index-type hnsw --hnsw-m 32 --ef-search 64 --recall-report
+    python3 build_faiss.py --metric cosine --storage sq8 --recall-report
+    python3 build_faiss.py --from-embeddings --index-type hnsw --shards 4
+
+--embedding-backend onnx encodes with the int8 ONNX Runtime export of the
+model (python -m app.embedding export, from rag_service_python/) instead of
+PyTorch.
+
+The top --citation-k passages for every certificate flaw's question and
+each line of --citation-questions (scripts/golden_queries.txt by default)
+are searched once and stored with the index (citations.json), so the service
+answers those questions from memory (see rag_service_python/app/citations.py).
+
+--save-embeddings keeps the paragraph embeddings next to the index, so other
+index types can be tried with --from-embeddings without re-downloading and
+re-encoding the corpus. --recall-report measures recall@k and latency of the
+new index against exact flat search across a sweep of nprobe / efSearch.
 
 Author: Mihir Gupta, 2025
 ================================================================================
 """
 
-import json
+import argparse
+import os
+import shutil
+import sys
+import time
+
 import faiss
 import numpy as np
-from langchain.document_loaders import WebBaseLoader
-from sentence_transformers import SentenceTransformer
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(SCRIPT_DIR, "../.."))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, "rag_service_python"))
+
+from app.cert_flaws import FLAW_QUESTIONS
+from app.citations import CitationTable
+from app.embedding import BACKENDS, load_embedder
+from app.indexes import (INDEX_TYPES, METRICS, STORAGE_TYPES, apply_search_params, build_params, create_index,
+                         faiss_search_parameters, l2_normalized, needs_training, search_params, similarities,
+                         write_manifest)
+from app.knowledge_base import (INDEX_NAME, current_index_dir, has_live_edits, new_version_dir, prune_versions,
+                                publish)
+from app.lexical import LexicalIndex
+from app.metastore import write_store
+from app.shards import build_shards, combine_shards, write_shards
+from app.sources import SourceMap
 
 # ----------------------------
 # CONFIG
@@ -36,70 +106,310 @@ urls = [
     "https://cabforum.org/working-groups/server/baseline-requirements/documents/CA-Browser-Forum-TLS-BR-2.1.5.pdf"
 ]
 
-OUTPUT_DIR = "../faiss_index/"
-INDEX_FILE = OUTPUT_DIR + "faiss_index.index"
-META_FILE  = OUTPUT_DIR + "metadata.json"
+MODEL_NAME = "all-MiniLM-L6-v2"
+INDEX_ROOT = os.path.abspath(os.path.join(SCRIPT_DIR, "../faiss_index"))
+EMBEDDINGS_FILE = os.path.join(INDEX_ROOT, "embeddings.npy")
+# Built with the paragraphs, so copied over when rebuilding --from-embeddings
+PARAGRAPH_FILES = ["metadata.sqlite", "metadata.json", "lexical", "source_ids.npy", "sources.json"]
+ONNX_DIR = os.path.join(PROJECT_ROOT, "onnx_model")
+CITATION_QUESTIONS_FILE = os.path.join(PROJECT_ROOT, "rag_service_python/scripts/golden_queries.txt")
+
+# Values swept by the recall report, per search knob
+SWEEPS = {
+    "nprobe": [1, 2, 4, 8, 16, 32, 64, 128],
+    "ef_search": [16, 32, 64, 128, 256, 512],
+}
+
 
 # ----------------------------
 # 1️⃣ Load documents from web
 # ----------------------------
-print("✅ Loading documents from the web...")
-docs = []
-for url in urls:
-    loader = WebBaseLoader(url)
-    loaded = loader.load()
-    print(f"Loaded {len(loaded)} from {url}")
-    for doc in loaded:
-        docs.append({
-            "content": doc.page_content,
-            "source": url
-        })
+def load_documents():
+    from langchain.document_loaders import WebBaseLoader
+
+    print("✅ Loading documents from the web...")
+    docs = []
+    for url in urls:
+        loader = WebBaseLoader(url)
+        loaded = loader.load()
+        print(f"Loaded {len(loaded)} from {url}")
+        for doc in loaded:
+            docs.append({
+                "content": doc.page_content,
+                "source": url
+            })
+    return docs
+
 
 # ----------------------------
 # 2️⃣ Split into paragraphs
 # ----------------------------
-print("✅ Splitting into paragraphs...")
-paragraphs = []
-metadata = {}
-idx = 0
-for doc in docs:
-    for para in doc["content"].split("\n\n"):
-        clean_para = para.strip()
-        if len(clean_para) < 50:  # skip very short
-            continue
-        paragraphs.append(clean_para)
-        metadata[idx] = {
-            "text": clean_para,
-            "source": doc["source"]
-        }
-        idx += 1
-
-print(f"Total paragraphs: {len(paragraphs)}")
+def split_paragraphs(docs):
+    print("✅ Splitting into paragraphs...")
+    paragraphs = []
+    metadata = {}
+    idx = 0
+    for doc in docs:
+        for para in doc["content"].split("\n\n"):
+            clean_para = para.strip()
+            if len(clean_para) < 50:  # skip very short
+                continue
+            paragraphs.append(clean_para)
+            metadata[idx] = {
+                "text": clean_para,
+                "source": doc["source"]
+            }
+            idx += 1
+
+    print(f"Total paragraphs: {len(paragraphs)}")
+    return paragraphs, metadata
+
 
 # ----------------------------
 # 3️⃣ Embed paragraphs
 # ----------------------------
-print("✅ Encoding with sentence-transformers...")
-model = SentenceTransformer("all-MiniLM-L6-v2")
-embeddings = model.encode(paragraphs, convert_to_numpy=True, show_progress_bar=True)
+def encode_paragraphs(paragraphs, model):
+    print(f"✅ Encoding {len(paragraphs)} paragraphs...")
+    embeddings = model.encode(paragraphs, convert_to_numpy=True, show_progress_bar=True)
+    return np.ascontiguousarray(embeddings, dtype="float32")
+
 
 # ----------------------------
 # 4️⃣ Build FAISS index
 # ----------------------------
-print("✅ Building FAISS index...")
-dim = embeddings.shape[1]
-index = faiss.IndexFlatL2(dim)
-index.add(embeddings)
+def build_index(embeddings, index_type, params, train_size, metric, storage, num_shards):
+    """
+    (index, shards): with num_shards > 1, shards is the list of shard
+    indexes and index searches all of them; otherwise shards is None
+    """
+    print(f"✅ Building FAISS index ({index_type}, {metric}, {storage}, {params})...")
+    dim = embeddings.shape[1]
+    train_vectors = None
+    if needs_training(index_type, storage):
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(embeddings), min(train_size, len(embeddings)), replace=False)
+        train_vectors = embeddings[np.sort(sample)]
+    started = time.time()
+    if num_shards > 1:
+        ids = np.arange(len(embeddings), dtype=np.int64)
+        shards = build_shards(index_type, params, embeddings, ids, num_shards, train_vectors, metric, storage)
+        index = combine_shards(shards)
+        print(f"Built {index.ntotal} vectors in {num_shards} shards in {time.time() - started:.1f}s")
+        return index, shards
+    index = create_index(index_type, dim, params, train_vectors, metric, storage)
+    index.add(embeddings)
+    print(f"Built {index.ntotal} vectors in {time.time() - started:.1f}s")
+    return index, None
+
 
 # ----------------------------
-# 5️⃣ Save index and metadata
+# 5️⃣ Recall / latency report
 # ----------------------------
-print("✅ Saving FAISS index & metadata...")
-import os
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-faiss.write_index(index, INDEX_FILE)
+def recall_report(index, index_type, storage, metric, defaults, embeddings, k, num_queries):
+    """
+    recall@k of the index against exact float32 flat search with the same
+    metric, and mean per-query latency, for each value of the index's
+    search knob. Queries are a random sample of the corpus embeddings.
+    """
+    rng = np.random.default_rng(1)
+    sample = rng.choice(len(embeddings), min(num_queries, len(embeddings)), replace=False)
+    queries = embeddings[sample]
+
+    exact = faiss.IndexFlatIP(embeddings.shape[1]) if metric == "cosine" else faiss.IndexFlatL2(embeddings.shape[1])
+    exact.add(embeddings)
+
+    def timed_search(search_index, params=None):
+        started = time.perf_counter()
+        # One query at a time, as the service sees them when idle
+        ids = np.vstack([search_index.search(queries[i:i + 1], k, params=params)[1]
+                         for i in range(len(queries))])
+        return ids, (time.perf_counter() - started) * 1000 / len(queries)
+
+    truth, flat_ms = timed_search(exact)
+    rows = [{"index_type": "flat", "storage": "float32", "recall_at_k": 1.0, "latency_ms": round(flat_ms, 3)}]
+
+    knobs = list(defaults)
+    settings = [dict(defaults)]
+    if knobs:
+        knob = knobs[0]
+        settings = [{**defaults, knob: value} for value in SWEEPS[knob]]
+    for setting in settings:
+        ids, ms = timed_search(index, faiss_search_parameters(index_type, setting))
+        hits = sum(len(set(found) & set(expected)) for found, expected in zip(ids, truth))
+        rows.append({
+            "index_type": index_type,
+            "storage": storage,
+            **setting,
+            "recall_at_k": round(hits / truth.size, 4),
+            "latency_ms": round(ms, 3),
+        })
+
+    print(f"\nrecall@{k} vs latency over {len(queries)} queries:")
+    for row in rows:
+        knob_text = " ".join(f"{name}={row[name]}" for name in defaults if name in row)
+        print(f"  {row['index_type']:<9} {row['storage']:<8} {knob_text:<16} recall={row['recall_at_k']:.4f} "
+              f"latency={row['latency_ms']:.3f} ms")
+    return {"k": k, "queries": len(queries), "results": rows}
+
+
+# ----------------------------
+# 6️⃣ Precompute citations for fixed questions
+# ----------------------------
+def build_citations(index, index_type, metric, defaults, model, questions_file, k):
+    questions = list(FLAW_QUESTIONS.values())
+    if questions_file:
+        with open(questions_file) as f:
+            questions += f.read().splitlines()
+    questions = CitationTable.questions_for(questions)
+    print(f"✅ Precomputing top-{k} citations for {len(questions)} questions...")
+    # Encoded normalized, exactly as the service encodes them
+    embeddings = np.ascontiguousarray(model.encode(questions, convert_to_numpy=True), dtype="float32")
+    if metric == "cosine":
+        embeddings = l2_normalized(embeddings)
+    search_parameters = faiss_search_parameters(index_type, defaults)
+
+    def search(vectors, n):
+        distances, ids = index.search(vectors, n, params=search_parameters)
+        return similarities(distances, metric), ids
+
+    return CitationTable.build(questions, embeddings, search, k, defaults)
+
+
+# ----------------------------
+# 7️⃣ Save index and metadata, then publish
+# ----------------------------
+def save(index, shards, metadata, manifest, citations, keep_versions):
+    os.makedirs(INDEX_ROOT, exist_ok=True)
+    previous_dir = current_index_dir(INDEX_ROOT)
+    output_dir = new_version_dir(INDEX_ROOT)
+    print(f"✅ Saving FAISS index & metadata to {output_dir}...")
+    if shards:
+        manifest["index_bytes"] = write_shards(shards, output_dir)
+    else:
+        faiss.write_index(index, os.path.join(output_dir, INDEX_NAME))
+        manifest["index_bytes"] = os.path.getsize(os.path.join(output_dir, INDEX_NAME))
+    print(f"Index is {manifest['index_bytes'] / 2**20:.1f} MiB "
+          f"({manifest['storage']}; float32 vectors alone would be "
+          f"{manifest['ntotal'] * manifest['dim'] * 4 / 2**20:.1f} MiB)")
+
+    if metadata is not None:
+        write_store(os.path.join(output_dir, "metadata.sqlite"), metadata.items())
+        print("✅ Building BM25 lexical index...")
+        LexicalIndex.build(metadata.items()).save(output_dir)
+        source_map = SourceMap.build(metadata.items())
+        source_map.save(output_dir)
+        print(f"✅ Recorded source ids ({', '.join(source_map.names)})...")
+    else:
+        # Same paragraphs as the version being replaced
+        for name in PARAGRAPH_FILES:
+            path = os.path.join(previous_dir, name)
+            if os.path.isdir(path):
+                shutil.copytree(path, os.path.join(output_dir, name))
+            elif os.path.exists(path):
+                shutil.copy2(path, output_dir)
+
+    citations.save(output_dir)
+    write_manifest(output_dir, manifest)
+    publish(INDEX_ROOT, output_dir)
+    print(f"🎉 Done! Published {output_dir}")
+    for name in prune_versions(INDEX_ROOT, keep_versions):
+        print(f"Removed old version {name}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build the FAISS index for the RAG service')
+    parser.add_argument('--index-type', choices=INDEX_TYPES, default='flat')
+    parser.add_argument('--metric', choices=METRICS, default='l2',
+                        help='cosine: normalize embeddings and search by inner product')
+    parser.add_argument('--storage', choices=STORAGE_TYPES, default='float32',
+                        help='Vector storage: float32, float16, or 8-bit scalar quantization (not with ivf_pq)')
+    parser.add_argument('--nlist', type=int, help='IVF cells (ivf_flat, ivf_pq)')
+    parser.add_argument('--nprobe', type=int, help='IVF cells scanned per query (default search setting)')
+    parser.add_argument('--pq-m', type=int, help='PQ sub-quantizers; must divide the embedding dimension')
+    parser.add_argument('--pq-nbits', type=int, help='Bits per PQ code')
+    parser.add_argument('--hnsw-m', type=int, help='HNSW links per node')
+    parser.add_argument('--ef-construction', type=int, help='HNSW candidate list size while building')
+    parser.add_argument('--ef-search', type=int, help='HNSW candidate list size per query (default search setting)')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='Split the index into this many shards, searched in parallel by the service')
+    parser.add_argument('--train-size', type=int, default=100000,
+                        help='Vectors sampled to train IVF indexes')
+    parser.add_argument('--embedding-backend', choices=BACKENDS, default='torch',
+                        help=f'Encode with PyTorch or the int8 ONNX export in {ONNX_DIR}')
+    parser.add_argument('--save-embeddings', action='store_true',
+                        help=f'Also save the paragraph embeddings to {EMBEDDINGS_FILE}')
+    parser.add_argument('--from-embeddings', action='store_true',
+                        help='Rebuild from saved embeddings and the existing metadata store instead of the web')
+    parser.add_argument('--recall-report', action='store_true',
+                        help='Report recall@k and latency against exact search')
+    parser.add_argument('--report-k', type=int, default=10)
+    parser.add_argument('--report-queries', type=int, default=1000)
+    parser.add_argument('--citation-questions', default=CITATION_QUESTIONS_FILE,
+                        help='Questions, one per line, to precompute passages for besides the flaw questions '
+                             '("" for none)')
+    parser.add_argument('--citation-k', type=int, default=10,
+                        help='Passages precomputed per question; larger k is searched live')
+    parser.add_argument('--keep-versions', type=int, default=3,
+                        help='Published index versions to keep on disk, this one included')
+    args = parser.parse_args()
+
+    # Edits made through the service since the last build, pending or compacted
+    current_dir = current_index_dir(INDEX_ROOT)
+    live_edits = has_live_edits(current_dir)
+
+    print(f"✅ Loading {MODEL_NAME} ({args.embedding_backend} backend)...")
+    model = load_embedder(args.embedding_backend, MODEL_NAME, ONNX_DIR)
+
+    if args.from_embeddings:
+        if live_edits:
+            sys.exit(f"❌ {current_dir} has live edits that {EMBEDDINGS_FILE} doesn't cover; "
+                     "rebuild from the web instead")
+        print(f"✅ Loading embeddings from {EMBEDDINGS_FILE}...")
+        embeddings = np.load(EMBEDDINGS_FILE)
+        metadata = None  # keep the metadata store the embeddings were built with
+    else:
+        if live_edits:
+            print(f"⚠️ {current_dir} has live edits this build from the web won't include")
+        docs = load_documents()
+        paragraphs, metadata = split_paragraphs(docs)
+        embeddings = encode_paragraphs(paragraphs, model)
+        if args.save_embeddings:
+            os.makedirs(INDEX_ROOT, exist_ok=True)
+            np.save(EMBEDDINGS_FILE, embeddings)
+
+    if args.metric == "cosine":
+        embeddings = l2_normalized(embeddings)
+
+    options = vars(args)
+    params = build_params(args.index_type, options)
+    defaults = search_params(args.index_type, options)
+    index, shards = build_index(embeddings, args.index_type, params, args.train_size, args.metric, args.storage,
+                                args.shards)
+    for part in shards or [index]:
+        apply_search_params(part, args.index_type, defaults)
+
+    manifest = {
+        "index_type": args.index_type,
+        "metric": args.metric,
+        "storage": args.storage,
+        "model": MODEL_NAME,
+        "dim": int(embeddings.shape[1]),
+        "ntotal": int(index.ntotal),
+        "build_params": params,
+        "search_params": defaults,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+    }
+    if shards:
+        manifest.update({"shards": len(shards), "max_id": int(index.ntotal) - 1})
+    if args.recall_report:
+        manifest["recall_report"] = recall_report(
+            index, args.index_type, args.storage, args.metric, defaults, embeddings, args.report_k,
+            args.report_queries)
+
+    citations = build_citations(index, args.index_type, args.metric, defaults, model, args.citation_questions,
+                                args.citation_k)
+    save(index, shards, metadata, manifest, citations, args.keep_versions)
 
-with open(META_FILE, "w") as f:
-    json.dump(metadata, f, indent=2)
 
-print(f"🎉 Done! Wrote index to {INDEX_FILE} and metadata to {META_FILE}")
+if __name__ == "__main__":
+    main()
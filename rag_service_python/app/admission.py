@@ -0,0 +1,101 @@
+"""
+================================================================================
+Request coalescing and admission control for the RAG service
+
+SingleFlight: identical queries that are in flight at the same time (the
+same question asked by 50 workers of one batch job) share one computation.
+The first request starts it as its own task and the rest await that task;
+a caller that disconnects stops waiting without cancelling it for the
+others.
+
+AdmissionController: at most max_in_flight requests are worked on at once,
+and at most max_queue more wait for a slot, each for up to max_queue_wait_ms.
+A request that would be queue entry max_queue + 1, or whose wait runs out,
+is rejected right away with Overloaded (a 503 with Retry-After), instead of
+piling up behind the others until everything times out. Admitted requests
+keep a bounded tail latency: the time to drain the queue ahead of them.
+================================================================================
+"""
+
+import asyncio
+
+
+class Overloaded(Exception):
+    """A request was not admitted; reason is queue_full or queue_timeout"""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class SingleFlight:
+    def __init__(self, on_coalesced=None):
+        """on_coalesced: optional callable run for every call that joined one in flight"""
+        self.on_coalesced = on_coalesced
+        self._calls = {}
+
+    async def do(self, key, compute):
+        """Result of compute() (a coroutine function), shared with concurrent calls for key"""
+        loop = asyncio.get_running_loop()
+        task = self._calls.get(key)
+        if task is None or task.get_loop() is not loop:
+            task = loop.create_task(compute())
+            self._calls[key] = task
+            task.add_done_callback(lambda done: self._forget(key, done))
+        elif self.on_coalesced:
+            self.on_coalesced()
+        return await asyncio.shield(task)
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def __len__(self):
+        return len(self._calls)
+
+
+class AdmissionController:
+    def __init__(self, max_in_flight=64, max_queue=256, max_queue_wait_ms=1000.0):
+        """max_in_flight: concurrent requests allowed; 0 or less admits everything"""
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.max_queue_wait = max_queue_wait_ms / 1000.0
+        self.queued = 0
+        self._slots = None
+        self._loop = None
+
+    async def acquire(self):
+        """
+        Wait for a slot, or raise Overloaded. Returns the function that gives
+        the slot back; calling it more than once is harmless.
+        """
+        if self.max_in_flight <= 0:
+            return lambda: None
+        loop = asyncio.get_running_loop()
+        if self._slots is None or self._loop is not loop:
+            # Created lazily on the server's event loop, like the micro-batcher's queue
+            self._loop = loop
+            self._slots = asyncio.Semaphore(self.max_in_flight)
+            self.queued = 0
+        if self._slots.locked():
+            if self.queued >= self.max_queue:
+                raise Overloaded("queue_full")
+            self.queued += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.max_queue_wait)
+            except asyncio.TimeoutError:
+                raise Overloaded("queue_timeout")
+            finally:
+                self.queued -= 1
+        else:
+            await self._slots.acquire()
+
+        slots = self._slots
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                slots.release()
+        return release
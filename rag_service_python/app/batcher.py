@@ -0,0 +1,84 @@
+"""
+================================================================================
+Micro-batching for /query
+
+Questions that arrive within a few milliseconds of each other are collected
+into one batch, so the service pays the transformer's per-call overhead once:
+one SentenceTransformer.encode call and one multi-row index.search per batch,
+with the results fanned back out to the waiting requests.
+
+A batch is closed when it reaches max_batch_size or when max_wait_ms has
+passed since its first question arrived. While one batch is being processed
+the next one fills up, so batches grow with load and stay at size 1 when the
+service is idle.
+================================================================================
+"""
+
+import asyncio
+
+
+class MicroBatcher:
+    def __init__(self, process_batch, max_batch_size=32, max_wait_ms=5.0):
+        """
+        process_batch: blocking function taking a list of items and returning
+            a list of results in the same order; it runs in a worker thread
+        """
+        self.process_batch = process_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = None
+        self._worker = None
+        self._loop = None
+
+    async def submit(self, item):
+        """Queue one item and wait for its result"""
+        loop = asyncio.get_running_loop()
+        if self._worker is None or self._loop is not loop or self._worker.done():
+            # Started lazily so the queue belongs to the server's event loop,
+            # and restarted if the app is served from a new loop
+            self._loop = loop
+            self._queue = asyncio.Queue()
+            self._worker = loop.create_task(self._run())
+        future = loop.create_future()
+        await self._queue.put((item, future))
+        return await future
+
+    async def _collect(self):
+        batch = [await self._queue.get()]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            # Take whatever is already waiting without yielding first
+            try:
+                batch.append(self._queue.get_nowait())
+                continue
+            except asyncio.QueueEmpty:
+                pass
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._collect()
+            # Requests that were cancelled while queued don't need computing
+            batch = [(item, future) for item, future in batch if not future.done()]
+            if not batch:
+                continue
+            try:
+                results = await loop.run_in_executor(
+                    None, self.process_batch, [item for item, _ in batch])
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), result in zip(batch, results):
+                if not future.done():
+                    future.set_result(result)
@@ -0,0 +1,204 @@
+"""
+================================================================================
+Query caches for the RAG service
+
+The same handful of questions are asked over and over, so the service keeps
+two bounded LRU caches with a TTL, both keyed by the normalized question:
+
+- embeddings: normalized question -> query vector (skips the encode)
+- results:    (normalized question, k, search params) -> top-k index ids
+              and scores (skips encode + search)
+
+The results cache is cleared whenever the knowledge base is (re)loaded, so a
+new index never serves ids computed against the old one; embeddings only
+depend on the model and survive a reload.
+
+Exact keys miss paraphrases ("is sha1 ok" / "can I use SHA-1 signatures").
+SemanticCache is a third, opt-in cache, for corpora where the main search
+is the expensive part: a small inner-product FAISS index over the
+normalized embeddings of recently searched questions. A new question whose
+embedding is within a cosine threshold of one of them, asked with the same
+k, search params, sources and knowledge base, gets that question's results
+without the main index being searched. The encode is still paid.
+================================================================================
+"""
+
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+from app.indexes import l2_normalized
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def normalize_question(question):
+    """
+    Cache key for a question. The embedding model is uncased, so lowercasing
+    and collapsing whitespace doesn't change the vector it produces.
+    """
+    return _WHITESPACE.sub(" ", question).strip().lower()
+
+
+class LRUCache:
+    """Thread-safe LRU cache with a per-entry time to live"""
+
+    def __init__(self, max_entries=4096, ttl_seconds=3600.0, on_lookup=None):
+        """on_lookup: optional callable told hit=True/False on every get"""
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.on_lookup = on_lookup
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        value = None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if entry[1] > time.monotonic():
+                    self._entries.move_to_end(key)
+                    value = entry[0]
+                else:
+                    del self._entries[key]
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if self.on_lookup:
+            self.on_lookup(value is not None)
+        return value
+
+    def put(self, key, value):
+        if self.max_entries <= 0:
+            return
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
+
+
+class SemanticCache:
+    """
+    Thread-safe LRU cache of top-k results keyed by (context, query embedding),
+    hit when a cached embedding with the same context has cosine
+    similarity >= threshold with the query's
+    """
+
+    # Nearest cached embeddings checked for one with the query's context
+    CANDIDATES = 8
+
+    def __init__(self, max_entries=1024, threshold=0.95, ttl_seconds=3600.0, on_lookup=None):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.ttl = ttl_seconds
+        self.on_lookup = on_lookup
+        self.hits = 0
+        self.misses = 0
+        self._index = None          # IndexIDMap2 over normalized embeddings, by entry id
+        self._entries = OrderedDict()  # entry id -> (context, result, expiry), oldest first
+        self._next_id = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, context_embeddings):
+        """Cached results, or None, for each (context, embedding) pair"""
+        if self.max_entries <= 0 or not context_embeddings:
+            return [None] * len(context_embeddings)
+        contexts = [context for context, _ in context_embeddings]
+        queries = l2_normalized(np.vstack([embedding for _, embedding in context_embeddings]))
+        answers = [None] * len(contexts)
+        with self._lock:
+            pending = list(range(len(contexts)))
+            while pending and self._entries:
+                similarities, entry_ids = self._index.search(
+                    queries[pending], min(self.CANDIDATES, len(self._entries)))
+                now = time.monotonic()
+                expired = set()
+                for i, row in enumerate(pending):
+                    for similarity, entry_id in zip(similarities[i], entry_ids[i]):
+                        if entry_id < 0 or similarity < self.threshold:
+                            break
+                        entry = self._entries.get(int(entry_id))
+                        if entry is not None and entry[2] <= now:
+                            expired.add(int(entry_id))
+                        elif entry is not None and entry[0] == contexts[row]:
+                            self._entries.move_to_end(int(entry_id))
+                            answers[row] = entry[1]
+                            break
+                if not expired:
+                    break
+                # Drop them from the index too, so they stop taking candidate slots, and look again past them
+                for entry_id in expired:
+                    del self._entries[entry_id]
+                self._index.remove_ids(np.array(sorted(expired), dtype=np.int64))
+                pending = [row for row in pending if answers[row] is None]
+            hits = sum(answer is not None for answer in answers)
+            self.hits += hits
+            self.misses += len(answers) - hits
+        if self.on_lookup:
+            for answer in answers:
+                self.on_lookup(answer is not None)
+        return answers
+
+    def put_many(self, entries):
+        """Cache (context, embedding, result) entries"""
+        if self.max_entries <= 0 or not entries:
+            return
+        import faiss
+
+        vectors = l2_normalized(np.vstack([embedding for _, embedding, _ in entries]))
+        with self._lock:
+            if self._index is None:
+                self._index = faiss.IndexIDMap2(faiss.IndexFlatIP(vectors.shape[1]))
+            entry_ids = np.arange(self._next_id, self._next_id + len(entries), dtype=np.int64)
+            self._next_id += len(entries)
+            expiry = time.monotonic() + self.ttl
+            for entry_id, (context, _, result) in zip(entry_ids, entries):
+                self._entries[int(entry_id)] = (context, result, expiry)
+            self._index.add_with_ids(vectors, entry_ids)
+            evicted = []
+            while len(self._entries) > self.max_entries:
+                evicted.append(self._entries.popitem(last=False)[0])
+            if evicted:
+                self._index.remove_ids(np.array(evicted, dtype=np.int64))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            if self._index is not None:
+                self._index.reset()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "size": len(self._entries),
+                "max_entries": self.max_entries,
+                "threshold": self.threshold,
+                "ttl_seconds": self.ttl,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+            }
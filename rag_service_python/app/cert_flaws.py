@@ -0,0 +1,99 @@
+"""
+================================================================================
+Certificate flaw detection for certificate-aware retrieval
+
+The same rules cert_data/scripts/label_certs.py labels the training data
+with (FLAW_RULES there; cert_data/tests/test_flaw_rules.py checks that the
+two copies agree), so a pasted PEM gets the flaw names the rest of the
+pipeline uses:
+
+    expired, short_key, sha1_signature, missing_SAN, low_entropy_serial
+
+Every flaw has a retrieval question (FLAW_QUESTIONS) phrased the way the RFC
+and Baseline Requirements passages that govern it are, which
+POST /query/certificate asks the knowledge base in one batch.
+================================================================================
+"""
+
+import datetime
+
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.x509.oid import ExtensionOID
+
+
+def has_low_entropy_serial(cert):
+    serial = cert.serial_number
+    if serial.bit_length() < 20:
+        return True
+
+    hex_serial = format(serial, 'x')
+    if len(hex_serial) >= 4:
+        # Repeated digits, sequential runs (1234, abcd) or very few distinct digits
+        if any(digit * 3 in hex_serial for digit in '0123456789abcdef'):
+            return True
+        for i in range(len(hex_serial) - 3):
+            if all(int(hex_serial[i + j], 16) == int(hex_serial[i], 16) + j for j in range(1, 4)):
+                return True
+        if len(set(hex_serial)) <= 3:
+            return True
+
+    return serial < 10000
+
+
+def is_expired(cert):
+    not_after = getattr(cert, "not_valid_after_utc", None)
+    if not_after is None:
+        return cert.not_valid_after < datetime.datetime.utcnow()
+    return not_after < datetime.datetime.now(datetime.timezone.utc)
+
+
+def has_short_key(cert):
+    pub_key = cert.public_key()
+    return isinstance(pub_key, rsa.RSAPublicKey) and pub_key.key_size < 2048
+
+
+def has_sha1_signature(cert):
+    # None for signature algorithms without a separate hash, such as Ed25519
+    algorithm = cert.signature_hash_algorithm
+    return algorithm is not None and "sha1" in algorithm.name.lower()
+
+
+def is_missing_san(cert):
+    try:
+        ext = cert.extensions.get_extension_for_oid(ExtensionOID.SUBJECT_ALTERNATIVE_NAME)
+        return not ext.value.get_values_for_type(x509.DNSName)
+    except x509.ExtensionNotFound:
+        return True
+
+
+# Flaw label -> rule, in the order labels are reported
+FLAW_RULES = [
+    ("expired", is_expired),
+    ("short_key", has_short_key),
+    ("sha1_signature", has_sha1_signature),
+    ("missing_SAN", is_missing_san),
+    ("low_entropy_serial", has_low_entropy_serial),
+]
+
+# Flaw label -> the question its supporting passages answer
+FLAW_QUESTIONS = {
+    "expired": "certificate validity period notBefore notAfter; "
+               "a certificate used after its notAfter date has expired",
+    "short_key": "minimum RSA key size for subscriber certificates; RSA modulus of at least 2048 bits",
+    "sha1_signature": "SHA-1 signature algorithm deprecated; certificates must not be signed with SHA-1",
+    "missing_SAN": "subjectAltName extension required; subject alternative name dNSName entries "
+                   "for TLS server certificates",
+    "low_entropy_serial": "certificate serial number must be a positive integer with at least "
+                          "64 bits of entropy from a CSPRNG",
+}
+
+
+def load_certificate(pem):
+    """Parse a PEM certificate; ValueError if it isn't one"""
+    data = pem.encode() if isinstance(pem, str) else pem
+    return x509.load_pem_x509_certificate(data)
+
+
+def get_flaws(cert):
+    return [flaw for flaw, rule in FLAW_RULES if rule(cert)]
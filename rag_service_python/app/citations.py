@@ -0,0 +1,103 @@
+"""
+================================================================================
+Precomputed citations: top-k passages for fixed questions, per index build
+
+The questions behind every certificate flaw (cert_flaws.FLAW_QUESTIONS) and
+a list of canonical questions (scripts/golden_queries.txt by default) are
+asked over and over, and their answers only change when the index does. So
+build_faiss.py searches them once, right after building the index, and
+stores the top-k ids and scores next to it:
+
+    citations.json            k, search params, questions, their ids and scores
+    citation_embeddings.npy   the question embeddings, so compaction
+                              (knowledge_base.compact) can re-search them
+
+The service answers a dense query for one of these questions, with the
+build's search params, no source filter and no live edits since the build,
+straight from this table: a dict lookup, no encode and no search. Anything
+else goes through the normal path.
+================================================================================
+"""
+
+import json
+import os
+
+import numpy as np
+
+from app.cache import normalize_question
+
+CITATIONS_NAME = "citations.json"
+EMBEDDINGS_NAME = "citation_embeddings.npy"
+
+
+class CitationTable:
+    def __init__(self, k, params, questions, ids, scores, embeddings):
+        self.k = k
+        self.params = params          # search params as a sorted tuple, as in query keys
+        self.questions = questions    # normalized
+        self.ids = ids                # top-k ids per question
+        self.scores = scores          # their scores, or None for tables built without them
+        self.embeddings = embeddings
+        self._by_question = dict(zip(questions, zip(ids, scores))) if scores is not None else {}
+
+    @classmethod
+    def build(cls, questions, embeddings, search, k, params):
+        """
+        search(embeddings, k) -> (scores, ids) over the new index, larger
+        scores nearer (indexes.similarities), with params (a dict) the search
+        params it uses
+        """
+        scores, ids = search(embeddings, k)
+        found = [row >= 0 for row in ids]
+        return cls(k, tuple(sorted(params.items())), questions,
+                   [tuple(int(idx) for idx in row[keep]) for row, keep in zip(ids, found)],
+                   [tuple(float(score) for score in row[keep]) for row, keep in zip(scores, found)],
+                   embeddings)
+
+    @staticmethod
+    def questions_for(questions):
+        """Normalized, de-duplicated questions, in order"""
+        return list(dict.fromkeys(normalize_question(question) for question in questions if question.strip()))
+
+    def rebuild(self, search):
+        """The same questions searched again, in an index rebuilt from the same vectors"""
+        return CitationTable.build(self.questions, self.embeddings, search, self.k, dict(self.params))
+
+    def lookup(self, question, k, params):
+        """(top-k ids, scores) of a normalized question, or None if the table can't answer it"""
+        if k > self.k or params != self.params:
+            return None
+        hits = self._by_question.get(question)
+        return (hits[0][:k], hits[1][:k]) if hits is not None else None
+
+    def __len__(self):
+        return len(self.questions)
+
+    def save(self, index_dir):
+        np.save(os.path.join(index_dir, EMBEDDINGS_NAME), self.embeddings)
+        with open(os.path.join(index_dir, CITATIONS_NAME), "w") as f:
+            json.dump({
+                "k": self.k,
+                "search_params": dict(self.params),
+                "questions": [{"question": question, "ids": list(ids), "scores": list(scores)}
+                              for question, ids, scores in zip(self.questions, self.ids, self.scores)],
+            }, f, indent=2)
+
+    @classmethod
+    def load(cls, index_dir):
+        """The table in index_dir, or None if it has none"""
+        path = os.path.join(index_dir, CITATIONS_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            table = json.load(f)
+        entries = table["questions"]
+        # Tables from before scores were stored answer nothing until the next build or compaction
+        scores = None
+        if all("scores" in entry for entry in entries):
+            scores = [tuple(entry["scores"]) for entry in entries]
+        return cls(table["k"], tuple(sorted(table["search_params"].items())),
+                   [entry["question"] for entry in entries],
+                   [tuple(entry["ids"]) for entry in entries],
+                   scores,
+                   np.load(os.path.join(index_dir, EMBEDDINGS_NAME)))
@@ -0,0 +1,193 @@
+"""
+================================================================================
+Embedding backends
+
+The service and build_faiss.py embed text through load_embedder(), which
+returns either:
+
+- torch: the SentenceTransformer model itself (eager PyTorch), or
+- onnx:  an OnnxEmbedder running the same model exported to ONNX and
+         dynamically quantized to int8, under ONNX Runtime's CPU provider.
+
+Both expose encode(sentences, batch_size=..., convert_to_numpy=True) with the
+SentenceTransformer semantics, so callers don't care which one they have.
+
+Export the model once (needs torch, onnx and onnxruntime):
+
+    python -m app.embedding export --out ../onnx_model
+
+then set RAG_EMBEDDING_BACKEND=onnx. scripts/check_embedding_backend.py
+compares the ONNX vectors and retrieval results against PyTorch's.
+================================================================================
+"""
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+CONFIG_NAME = "embedding_config.json"
+FP32_NAME = "model.onnx"
+INT8_NAME = "model_int8.onnx"
+
+BACKENDS = ("torch", "onnx")
+
+
+def export_onnx(model_name, out_dir, quantize=True):
+    """
+    Export a SentenceTransformer (transformer + pooling + normalize) to one
+    ONNX graph returning sentence embeddings, and an int8 copy of it with
+    dynamically quantized weights
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    st_model = SentenceTransformer(model_name, device="cpu")
+    transformer = st_model[0]
+    normalize = any(type(module).__name__ == "Normalize" for module in st_model)
+    pooling_config = st_model[1].get_config_dict()
+    # Older sentence-transformers releases use one flag per pooling mode
+    pooling_mode = pooling_config.get("pooling_mode")
+    if pooling_mode is None:
+        if pooling_config.get("pooling_mode_mean_tokens"):
+            pooling_mode = "mean"
+        elif pooling_config.get("pooling_mode_cls_token"):
+            pooling_mode = "cls"
+    if pooling_mode not in ("mean", "cls"):
+        raise ValueError(f"Only mean and CLS pooling can be exported, not {pooling_mode}")
+
+    class SentenceEmbedding(torch.nn.Module):
+        def __init__(self, auto_model):
+            super().__init__()
+            self.auto_model = auto_model
+
+        def forward(self, input_ids, attention_mask, token_type_ids):
+            hidden = self.auto_model(input_ids=input_ids, attention_mask=attention_mask,
+                                     token_type_ids=token_type_ids).last_hidden_state
+            if pooling_mode == "cls":
+                embedding = hidden[:, 0]
+            else:
+                mask = attention_mask.unsqueeze(-1).to(hidden.dtype)
+                embedding = (hidden * mask).sum(1) / mask.sum(1).clamp(min=1e-9)
+            if normalize:
+                embedding = torch.nn.functional.normalize(embedding, p=2, dim=1)
+            return embedding
+
+    os.makedirs(out_dir, exist_ok=True)
+    fp32_path = os.path.join(out_dir, FP32_NAME)
+    sample = transformer.tokenizer(["an example sentence", "another one"], padding=True,
+                                   return_tensors="pt")
+    inputs = ("input_ids", "attention_mask", "token_type_ids")
+    print(f"✅ Exporting {model_name} to {fp32_path}...")
+    with torch.no_grad():
+        torch.onnx.export(
+            SentenceEmbedding(transformer.auto_model).eval(),
+            tuple(sample[name] for name in inputs),
+            fp32_path,
+            input_names=list(inputs),
+            output_names=["sentence_embedding"],
+            dynamic_axes={**{name: {0: "batch", 1: "sequence"} for name in inputs},
+                          "sentence_embedding": {0: "batch"}},
+            opset_version=17,
+            dynamo=False,
+        )
+    transformer.tokenizer.save_pretrained(out_dir)
+
+    if quantize:
+        from onnxruntime.quantization import QuantType, quantize_dynamic
+
+        int8_path = os.path.join(out_dir, INT8_NAME)
+        print(f"✅ Quantizing weights to int8 in {int8_path}...")
+        quantize_dynamic(fp32_path, int8_path, weight_type=QuantType.QInt8)
+
+    with open(os.path.join(out_dir, CONFIG_NAME), "w") as f:
+        json.dump({
+            "model": model_name,
+            "max_seq_length": transformer.max_seq_length,
+            "pooling": pooling_mode,
+            "normalize": normalize,
+        }, f, indent=2)
+    print(f"🎉 Exported {model_name} to {out_dir}")
+
+
+class OnnxEmbedder:
+    """SentenceTransformer-compatible encode() on top of an ONNX Runtime session"""
+
+    def __init__(self, model_dir, quantized=True, threads=None):
+        """
+        threads: intra-op threads; defaults to RAG_EMBEDDING_THREADS, or to
+            ONNX Runtime's choice (one per physical core) if that is unset
+        """
+        from transformers import AutoTokenizer
+
+        with open(os.path.join(model_dir, CONFIG_NAME)) as f:
+            self.config = json.load(f)
+        self.path = os.path.join(model_dir, INT8_NAME if quantized else FP32_NAME)
+        if not os.path.exists(self.path):
+            raise FileNotFoundError(f"{self.path} not found; run python -m app.embedding export")
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.max_seq_length = self.config["max_seq_length"]
+        self.threads = threads
+        self._session = None
+        self._session_pid = None
+
+    def _get_session(self):
+        # ONNX Runtime's thread pool doesn't survive a fork, so each process
+        # (e.g. every gunicorn worker) creates its own session on first use
+        if self._session is None or self._session_pid != os.getpid():
+            import onnxruntime as ort
+
+            options = ort.SessionOptions()
+            options.intra_op_num_threads = self.threads or int(os.environ.get("RAG_EMBEDDING_THREADS", "0"))
+            options.inter_op_num_threads = 1
+            options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+            options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+            self._session = ort.InferenceSession(self.path, options, providers=["CPUExecutionProvider"])
+            self._input_names = [node.name for node in self._session.get_inputs()]
+            self._session_pid = os.getpid()
+        return self._session
+
+    def encode(self, sentences, batch_size=32, convert_to_numpy=True, show_progress_bar=False, **kwargs):
+        session = self._get_session()
+        single = isinstance(sentences, str)
+        if single:
+            sentences = [sentences]
+
+        # Batch similar lengths together to keep padding down
+        order = np.argsort([-len(sentence) for sentence in sentences], kind="stable")
+        embeddings = [None] * len(sentences)
+        for start in range(0, len(sentences), batch_size):
+            rows = order[start:start + batch_size]
+            tokens = self.tokenizer([sentences[row] for row in rows], padding=True, truncation=True,
+                                    max_length=self.max_seq_length, return_tensors="np")
+            feed = {name: tokens[name].astype(np.int64) for name in self._input_names}
+            batch = session.run(["sentence_embedding"], feed)[0]
+            for row, embedding in zip(rows, batch):
+                embeddings[row] = embedding
+
+        result = np.vstack(embeddings).astype("float32") if embeddings else np.zeros((0, 0), "float32")
+        return result[0] if single else result
+
+
+def load_embedder(backend, model_name, onnx_dir=None):
+    if backend == "torch":
+        from sentence_transformers import SentenceTransformer
+
+        return SentenceTransformer(model_name)
+    if backend == "onnx":
+        quantized = os.environ.get("RAG_ONNX_QUANTIZED", "1") != "0"
+        return OnnxEmbedder(onnx_dir, quantized=quantized)
+    raise ValueError(f"Unknown embedding backend: {backend} (expected one of {BACKENDS})")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Export the embedding model to ONNX')
+    subcommands = parser.add_subparsers(dest="command", required=True)
+    export = subcommands.add_parser("export")
+    export.add_argument('--model', default='all-MiniLM-L6-v2')
+    export.add_argument('--out', default=os.path.join(os.path.dirname(__file__), "../../onnx_model"))
+    export.add_argument('--no-quantize', action='store_true', help='Only write the fp32 model')
+    args = parser.parse_args()
+
+    export_onnx(args.model, os.path.abspath(args.out), quantize=not args.no_quantize)
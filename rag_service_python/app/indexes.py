@@ -0,0 +1,248 @@
+"""
+================================================================================
+FAISS index types and the index manifest
+
+build_faiss.py can build an exact flat index or one of three approximate
+nearest-neighbor indexes for corpora too big to scan on every query:
+
+- ivf_flat: inverted lists over nlist k-means cells, nprobe cells scanned
+- ivf_pq:   the same, with vectors product-quantized to pq_m x pq_nbits bits
+- hnsw:     HNSW graph with hnsw_m links per node, efSearch candidates
+
+Any of them can compare vectors by L2 distance (the default) or by cosine
+similarity: embeddings are L2-normalized at build and query time and
+searched with inner product. And any but ivf_pq (already compressed) can
+store its vectors as float32, float16 (half the memory) or 8-bit scalar
+quantized (a quarter), at some recall cost the build's --recall-report
+measures against exact float32 search.
+
+The index type, metric, storage and build/search parameters are written
+next to the index as manifest.json, which main.py reads to know how to
+search it. An index without a manifest is the original flat L2 index.
+
+read_index memory-maps the index file instead of copying it into RAM, so
+startup stays fast as the corpus grows and workers share the page cache.
+
+Indexes built by build_faiss.py use positions as ids; versions compacted
+from live edits (see live.py) are wrapped in an IndexIDMap2 so paragraph ids
+survive deletions. Everything here accepts either.
+
+faiss is imported inside the functions that need it, so importing this
+module (and app.main) stays cheap until the index is actually loaded.
+================================================================================
+"""
+
+import json
+import os
+
+MANIFEST_NAME = "manifest.json"
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+METRICS = ("l2", "cosine")
+STORAGE_TYPES = ("float32", "fp16", "sq8")
+
+# Build-time parameters, with their defaults, per index type
+BUILD_PARAMS = {
+    "flat": {},
+    "ivf_flat": {"nlist": 1024},
+    "ivf_pq": {"nlist": 1024, "pq_m": 48, "pq_nbits": 8},
+    "hnsw": {"hnsw_m": 32, "ef_construction": 200},
+}
+
+# Search-time knobs, with their defaults; these can be overridden per request
+SEARCH_PARAMS = {
+    "flat": {},
+    "ivf_flat": {"nprobe": 16},
+    "ivf_pq": {"nprobe": 16},
+    "hnsw": {"ef_search": 64},
+}
+
+
+def build_params(index_type, overrides=None):
+    """Defaults for index_type updated with the non-None values in overrides"""
+    params = dict(BUILD_PARAMS[index_type])
+    for name, value in (overrides or {}).items():
+        if name in params and value is not None:
+            params[name] = value
+    return params
+
+
+def search_params(index_type, overrides=None):
+    params = dict(SEARCH_PARAMS[index_type])
+    for name, value in (overrides or {}).items():
+        if name in params and value is not None:
+            params[name] = value
+    return params
+
+
+def needs_training(index_type, storage="float32"):
+    return index_type in ("ivf_flat", "ivf_pq") or storage == "sq8"
+
+
+def l2_normalized(vectors):
+    """Float32 copy of vectors scaled to unit length, as cosine indexes store and search them"""
+    import numpy as np
+
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def similarities(distances, metric):
+    """faiss distances as scores that are larger the nearer: L2 distances negated, cosine similarities as is"""
+    return distances if metric == "cosine" else -distances
+
+
+def create_index(index_type, dim, params, train_vectors=None, metric="l2", storage="float32"):
+    """
+    An empty index of index_type, trained on train_vectors if it needs
+    training (see needs_training). nlist is capped so every cell gets some
+    training points. Cosine indexes expect normalized vectors.
+    """
+    import faiss
+
+    if metric not in METRICS:
+        raise ValueError(f"Unknown metric: {metric}")
+    if storage not in STORAGE_TYPES:
+        raise ValueError(f"Unknown storage: {storage}")
+    if index_type == "ivf_pq" and storage != "float32":
+        raise ValueError("ivf_pq already product-quantizes its vectors; use the default float32 storage")
+    faiss_metric = faiss.METRIC_INNER_PRODUCT if metric == "cosine" else faiss.METRIC_L2
+    quantizer_type = {"fp16": faiss.ScalarQuantizer.QT_fp16, "sq8": faiss.ScalarQuantizer.QT_8bit}.get(storage)
+
+    if index_type == "flat":
+        if quantizer_type is not None:
+            index = faiss.IndexScalarQuantizer(dim, quantizer_type, faiss_metric)
+        elif metric == "cosine":
+            index = faiss.IndexFlatIP(dim)
+        else:
+            index = faiss.IndexFlatL2(dim)
+    elif index_type == "hnsw":
+        if quantizer_type is not None:
+            index = faiss.IndexHNSWSQ(dim, quantizer_type, params["hnsw_m"], faiss_metric)
+        else:
+            index = faiss.IndexHNSWFlat(dim, params["hnsw_m"], faiss_metric)
+        index.hnsw.efConstruction = params["ef_construction"]
+    else:
+        # faiss wants ~39 training points per centroid
+        nlist = max(1, min(params["nlist"], len(train_vectors) // 39))
+        params["nlist"] = nlist
+        quantizer = faiss.IndexFlatIP(dim) if metric == "cosine" else faiss.IndexFlatL2(dim)
+        if index_type == "ivf_flat" and quantizer_type is not None:
+            index = faiss.IndexIVFScalarQuantizer(quantizer, dim, nlist, quantizer_type, faiss_metric)
+        elif index_type == "ivf_flat":
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss_metric)
+        elif index_type == "ivf_pq":
+            if dim % params["pq_m"]:
+                raise ValueError(f"pq_m={params['pq_m']} must divide the embedding dimension {dim}")
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, params["pq_m"], params["pq_nbits"], faiss_metric)
+        else:
+            raise ValueError(f"Unknown index type: {index_type}")
+
+    if needs_training(index_type, storage):
+        index.train(train_vectors)
+    return index
+
+
+def unwrap(index):
+    """The index inside an IndexIDMap / IndexIDMap2, or index itself"""
+    import faiss
+
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return index
+
+
+def index_vectors(index):
+    """
+    (ids, vectors) of everything stored in an index. Ids are positions
+    unless the index is ID-mapped; PQ vectors come back decoded, so only
+    approximately.
+    """
+    import faiss
+    import numpy as np
+
+    inner = unwrap(index)
+    if inner is index:
+        ids = np.arange(index.ntotal, dtype=np.int64)
+    else:
+        ids = faiss.vector_to_array(index.id_map)
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        ivf.make_direct_map()
+    return ids, inner.reconstruct_n(0, inner.ntotal)
+
+
+def apply_search_params(index, index_type, params):
+    """Set search_params as the index's defaults"""
+    import faiss
+
+    if index_type in ("ivf_flat", "ivf_pq"):
+        faiss.extract_index_ivf(index).nprobe = params["nprobe"]
+    elif index_type == "hnsw":
+        unwrap(index).hnsw.efSearch = params["ef_search"]
+
+
+def faiss_search_parameters(index_type, params, selector=None):
+    """
+    SearchParameters object for one index.search call, or None for an
+    unfiltered flat search. selector (a faiss.IDSelector) restricts the
+    search to the ids it accepts.
+    """
+    import faiss
+
+    if index_type in ("ivf_flat", "ivf_pq"):
+        return faiss.SearchParametersIVF(nprobe=params["nprobe"], sel=selector)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=params["ef_search"], sel=selector)
+    if selector is not None:
+        return faiss.SearchParameters(sel=selector)
+    return None
+
+
+def read_index(path, index_type, mmap=True):
+    """
+    Load an index, memory-mapped when the type and faiss build allow it:
+    IVF inverted lists map with IO_FLAG_MMAP, flat vectors (flat and HNSW
+    storage) with IO_FLAG_MMAP_IFC. A mapped index is read-only.
+    """
+    import faiss
+
+    if mmap:
+        if index_type in ("ivf_flat", "ivf_pq"):
+            flag = faiss.IO_FLAG_MMAP
+        else:
+            flag = getattr(faiss, "IO_FLAG_MMAP_IFC", None)
+        if flag is not None:
+            try:
+                return faiss.read_index(path, flag | faiss.IO_FLAG_READ_ONLY)
+            except RuntimeError as e:
+                print(f"⚠️ Could not memory-map {path} ({e}); loading it into memory")
+    return faiss.read_index(path)
+
+
+def write_manifest(index_dir, manifest):
+    with open(os.path.join(index_dir, MANIFEST_NAME), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+
+def load_manifest(index_dir):
+    path = os.path.join(index_dir, MANIFEST_NAME)
+    if not os.path.exists(path):
+        return {
+            "index_type": "flat",
+            "metric": "l2",
+            "storage": "float32",
+            "build_params": {},
+            "search_params": {},
+        }
+    with open(path) as f:
+        manifest = json.load(f)
+    index_type = manifest["index_type"]
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type in {path}: {index_type}")
+    # Built before these options existed
+    manifest.setdefault("metric", "l2")
+    manifest.setdefault("storage", "float32")
+    manifest["search_params"] = search_params(index_type, manifest.get("search_params"))
+    return manifest
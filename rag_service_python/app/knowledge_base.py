@@ -0,0 +1,295 @@
+"""
+================================================================================
+Versioned knowledge-base directories and the loaded bundle of one version
+
+build_faiss.py publishes every build into its own directory under the index
+root, and only then points the root's CURRENT file at it (written to a
+temporary file and renamed, so readers see the old name or the new one):
+
+    knowledge_base/faiss_index/
+        CURRENT                  "20250301-120000"
+        20250301-120000/         faiss_index.index, manifest.json,
+        20250214-093000/         metadata.sqlite, lexical/, sources.json, ...
+
+A root with no CURRENT file is itself the index directory, as before. A
+sharded version has shards/ (see shards.py) instead of faiss_index.index.
+
+A KnowledgeBase is everything loaded from one version directory: the FAISS
+index (or the ShardPool searching its shards), manifest, metadata store,
+BM25 index, source map and precomputed citations. Its index files are never
+modified after loading: live edits (live.py) go to an in-memory delta and
+the metadata store. The service swaps in a new one on reload, and each
+request keeps using the one it started with, so an index and the metadata
+of another version are never mixed. An old version is freed (and its files
+unmapped) when the last request using it finishes.
+
+compact() publishes a version with its live edits folded in: the remaining
+base vectors plus the added ones, rebuilt with the same index type and
+parameters (and number of shards) into an IndexIDMap2 so paragraph ids are
+kept, with the citation table searched again against it. IVF-PQ and sq8
+vectors are re-encoded from their decoded approximations, so rebuild those
+from the web once in a while.
+================================================================================
+"""
+
+import os
+import shutil
+import time
+
+import numpy as np
+
+from app.citations import CitationTable
+from app.indexes import (apply_search_params, build_params, create_index, faiss_search_parameters,
+                         index_vectors, l2_normalized, load_manifest, needs_training, read_index, similarities,
+                         unwrap, write_manifest)
+from app.lexical import LexicalIndex
+from app.live import LiveEdits
+from app.metastore import MetadataStore, open_store, write_store
+from app.shards import SHARDS_DIR, ShardPool, build_shards, combine_shards, read_shards, write_shards
+from app.sources import SourceMap
+
+CURRENT_NAME = "CURRENT"
+INDEX_NAME = "faiss_index.index"
+TRAIN_SIZE = 100000
+
+
+def current_index_dir(root):
+    """Directory of the published version under root, or root itself if unversioned"""
+    current_path = os.path.join(root, CURRENT_NAME)
+    if not os.path.exists(current_path):
+        return root
+    with open(current_path) as f:
+        return os.path.join(root, f.read().strip())
+
+
+def new_version_dir(root):
+    """A fresh, empty version directory under root"""
+    version = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    path = os.path.join(root, version)
+    suffix = 0
+    while os.path.exists(path):  # a compaction in the same second as a build
+        suffix += 1
+        path = os.path.join(root, f"{version}-{suffix}")
+    os.makedirs(path)
+    return path
+
+
+def has_index(index_dir):
+    return (os.path.isfile(os.path.join(index_dir, INDEX_NAME))
+            or os.path.isdir(os.path.join(index_dir, SHARDS_DIR)))
+
+
+def has_live_edits(index_dir):
+    """Whether the index in index_dir has edits made through the service, pending or compacted in"""
+    if not has_index(index_dir):
+        return False
+    if "compacted_from" in load_manifest(index_dir):
+        return True
+    # Only a SQLite store has an edits log; metadata.json (or no metadata at all) means none
+    sqlite_path = os.path.join(index_dir, "metadata.sqlite")
+    return os.path.exists(sqlite_path) and bool(MetadataStore(sqlite_path).edits_since(0))
+
+
+def publish(root, version_dir):
+    """Atomically make version_dir the current version under root"""
+    tmp_path = os.path.join(root, CURRENT_NAME + ".tmp")
+    with open(tmp_path, "w") as f:
+        f.write(os.path.basename(version_dir) + "\n")
+    os.replace(tmp_path, os.path.join(root, CURRENT_NAME))
+
+
+def prune_versions(root, keep):
+    """Delete all but the newest keep version directories (never the current one)"""
+    current = os.path.basename(current_index_dir(root))
+    versions = sorted(name for name in os.listdir(root) if has_index(os.path.join(root, name)))
+    removed = []
+    for name in versions[:max(len(versions) - keep, 0)]:
+        if name != current:
+            # Services still serving it keep their open and mapped files until they reload
+            shutil.rmtree(os.path.join(root, name))
+            removed.append(name)
+    return removed
+
+
+class KnowledgeBase:
+    def __init__(self, index_dir, mmap=True):
+        self.dir = index_dir
+        self.version = os.path.basename(os.path.normpath(index_dir))
+        self.manifest = load_manifest(index_dir)
+        index_type = self.manifest["index_type"]
+        if self.sharded:
+            print(f"✅ Using FAISS index ({index_type}, {self.manifest['metric']}, {self.manifest['storage']}) "
+                  f"in {self.manifest['shards']} shards from {os.path.join(index_dir, SHARDS_DIR)}...")
+            # Shard processes start on the first search, in the process that makes it
+            self.index = ShardPool(index_dir, self.manifest["shards"], index_type, self.metric,
+                                   self.manifest["search_params"], self.manifest["ntotal"], self.manifest["dim"],
+                                   mmap=mmap)
+        else:
+            print(f"✅ Loading FAISS index ({index_type}, {self.manifest['metric']}, {self.manifest['storage']}) from {os.path.join(index_dir, INDEX_NAME)}...")
+            self.index = read_index(os.path.join(index_dir, INDEX_NAME), index_type, mmap=mmap)
+            apply_search_params(self.index, index_type, self.manifest["search_params"])
+
+        self.metadata = open_store(index_dir)
+        print(f"✅ Opened metadata from {self.metadata.path}...")
+
+        self.lexical_index = LexicalIndex.load(index_dir)
+        if self.lexical_index is None:
+            print("⚠️ No lexical index found; every query goes through the embedding model")
+        else:
+            print(f"✅ Loaded BM25 index ({len(self.lexical_index.vocab)} terms)...")
+
+        self.source_map = SourceMap.load(index_dir)
+        if self.source_map is None:
+            print("⚠️ No source ids found; queries can't be filtered by source")
+        else:
+            print(f"✅ Loaded source ids ({', '.join(self.source_map.names)})...")
+
+        self.citations = CitationTable.load(index_dir)
+        if self.citations is None:
+            print("⚠️ No precomputed citations found; flaw and canonical questions are searched live")
+        else:
+            print(f"✅ Loaded precomputed citations for {len(self.citations)} questions...")
+
+        if self.sharded:
+            num_base_ids = self.manifest["max_id"] + 1
+        elif unwrap(self.index) is self.index:
+            num_base_ids = self.index.ntotal
+        else:
+            import faiss
+
+            num_base_ids = int(faiss.vector_to_array(self.index.id_map).max(initial=-1)) + 1
+        self.live = LiveEdits(self.index.d, num_base_ids, self.metric)
+        applied = self.live.sync(self.metadata)
+        if applied:
+            print(f"✅ Replayed {applied} live edits...")
+
+    @property
+    def index_type(self):
+        return self.manifest["index_type"]
+
+    @property
+    def metric(self):
+        return self.manifest["metric"]
+
+    @property
+    def sharded(self):
+        return bool(self.manifest.get("shards"))
+
+    def base_vectors(self):
+        """(ids, vectors) stored in the base index, every shard's included"""
+        if not self.sharded:
+            return index_vectors(self.index)
+        parts = [index_vectors(shard) for shard in
+                 read_shards(self.dir, self.manifest["shards"], self.index_type)]
+        return np.concatenate([ids for ids, _ in parts]), np.vstack([vectors for _, vectors in parts])
+
+    def source_names(self):
+        names = set(self.source_map.names) if self.source_map else set()
+        return names | self.live.source_names()
+
+    def allowed_ids(self, sources):
+        """Boolean mask over base ids for lexical search, or None if every id is allowed"""
+        return self.live.allowed(self.source_map, sources)
+
+    def search(self, embeddings, k, params, sources=None, timings=None):
+        """
+        (distances, ids) of the k nearest paragraphs, live edits included,
+        searching with params and only from sources if given. Smaller
+        distances are nearer; a cosine index's similarities come negated.
+        A sharded index adds each shard's time to timings, if given.
+        """
+        if self.metric == "cosine":
+            embeddings = l2_normalized(embeddings)
+        # The selector points into the bitmap, so both are held until the search is done
+        selector, bitmap = self.live.base_selector(self.source_map, sources)
+        if self.sharded:
+            distances, ids = self.index.search(embeddings, k, params, bitmap, timings)
+        else:
+            distances, ids = self.index.search(
+                embeddings, k, params=faiss_search_parameters(self.index_type, params, selector))
+        if self.metric == "cosine":
+            distances = -distances
+        return self.live.merge(embeddings, k, sources, distances, ids)
+
+
+def compact(knowledge_base, root, keep_versions):
+    """
+    Publish knowledge_base with its live edits folded in as a new version
+    under root, sealing its metadata store; edits logged meanwhile are
+    carried over to the new store. Returns the new version directory.
+    """
+    import faiss
+
+    seq, deleted, delta_ids, delta_vectors = knowledge_base.live.snapshot()
+    base_ids, base_vectors = knowledge_base.base_vectors()
+    keep = ~deleted[base_ids]
+    ids = np.concatenate([base_ids[keep], delta_ids])
+    vectors = np.ascontiguousarray(np.vstack([base_vectors[keep], delta_vectors]), dtype=np.float32)
+    if not len(ids):
+        raise ValueError("Nothing left to index")
+
+    manifest = dict(knowledge_base.manifest)
+    index_type = manifest["index_type"]
+    params = build_params(index_type, manifest.get("build_params"))
+    train_vectors = None
+    if needs_training(index_type, manifest["storage"]):
+        rng = np.random.default_rng(0)
+        sample = rng.choice(len(vectors), min(TRAIN_SIZE, len(vectors)), replace=False)
+        train_vectors = vectors[np.sort(sample)]
+    if knowledge_base.sharded:
+        shards = build_shards(index_type, params, vectors, ids, manifest["shards"], train_vectors,
+                              manifest["metric"], manifest["storage"])
+        index = combine_shards(shards)
+    else:
+        index = faiss.IndexIDMap2(create_index(
+            index_type, vectors.shape[1], params, train_vectors, manifest["metric"], manifest["storage"]))
+        index.add_with_ids(vectors, ids)
+
+    # The paragraphs as of now may be ahead of seq; replaying the edits
+    # carried over on load brings the vectors level with them again
+    records = list(knowledge_base.metadata.items())
+    output_dir = new_version_dir(root)
+    published = False
+    try:
+        if knowledge_base.sharded:
+            manifest["index_bytes"] = write_shards(shards, output_dir)
+            manifest["max_id"] = int(ids.max())
+        else:
+            faiss.write_index(index, os.path.join(output_dir, INDEX_NAME))
+            manifest["index_bytes"] = os.path.getsize(os.path.join(output_dir, INDEX_NAME))
+        sqlite_path = os.path.join(output_dir, "metadata.sqlite")
+        write_store(sqlite_path, records)
+        LexicalIndex.build(records).save(output_dir)
+        SourceMap.build(records).save(output_dir)
+        manifest.update({
+            "dim": int(vectors.shape[1]),
+            "ntotal": int(index.ntotal),
+            "build_params": params,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+            "compacted_from": knowledge_base.version,
+        })
+        manifest.pop("recall_report", None)
+        if knowledge_base.citations is not None:
+            search_parameters = faiss_search_parameters(index_type, manifest["search_params"])
+
+            def search(vectors, k):
+                distances, ids = index.search(vectors, k, params=search_parameters)
+                return similarities(distances, knowledge_base.metric), ids
+
+            knowledge_base.citations.rebuild(search).save(output_dir)
+        write_manifest(output_dir, manifest)
+
+        def hand_over(edits):
+            nonlocal published
+            if edits:
+                MetadataStore(sqlite_path).replay(edits)
+            publish(root, output_dir)
+            published = True
+
+        knowledge_base.metadata.seal(os.path.basename(output_dir), seq, hand_over)
+    except BaseException:
+        if not published:
+            shutil.rmtree(output_dir, ignore_errors=True)
+        raise
+    prune_versions(root, keep_versions)
+    return output_dir
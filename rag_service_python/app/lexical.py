@@ -0,0 +1,201 @@
+"""
+================================================================================
+BM25 lexical index over the knowledge-base paragraphs
+
+Dense embeddings are poor at exact lookups such as "RFC 5280 4.2.1.6",
+"2.5.29.17" or "basicConstraints", and still cost a full encode. This is an
+inverted index built by build_faiss.py next to the FAISS files (lexical/),
+that main.py uses:
+
+- auto mode: questions that look like a section reference, an OID or bare
+  identifiers (is_lexical_query) are answered from here without embedding
+- lexical mode: always answered from here
+- hybrid mode: BM25 and vector scores are normalized and fused (fuse)
+
+Tokens keep dotted and hyphenated runs whole (4.2.1.6, 2.5.29.17, sha-256,
+id-kp-serverauth), plus the parts of hyphenated ones; paragraphs from an RFC
+also get that RFC's number as tokens, so "RFC 5280" matches them.
+
+Postings are stored as CSR arrays (.npy, memory-mapped on load) with the
+vocabulary in vocab.json. Build it for an existing index directory with
+
+    python -m app.lexical ../knowledge_base/faiss_index
+================================================================================
+"""
+
+import json
+import os
+import re
+import sys
+from collections import Counter
+
+import numpy as np
+
+LEXICAL_DIR = "lexical"
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:[.\-][a-z0-9]+)*")
+RFC_SOURCE_RE = re.compile(r"rfc(\d+)")
+
+# Query patterns that are better served by exact term matching
+SECTION_RE = re.compile(r"\brfc\s*\d{3,5}\b|§\s*\d+(?:\.\d+)*|\bsection\s+\d+(?:\.\d+)*", re.IGNORECASE)
+DOTTED_NUMBER_RE = re.compile(r"\b\d+(?:\.\d+){2,}\b")  # OIDs and deep section numbers
+IDENTIFIER_RE = re.compile(r"^(?:id-[a-zA-Z0-9-]+|[a-z]+(?:[A-Z][a-z0-9]*)+)$")  # id-kp-..., camelCase
+
+K1 = 1.5
+B = 0.75
+
+
+def tokenize(text):
+    tokens = TOKEN_RE.findall(text.lower())
+    for token in list(tokens):
+        if "-" in token:
+            tokens.extend(part for part in token.split("-") if part)
+    return tokens
+
+
+def source_tokens(source):
+    match = RFC_SOURCE_RE.search(source.lower())
+    return ["rfc", match.group(1)] if match else []
+
+
+def is_lexical_query(question):
+    """Section references, OIDs, or a question made only of one to three identifiers"""
+    if SECTION_RE.search(question) or DOTTED_NUMBER_RE.search(question):
+        return True
+    words = question.strip().rstrip("?.").split()
+    return 0 < len(words) <= 3 and all(IDENTIFIER_RE.match(word) for word in words)
+
+
+class LexicalIndex:
+    def __init__(self, vocab, offsets, doc_ids, tfs, doc_lengths):
+        self.vocab = vocab              # term -> row in offsets
+        self.offsets = offsets          # postings of term t are [offsets[t], offsets[t + 1])
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lengths = doc_lengths  # indexed by paragraph id; 0 for ids with no paragraph
+        self.num_docs = int(np.count_nonzero(doc_lengths))
+        self.avg_length = float(doc_lengths.sum()) / max(self.num_docs, 1)
+
+    @classmethod
+    def build(cls, records):
+        """Index (id, {"text", "source"}) records"""
+        postings = {}
+        lengths = {}
+        for idx, record in records:
+            idx = int(idx)
+            tokens = tokenize(record["text"]) + source_tokens(record["source"])
+            lengths[idx] = len(tokens)
+            for term, tf in Counter(tokens).items():
+                postings.setdefault(term, []).append((idx, tf))
+
+        vocab = {}
+        offsets = [0]
+        doc_ids = []
+        tfs = []
+        for row, term in enumerate(sorted(postings)):
+            vocab[term] = row
+            for idx, tf in postings[term]:
+                doc_ids.append(idx)
+                tfs.append(tf)
+            offsets.append(len(doc_ids))
+
+        doc_lengths = np.zeros(max(lengths, default=-1) + 1, dtype=np.int32)
+        for idx, length in lengths.items():
+            doc_lengths[idx] = length
+        return cls(vocab, np.array(offsets, dtype=np.int64), np.array(doc_ids, dtype=np.int32),
+                   np.array(tfs, dtype=np.float32), doc_lengths)
+
+    def save(self, index_dir):
+        path = os.path.join(index_dir, LEXICAL_DIR)
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, "vocab.json"), "w") as f:
+            json.dump(self.vocab, f)
+        for name in ("offsets", "doc_ids", "tfs", "doc_lengths"):
+            np.save(os.path.join(path, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def load(cls, index_dir):
+        """The index in index_dir, or None if it has none"""
+        path = os.path.join(index_dir, LEXICAL_DIR)
+        if not os.path.exists(os.path.join(path, "vocab.json")):
+            return None
+        with open(os.path.join(path, "vocab.json")) as f:
+            vocab = json.load(f)
+        arrays = [np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+                  for name in ("offsets", "doc_ids", "tfs", "doc_lengths")]
+        return cls(vocab, *arrays)
+
+    def scores(self, question, allowed=None):
+        """
+        BM25 score of every paragraph id for question; with allowed, a
+        boolean mask over ids, ids outside it score 0
+        """
+        scores = np.zeros(len(self.doc_lengths), dtype=np.float32)
+        for term in set(tokenize(question)):
+            row = self.vocab.get(term)
+            if row is None:
+                continue
+            start, end = self.offsets[row], self.offsets[row + 1]
+            ids = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            idf = np.log(1 + (self.num_docs - len(ids) + 0.5) / (len(ids) + 0.5))
+            norm = K1 * (1 - B + B * self.doc_lengths[ids] / self.avg_length)
+            scores[ids] += idf * tf * (K1 + 1) / (tf + norm)
+        if allowed is not None:
+            n = min(len(scores), len(allowed))
+            scores[:n] *= allowed[:n]
+            scores[n:] = 0
+        return scores
+
+    def search(self, question, k, allowed=None):
+        """(ids, BM25 scores) of the top-k paragraphs with a non-zero score, best first"""
+        scores = self.scores(question, allowed)
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        matched = matched[np.argsort(-scores[matched], kind="stable")]
+        return matched, scores[matched]
+
+
+def fuse(lexical_scores, dense_ids, dense_distances, k, alpha):
+    """
+    Hybrid ranking of the dense candidates plus the best lexical matches,
+    as (ids, fused scores), best first. Both scores are min-max normalized
+    to [0, 1] (smaller distance is better; KnowledgeBase.search negates
+    cosine similarities); candidates missing from the dense list get a
+    dense score of 0. alpha weights the dense side.
+    """
+    valid = dense_ids >= 0
+    dense_ids, dense_distances = dense_ids[valid], dense_distances[valid]
+    dense_score = {}
+    if len(dense_ids):
+        nearest, farthest = float(dense_distances.min()), float(dense_distances.max())
+        spread = farthest - nearest
+        dense_score = {int(idx): (farthest - float(distance)) / spread if spread else 1.0
+                       for idx, distance in zip(dense_ids, dense_distances)}
+
+    candidates = set(dense_score)
+    top_lexical = np.flatnonzero(lexical_scores)
+    if len(top_lexical) > len(dense_ids):
+        top_lexical = top_lexical[np.argpartition(-lexical_scores[top_lexical], len(dense_ids))[:len(dense_ids)]]
+    candidates.update(int(idx) for idx in top_lexical)
+
+    best_lexical = float(lexical_scores.max()) if len(lexical_scores) else 0.0
+    fused = []
+    for idx in candidates:
+        lexical = float(lexical_scores[idx]) / best_lexical if best_lexical and idx < len(lexical_scores) else 0.0
+        fused.append((alpha * dense_score.get(idx, 0.0) + (1 - alpha) * lexical, idx))
+    fused.sort(reverse=True)
+    return [idx for _, idx in fused[:k]], [score for score, _ in fused[:k]]
+
+
+if __name__ == "__main__":
+    from app.metastore import open_store
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m app.lexical path/to/faiss_index")
+    index_dir = sys.argv[1]
+    lexical_index = LexicalIndex.build(open_store(index_dir).items())
+    lexical_index.save(index_dir)
+    print(f"✅ Wrote BM25 index of {lexical_index.num_docs} paragraphs, "
+          f"{len(lexical_index.vocab)} terms to {os.path.join(index_dir, LEXICAL_DIR)}")
@@ -0,0 +1,152 @@
+"""
+================================================================================
+Live paragraph edits layered over a read-only index version
+
+A published version's FAISS index is memory-mapped and never written to.
+Paragraphs added or replaced through POST /admin/paragraphs go into a small
+in-memory IndexIDMap2 (the delta, exact and float32 whatever the base
+index stores), and ids that were deleted or replaced are
+masked out of the base index with the same IDSelectorBitmap mechanism as
+source filters (sources.py). Every search runs on both and merges the two
+top-k lists by distance, so an edit costs one embedding and a SQLite
+transaction, not a rebuild.
+
+The edits themselves are the metadata store's edits log (metastore.py):
+each worker replays new entries onto its own LiveEdits (sync), so every
+gunicorn worker sees an edit within RAG_EDIT_POLL_SECONDS, and a restarted
+one rebuilds its delta from the log.
+
+Compaction (knowledge_base.compact) folds the edits into a new version and
+starts it with an empty delta.
+
+BM25 only covers paragraphs as of the last build or compaction: new and
+replaced paragraphs are found by embedding until then, and deleted ones
+drop out of lexical results right away.
+================================================================================
+"""
+
+import threading
+
+import numpy as np
+
+from app.indexes import l2_normalized
+from app.sources import source_name
+
+
+class LiveEdits:
+    def __init__(self, dim, num_base_ids, metric="l2"):
+        """
+        num_base_ids: one more than the largest id in the base index;
+        metric: the base index's (see indexes.py)
+        """
+        import faiss
+
+        self.metric = metric
+        self.delta = faiss.IndexIDMap2(faiss.IndexFlatIP(dim) if metric == "cosine" else faiss.IndexFlatL2(dim))
+        self.delta_sources = {}   # delta id -> source name
+        self.deleted = np.zeros(num_base_ids, dtype=bool)  # base ids masked out
+        self.seq = 0              # last edits log entry applied
+        self.generation = 0       # bumped whenever the searchable set changes
+        self.lock = threading.Lock()
+        self._selectors = {}
+
+    def sync(self, store):
+        """Apply entries of store's edits log newer than the last sync; returns how many"""
+        with self.lock:
+            edits = store.edits_since(self.seq)
+            for seq, idx, op, _, source, embedding in edits:
+                if idx < len(self.deleted):
+                    self.deleted[idx] = True
+                self.delta.remove_ids(np.array([idx], dtype=np.int64))
+                self.delta_sources.pop(idx, None)
+                if op == "upsert":
+                    vector = np.frombuffer(embedding, dtype=np.float32).reshape(1, -1)
+                    if self.metric == "cosine":
+                        vector = l2_normalized(vector)
+                    self.delta.add_with_ids(vector, np.array([idx], dtype=np.int64))
+                    self.delta_sources[idx] = source_name(source)
+                self.seq = seq
+            if edits:
+                self.generation += 1
+                self._selectors.clear()
+        return len(edits)
+
+    def source_names(self):
+        with self.lock:
+            return set(self.delta_sources.values())
+
+    def allowed(self, source_map, sources):
+        """Boolean mask over base ids still searchable (and from sources, if given), or None for all"""
+        return self._filter(source_map, sources)[0]
+
+    def base_selector(self, source_map, sources):
+        """
+        (selector, bitmap) for searching the base index: the selector tests
+        the packed bitmap, which must outlive the search, so hold on to the
+        whole tuple until it returns. Both are None if all ids pass.
+        """
+        _, bitmap, selector = self._filter(source_map, sources)
+        return selector, bitmap
+
+    def _filter(self, source_map, sources):
+        key = frozenset(sources or ())
+        with self.lock:
+            cached = self._selectors.get(key)
+            if cached is not None:
+                return cached
+            if not self.deleted.any():
+                if key:
+                    cached = (source_map.mask(key), source_map.bitmap(key), source_map.selector(key))
+                else:
+                    cached = (None, None, None)
+            else:
+                import faiss
+
+                mask = ~self.deleted
+                if key:
+                    source_mask = source_map.mask(key)
+                    n = min(len(mask), len(source_mask))
+                    mask[:n] &= source_mask[:n]
+                    mask[n:] = False
+                bitmap = np.packbits(mask, bitorder="little")
+                cached = (mask, bitmap, faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+            self._selectors[key] = cached
+            return cached
+
+    def merge(self, embeddings, k, sources, distances, ids):
+        """
+        Base search results merged with the k nearest delta vectors, by
+        distance (smaller is nearer: cosine similarities come negated)
+        """
+        import faiss
+
+        with self.lock:
+            if self.delta.ntotal == 0:
+                return distances, ids
+            params = None
+            if sources:
+                wanted = np.array([idx for idx, name in self.delta_sources.items() if name in sources],
+                                  dtype=np.int64)
+                if not len(wanted):
+                    return distances, ids
+                selector = faiss.IDSelectorBatch(len(wanted), faiss.swig_ptr(wanted))
+                params = faiss.SearchParameters(sel=selector)
+            delta_distances, delta_ids = self.delta.search(
+                embeddings, min(k, self.delta.ntotal), params=params)
+        if self.metric == "cosine":
+            delta_distances = -delta_distances
+
+        distances = np.hstack([distances, delta_distances])
+        ids = np.hstack([ids, delta_ids])
+        distances = np.where(ids >= 0, distances, np.inf)
+        order = np.argsort(distances, axis=1, kind="stable")[:, :k]
+        return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+    def snapshot(self):
+        """(seq, deleted mask, delta ids, delta vectors) as of the last applied edit"""
+        import faiss
+
+        with self.lock:
+            inner = faiss.downcast_index(self.delta.index)
+            return (self.seq, self.deleted.copy(), faiss.vector_to_array(self.delta.id_map).copy(),
+                    inner.reconstruct_n(0, inner.ntotal))
@@ -6,50 +6,621 @@ FastAPI RAG Service
 Loads your FAISS index + metadata, embeds incoming question, 
 finds nearest paragraphs from RFCs + CAB docs, and returns them.
 
+This module holds the configuration (RAG_* environment variables, see the
+README), the request models and the endpoints; the machinery lives next to
+it: batcher.py and cache.py (micro-batching, result caches), admission.py
+(coalescing, load shedding), knowledge_base.py, live.py and shards.py
+(index versions, live edits, sharded search), lexical.py and sources.py
+(BM25, source filters), citations.py, embedding.py and metrics.py.
+
 Run with:
     uvicorn app.main:app --reload
 
+or, for several workers sharing one copy of the model and index
+(see gunicorn.conf.py):
+    RAG_WORKERS=4 gunicorn -c gunicorn.conf.py app.main:app
+
 Author: Mihir Gupta, 2025
 ================================================================================
 """
 
-from fastapi import FastAPI
-from pydantic import BaseModel
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Header, HTTPException, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from pydantic import BaseModel, Field
+from typing import List, Literal, Optional
+import asyncio
+import fcntl
+import hmac
 import json
-import faiss
+import os
+import threading
+import time
+import weakref
 import numpy as np
-from sentence_transformers import SentenceTransformer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+from app.admission import AdmissionController, Overloaded, SingleFlight
+from app.batcher import MicroBatcher
+from app.cache import LRUCache, SemanticCache, normalize_question
+from app.cert_flaws import FLAW_QUESTIONS, get_flaws, load_certificate
+from app.embedding import load_embedder
+from app.indexes import search_params
+from app.knowledge_base import KnowledgeBase, compact, current_index_dir
+from app.lexical import fuse, is_lexical_query
+from app.metastore import IdOutOfRange, Sealed
+from app.metrics import (BATCH_SIZE, COALESCED, ERRORS, QUERY_K, REJECTED, REQUEST_SECONDS, STAGE_SECONDS,
+                         cache_counter, record_slow_query, render_metrics, stage)
+
+# ----------------------------
+# Config
+# ----------------------------
+BATCH_MAX_SIZE = int(os.environ.get("RAG_BATCH_MAX_SIZE", "32"))
+BATCH_MAX_WAIT_MS = float(os.environ.get("RAG_BATCH_MAX_WAIT_MS", "5"))
+CACHE_MAX_ENTRIES = int(os.environ.get("RAG_CACHE_MAX_ENTRIES", "4096"))
+CACHE_TTL_SECONDS = float(os.environ.get("RAG_CACHE_TTL_SECONDS", "3600"))
+# Semantic cache of recent dense searches; 0 entries (the default) turns it off
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get("RAG_SEMANTIC_CACHE_MAX_ENTRIES", "0"))
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get("RAG_SEMANTIC_CACHE_THRESHOLD", "0.95"))
+QUERY_BATCH_CHUNK = int(os.environ.get("RAG_QUERY_BATCH_CHUNK", "256"))
+QUERY_BATCH_MAX_ITEMS = int(os.environ.get("RAG_QUERY_BATCH_MAX_ITEMS", "100000"))
+# Hits of a streamed /query whose metadata is read (and written out) at a time
+STREAM_CHUNK = int(os.environ.get("RAG_STREAM_CHUNK", "256"))
+# Largest k a query may ask for; every search allocates queries x k results (in every shard process)
+MAX_K = int(os.environ.get("RAG_MAX_K", "10000"))
+# Largest nprobe and ef_search a query may ask for: IVF cells scanned, and
+# the HNSW candidate beam, per search (nprobe is also capped at the index's nlist)
+MAX_NPROBE = int(os.environ.get("RAG_MAX_NPROBE", "1024"))
+MAX_EF_SEARCH = int(os.environ.get("RAG_MAX_EF_SEARCH", "1024"))
+# Admission control: requests served at once, how many more may wait and for
+# how long before getting a 503; RAG_MAX_IN_FLIGHT=0 turns it off
+MAX_IN_FLIGHT = int(os.environ.get("RAG_MAX_IN_FLIGHT", "64"))
+MAX_QUEUE = int(os.environ.get("RAG_MAX_QUEUE", "256"))
+MAX_QUEUE_WAIT_MS = float(os.environ.get("RAG_MAX_QUEUE_WAIT_MS", "1000"))
+RETRY_AFTER_SECONDS = int(os.environ.get("RAG_RETRY_AFTER_SECONDS", "1"))
+# How often to check for a newly published index version; 0 turns it off
+RELOAD_POLL_SECONDS = float(os.environ.get("RAG_RELOAD_POLL_SECONDS", "10"))
+# How often to apply live edits made through other workers, and to fold
+# pending edits into a new index version; 0 turns either off
+EDIT_POLL_SECONDS = float(os.environ.get("RAG_EDIT_POLL_SECONDS", "1"))
+COMPACT_INTERVAL_SECONDS = float(os.environ.get("RAG_COMPACT_INTERVAL_SECONDS", "3600"))
+# How far above the next free paragraph id an upsert may pick its own id;
+# arrays of the index and BM25 are sized by the largest id
+MAX_ID_GAP = int(os.environ.get("RAG_MAX_ID_GAP", "100000"))
+# Index versions kept on disk after a compaction, the new one included
+KEEP_VERSIONS = int(os.environ.get("RAG_KEEP_VERSIONS", "3"))
+# Required in X-Admin-Token by the /admin endpoints, which are disabled without it
+ADMIN_TOKEN = os.environ.get("RAG_ADMIN_TOKEN")
+INDEX_MMAP = os.environ.get("RAG_INDEX_MMAP", "1") != "0"
+BLOCKING_STARTUP = os.environ.get("RAG_BLOCKING_STARTUP", "0") == "1"
+MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_BACKEND = os.environ.get("RAG_EMBEDDING_BACKEND", "torch")
+# Weight of the vector score in hybrid mode, and how many dense candidates
+# per requested result are fused with the lexical ones
+HYBRID_ALPHA = float(os.environ.get("RAG_HYBRID_ALPHA", "0.5"))
+HYBRID_DEPTH = int(os.environ.get("RAG_HYBRID_DEPTH", "4"))
+
+# Run once per process before going ready, so the first real query doesn't pay
+# for tokenizer and kernel warmup; single and batched, short and long
+WARMUP_QUESTIONS = [
+    "Is SHA-1 allowed?",
+    "What is the SAN requirement for TLS server certificates?",
+    "How many bits of entropy must a certificate serial number contain, and "
+    "which CA/Browser Forum Baseline Requirements section defines it?",
+]
 
 # ----------------------------
 # Models
 # ----------------------------
 class QueryRequest(BaseModel):
     question: str
-    k: int = 5
+    k: int = Field(5, ge=1, le=MAX_K)
+    # Search-time knobs for approximate indexes; ignored by index types they don't apply to
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_NPROBE)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_EF_SEARCH)
+    mode: Literal["auto", "dense", "lexical", "hybrid"] = "auto"
+    # Only return paragraphs from these sources (see GET /index for the names)
+    sources: Optional[List[str]] = None
+    # Return stage and per-shard timings with the results (not when streaming)
+    debug: bool = False
+    # "ids" returns ids, scores and sources only; max_text_chars cuts the text short
+    fields: Literal["full", "ids"] = "full"
+    max_text_chars: Optional[int] = Field(None, ge=1)
+    # Stream the hits back as NDJSON, one per line
+    stream: bool = False
+
+class BatchQueryRequest(BaseModel):
+    queries: List[QueryRequest]
+    stream: bool = False
+
+class CertificateQueryRequest(BaseModel):
+    pem: str
+    # Passages per flaw, and the same knobs as QueryRequest
+    k: int = Field(5, ge=1, le=MAX_K)
+    nprobe: Optional[int] = Field(None, ge=1, le=MAX_NPROBE)
+    ef_search: Optional[int] = Field(None, ge=1, le=MAX_EF_SEARCH)
+    mode: Literal["auto", "dense", "lexical", "hybrid"] = "auto"
+    sources: Optional[List[str]] = None
+    fields: Literal["full", "ids"] = "full"
+    max_text_chars: Optional[int] = Field(None, ge=1)
+
+class Paragraph(BaseModel):
+    text: str
+    # Source URL, or a name for paragraphs of internal documents
+    source: str
+    # Replaces the paragraph with this id; a new id is assigned if omitted
+    id: Optional[int] = Field(None, ge=0, le=2**31 - 1)
+
+class UpsertRequest(BaseModel):
+    paragraphs: List[Paragraph] = Field(..., min_length=1)
+
+class DeleteRequest(BaseModel):
+    ids: List[int]
 
 # ----------------------------
-# App & global state
+# Global state
 # ----------------------------
-app = FastAPI()
-
-print("✅ Loading SentenceTransformer model...")
-model = SentenceTransformer("all-MiniLM-L6-v2")
+model = None
+# The KnowledgeBase being served; replaced on reload, only its live edits change
+kb = None
 
-import os
+# loading -> warming -> ready, or failed
+readiness = {"status": "loading", "error": None, "warmup_seconds": None}
+_load_lock = threading.Lock()
+_reload_lock = threading.Lock()
 
 # Get the absolute path to the project root
 project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), "../.."))
 
-# Define paths relative to project root
-faiss_index_path = os.path.join(project_root, "knowledge_base/faiss_index/faiss_index.index")
-metadata_path = os.path.join(project_root, "knowledge_base/faiss_index/metadata.json")
+onnx_model_dir = os.environ.get("RAG_ONNX_DIR", os.path.join(project_root, "onnx_model"))
+
+def load_model():
+    global model
 
-print(f"✅ Loading FAISS index from {faiss_index_path}...")
-index = faiss.read_index(faiss_index_path)
+    print(f"✅ Loading {MODEL_NAME} embedding model ({EMBEDDING_BACKEND} backend)...")
+    model = load_embedder(EMBEDDING_BACKEND, MODEL_NAME, onnx_model_dir)
 
-print(f"✅ Loading metadata from {metadata_path}...")
-with open(metadata_path) as f:
-    metadata = json.load(f)
+# Define paths relative to project root; versions are published under it (see knowledge_base.py)
+faiss_index_root = os.environ.get("RAG_INDEX_ROOT", os.path.join(project_root, "knowledge_base/faiss_index"))
+
+embedding_cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, on_lookup=cache_counter("embeddings"))
+result_cache = LRUCache(CACHE_MAX_ENTRIES, CACHE_TTL_SECONDS, on_lookup=cache_counter("results"))
+semantic_cache = SemanticCache(SEMANTIC_CACHE_MAX_ENTRIES, SEMANTIC_CACHE_THRESHOLD, CACHE_TTL_SECONDS,
+                               on_lookup=cache_counter("semantic"))
+
+def load_knowledge_base():
+    """Load the currently published version of the knowledge base"""
+    global kb
+
+    kb = KnowledgeBase(current_index_dir(faiss_index_root), mmap=INDEX_MMAP)
+
+def load_state():
+    """Load whatever isn't loaded yet; a no-op in workers forked after a preload"""
+    with _load_lock:
+        if model is None:
+            load_model()
+        if kb is None:
+            load_knowledge_base()
+
+def warmup(knowledge_base):
+    """Encode and search a few questions without touching the caches"""
+    started = time.time()
+    for questions in ([WARMUP_QUESTIONS[0]], WARMUP_QUESTIONS):
+        embeddings = model.encode(questions, convert_to_numpy=True)
+        knowledge_base.index.search(embeddings, 5)
+    knowledge_base.metadata.get_many([0])
+    if knowledge_base.lexical_index is not None:
+        knowledge_base.lexical_index.search(WARMUP_QUESTIONS[0], 5)
+    return time.time() - started
+
+def reload_knowledge_base(force=False):
+    """
+    Load and warm up the published version in the background, then swap it
+    in. Requests already running finish on the version they started with;
+    the old one is freed once they're done. Returns whether anything changed.
+    """
+    global kb
+
+    with _reload_lock:
+        index_dir = current_index_dir(faiss_index_root)
+        if not force and kb is not None and kb.dir == index_dir:
+            return False
+        new_kb = KnowledgeBase(index_dir, mmap=INDEX_MMAP)
+        warmup(new_kb)
+        old_kb, kb = kb, new_kb
+        # Keys hold their version, so old results can't be served; drop them to free the old one sooner
+        result_cache.clear()
+        semantic_cache.clear()
+    if old_kb is not None:
+        weakref.finalize(old_kb, print, f"✅ Released index version {old_kb.version}")
+    print(f"✅ Now serving index version {new_kb.version}")
+    return True
+
+def sync_edits(knowledge_base=None):
+    """Apply live edits logged since the last sync to the served version (or knowledge_base)"""
+    knowledge_base = knowledge_base or kb
+    if knowledge_base.live.sync(knowledge_base.metadata):
+        # Keys hold the edit generation, so stale results can't be served; drop them to free memory
+        result_cache.clear()
+        semantic_cache.clear()
+
+def edit_knowledge_base(edit):
+    """
+    Run edit(knowledge_base) against the served version and apply it at once.
+    If that version was just compacted away, the edit goes to the new one.
+    Returns (edit's result, the knowledge base edited).
+    """
+    knowledge_base = kb
+    try:
+        result = edit(knowledge_base)
+    except Sealed:
+        reload_knowledge_base()
+        knowledge_base = kb
+        result = edit(knowledge_base)
+    sync_edits(knowledge_base)
+    return result, knowledge_base
+
+def compact_knowledge_base(only_if_edited=False):
+    """
+    Fold the served version's live edits into a new published version and
+    switch to it. Returns the new version, or None if another worker holds
+    the compaction lock (or, with only_if_edited, there was nothing to fold).
+    """
+    with open(os.path.join(faiss_index_root, ".compact.lock"), "w") as lock_file:
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            return None
+        # Another worker may have compacted since this one last looked
+        reload_knowledge_base()
+        sync_edits()
+        if only_if_edited and not kb.live.seq:
+            return None
+        started = time.time()
+        version_dir = compact(kb, faiss_index_root, KEEP_VERSIONS)
+        print(f"✅ Compacted live edits into index version {os.path.basename(version_dir)} "
+              f"in {time.time() - started:.1f}s")
+        reload_knowledge_base()
+        return kb.version
+
+def watch_knowledge_base():
+    """
+    Reload whenever a new version is published, apply edits made through
+    other workers and compact pending edits, each on its own interval
+    """
+    tasks = [
+        (RELOAD_POLL_SECONDS, reload_knowledge_base, "Reload failed"),
+        (EDIT_POLL_SECONDS, sync_edits, "Applying live edits failed"),
+        (COMPACT_INTERVAL_SECONDS, lambda: compact_knowledge_base(only_if_edited=True), "Compaction failed"),
+    ]
+    tasks = [task for task in tasks if task[0] > 0]
+    due = [time.monotonic() + seconds for seconds, _, _ in tasks]
+    while tasks:
+        i = min(range(len(tasks)), key=due.__getitem__)
+        time.sleep(max(0.0, due[i] - time.monotonic()))
+        seconds, run, failure = tasks[i]
+        try:
+            run()
+        except Exception as e:
+            print(f"❌ {failure}, still serving index version {kb.version}: {e}")
+        due[i] = time.monotonic() + seconds
+
+def start_up():
+    try:
+        load_state()
+        readiness["status"] = "warming"
+        readiness["warmup_seconds"] = round(warmup(kb), 3)
+        readiness["status"] = "ready"
+        print(f"✅ Ready (warmup took {readiness['warmup_seconds']}s)")
+        if max(RELOAD_POLL_SECONDS, EDIT_POLL_SECONDS, COMPACT_INTERVAL_SECONDS) > 0:
+            threading.Thread(target=watch_knowledge_base, name="index-watcher", daemon=True).start()
+    except Exception as e:
+        readiness["status"] = "failed"
+        readiness["error"] = str(e)
+        print(f"❌ Startup failed: {e}")
+
+# ----------------------------
+# Retrieval
+# ----------------------------
+def embed_questions(questions, timings=None):
+    """Embeddings for normalized questions, encoding only the ones not cached"""
+    embeddings = [embedding_cache.get(question) for question in questions]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        with stage("encode", timings):
+            encoded = model.encode([questions[i] for i in missing], convert_to_numpy=True)
+        for i, embedding in zip(missing, encoded):
+            embedding_cache.put(questions[i], embedding)
+            embeddings[i] = embedding
+    return np.vstack(embeddings)
+
+def resolve_mode(query, knowledge_base):
+    """The retrieval mode for a query, with auto routed by the question's pattern"""
+    if query.mode == "auto":
+        if knowledge_base.lexical_index is not None and is_lexical_query(query.question):
+            return "lexical"
+        return "dense"
+    if query.mode in ("lexical", "hybrid") and knowledge_base.lexical_index is None:
+        raise HTTPException(
+            status_code=400,
+            detail="No lexical index is loaded; rebuild with build_faiss.py or python -m app.lexical"
+        )
+    return query.mode
+
+def source_filter(query, knowledge_base):
+    """The sources a query is restricted to, as a sorted tuple; () for all"""
+    if not query.sources:
+        return ()
+    source_map = knowledge_base.source_map
+    if source_map is None:
+        raise HTTPException(
+            status_code=400,
+            detail="No source ids are loaded; rebuild with build_faiss.py or python -m app.sources"
+        )
+    names = knowledge_base.source_names()
+    unknown = sorted(set(query.sources) - names)
+    if unknown:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unknown sources {unknown}; expected some of {sorted(names)}"
+        )
+    return tuple(sorted(set(query.sources)))
+
+def query_key(query, mode, knowledge_base):
+    """
+    Cache and batching key of a query: (normalized question, k, search params,
+    mode, sources, knowledge base, edit generation), with the params as a
+    sorted tuple of the knobs the index uses. Lexical queries don't touch the
+    vector index, so have no params. The knowledge base the request started
+    with travels with the key, so it is answered from that version
+    throughout; the generation of its live edits keeps results from before
+    an edit out of the cache afterwards.
+    """
+    params = ()
+    if mode != "lexical":
+        params = search_params(knowledge_base.index_type, {
+            **knowledge_base.manifest["search_params"], "nprobe": query.nprobe, "ef_search": query.ef_search})
+        # Probing more cells than the index has scans nothing more
+        nlist = knowledge_base.manifest.get("build_params", {}).get("nlist")
+        if "nprobe" in params and nlist:
+            params["nprobe"] = min(params["nprobe"], nlist)
+        params = tuple(sorted(params.items()))
+    return (normalize_question(query.question), query.k, params, mode,
+            source_filter(query, knowledge_base), knowledge_base, knowledge_base.live.generation)
+
+def as_hits(ids, scores):
+    """
+    A result as cached and passed around: (ids, scores) tuples, best first,
+    without the -1 padding of a search that found fewer than k
+    """
+    hits = [(int(idx), float(score)) for idx, score in zip(ids, scores) if idx >= 0]
+    return tuple(idx for idx, _ in hits), tuple(score for _, score in hits)
+
+def search_lexical(key):
+    """Top-k hits of a lexical key from the BM25 index; no embedding involved"""
+    question, k, _, _, sources, knowledge_base, _ = key
+    return as_hits(*knowledge_base.lexical_index.search(question, k, knowledge_base.allowed_ids(sources)))
+
+count_citation_lookup = cache_counter("citations")
+
+def precomputed_result(key):
+    """Top-k hits of a dense key from its version's citation table, or None if it isn't in there"""
+    question, k, params, mode, sources, knowledge_base, generation = key
+    # Live edits may change the answer, so only the build's own index state qualifies
+    if knowledge_base.citations is None or mode != "dense" or sources or generation:
+        return None
+    hits = knowledge_base.citations.lookup(question, k, params)
+    count_citation_lookup(hits is not None)
+    return hits
+
+def cache_result(key, hits):
+    # A result computed against a version that has since been swapped out, or
+    # edited while it was computed, is useless
+    knowledge_base = key[5]
+    if knowledge_base is kb and key[6] == knowledge_base.live.generation:
+        result_cache.put(key, hits)
+
+def search_questions(items):
+    """
+    Encode a batch of dense or hybrid keys in one call and search them with
+    one multi-row search per distinct set of search params and source filter;
+    a filter (and deleted paragraphs) is applied by FAISS itself (an
+    IDSelector), so k is never inflated to make up for filtered-out results,
+    and live edits are merged in (KnowledgeBase.search). Hybrid keys search
+    HYBRID_DEPTH times deeper and fuse those candidates with BM25. Dense
+    keys close enough to a recent one are answered from the semantic cache
+    instead of the index.
+    Returns one (hits, stage timings in ms) pair per item; every item
+    shares the batch's timings.
+    """
+    BATCH_SIZE.observe(len(items))
+    timings = {}
+    questions = [key[0] for key in items]
+    query_embeddings = embed_questions(questions, timings)
+
+    def depth(item):
+        _, k, _, mode, _, _, _ = item
+        return k * HYBRID_DEPTH if mode == "hybrid" else k
+
+    # Everything but the question: a paraphrase may only reuse hits searched the same way
+    dense = [row for row, key in enumerate(items) if key[3] == "dense"]
+    results = [None] * len(items)
+    for row, hits in zip(dense, semantic_cache.get_many([(items[row][1:], query_embeddings[row]) for row in dense])):
+        results[row] = hits
+
+    rows_by_search = {}
+    for row, (_, _, params, _, sources, knowledge_base, _) in enumerate(items):
+        if results[row] is None:
+            rows_by_search.setdefault((knowledge_base, params, sources), []).append(row)
+
+    for (knowledge_base, params, sources), rows in rows_by_search.items():
+        max_depth = max(depth(items[row]) for row in rows)
+        with stage("search", timings):
+            D, I = knowledge_base.search(query_embeddings[rows], max_depth, dict(params), sources, timings)
+        # With the same search params, top-k is a prefix of top-max_k
+        for i, row in enumerate(rows):
+            question, k, _, mode, _, _, _ = items[row]
+            if mode == "hybrid":
+                n = depth(items[row])
+                with stage("lexical", timings):
+                    lexical_scores = knowledge_base.lexical_index.scores(question, knowledge_base.allowed_ids(sources))
+                    results[row] = as_hits(*fuse(lexical_scores, I[i][:n], D[i][:n], k, HYBRID_ALPHA))
+            else:
+                # Distances are smaller the nearer; scores larger
+                results[row] = as_hits(I[i][:k], -D[i][:k])
+    semantic_cache.put_many([(items[row][1:], query_embeddings[row], results[row])
+                             for rows in rows_by_search.values() for row in rows if items[row][3] == "dense"])
+    return [(hits, timings) for hits in results]
+
+def add_timings(timings, batch_timings):
+    """Charge a request with the stage timings of the batch it was part of"""
+    if timings is not None:
+        for name, ms in batch_timings.items():
+            timings[name] = timings.get(name, 0.0) + ms
+
+def answer_keys(keys, timings=None):
+    """
+    Top-k hits for a chunk of query keys: precomputed ones come from the
+    citation table, cached ones from the results cache, lexical ones from
+    the BM25 index, and the rest share one encode and one index.search.
+    """
+    answers = [precomputed_result(key) for key in keys]
+    answers = [hits if hits is not None else result_cache.get(key) for key, hits in zip(keys, answers)]
+    missing = [i for i, hits in enumerate(answers) if hits is None]
+    dense = []
+    for i in missing:
+        if keys[i][3] == "lexical":
+            with stage("lexical", timings):
+                answers[i] = search_lexical(keys[i])
+            cache_result(keys[i], answers[i])
+        else:
+            dense.append(i)
+    if dense:
+        searched = search_questions([keys[i] for i in dense])
+        for i, (hits, _) in zip(dense, searched):
+            answers[i] = hits
+            cache_result(keys[i], hits)
+        add_timings(timings, searched[0][1])
+    return answers
+
+def answer_queries(queries, keys, timings=None):
+    """answer_keys, with auto-routed lexical queries that BM25 found nothing for retried as dense"""
+    answers = answer_keys(keys, timings)
+    retry = [i for i, (query, key, hits) in enumerate(zip(queries, keys, answers))
+             if not hits[0] and key[3] == "lexical" and query.mode == "auto"]
+    if retry:
+        retried = answer_keys([query_key(queries[i], "dense", keys[i][5]) for i in retry], timings)
+        for i, hits in zip(retry, retried):
+            answers[i] = hits
+    return answers
+
+def debug_info(knowledge_base, mode, timings):
+    """What a request with debug set gets besides its results"""
+    info = {
+        "version": knowledge_base.version,
+        "mode": mode,
+        "stages_ms": {name: round(ms, 3) for name, ms in timings.items() if "." not in name},
+    }
+    # Sharded searches add search.shardN, which overlap search rather than add to it
+    shards = knowledge_base.manifest.get("shards", 0)
+    if "search.shard0" in timings:
+        info["shards_ms"] = [round(timings[f"search.shard{shard}"], 3) for shard in range(shards)]
+    return info
+
+def lookup_results(knowledge_base, hits, timings=None, fields="full", max_text_chars=None):
+    """
+    One result per hit with metadata: id, score, source and, unless fields
+    is "ids", the text, cut to max_text_chars if given
+    """
+    ids, scores = hits
+    text_chars = 0 if fields == "ids" else max_text_chars
+    with stage("metadata", timings):
+        records = knowledge_base.metadata.get_by_id(ids, text_chars)
+    return [{"id": idx, "score": round(score, 6), **records[idx]}
+            for idx, score in zip(ids, scores) if idx in records]
+
+def dumps(content):
+    """content as compact UTF-8 JSON; orjson is several times faster on large results"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+class FastJSONResponse(JSONResponse):
+    def render(self, content):
+        return dumps(content)
+
+batcher = MicroBatcher(search_questions, max_batch_size=BATCH_MAX_SIZE, max_wait_ms=BATCH_MAX_WAIT_MS)
+singleflight = SingleFlight(on_coalesced=COALESCED.inc)
+admission = AdmissionController(MAX_IN_FLIGHT, MAX_QUEUE, MAX_QUEUE_WAIT_MS)
+
+def require_ready():
+    if readiness["status"] != "ready":
+        raise HTTPException(
+            status_code=503,
+            detail=f"Service is {readiness['status']}",
+            headers={"Retry-After": "5"}
+        )
+
+def require_admin(token):
+    # They edit the corpus and delete old versions from disk, so nobody gets in without a token configured
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403,
+                            detail="Admin endpoints are disabled; set RAG_ADMIN_TOKEN to enable them")
+    if not hmac.compare_digest(token or "", ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Missing or wrong X-Admin-Token")
+
+def require_writable():
+    if not kb.metadata.writable:
+        raise HTTPException(
+            status_code=409,
+            detail="Live edits need a metadata.sqlite store; convert it with python -m app.metastore"
+        )
+
+async def admit(timings):
+    """Wait for an admission slot; returns the function that frees it, or raises 503"""
+    try:
+        with stage("admission", timings):
+            return await admission.acquire()
+    except Overloaded as e:
+        REJECTED.labels(reason=e.reason).inc()
+        raise HTTPException(
+            status_code=503,
+            detail=f"Service overloaded ({e.reason.replace('_', ' ')})",
+            headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+        )
+
+# ----------------------------
+# App
+# ----------------------------
+@asynccontextmanager
+async def lifespan(app):
+    loading = asyncio.get_running_loop().run_in_executor(None, start_up)
+    if BLOCKING_STARTUP:
+        await loading
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+@app.middleware("http")
+async def observe_request(request: Request, call_next):
+    """Request latency and error counts per endpoint (time to response headers for streams)"""
+    # Unknown paths share one label so scanners can't blow up the series count
+    endpoint = request.url.path if request.url.path in METERED_PATHS else "other"
+    started = time.perf_counter()
+    status = "500"
+    try:
+        response = await call_next(request)
+        status = str(response.status_code)
+        return response
+    finally:
+        REQUEST_SECONDS.labels(endpoint=endpoint, status=status).observe(time.perf_counter() - started)
+        if int(status) >= 400:
+            ERRORS.labels(endpoint=endpoint, status=status).inc()
 
 # ----------------------------
 # Endpoints
@@ -68,7 +639,12 @@ def root():
             {
                 "path": "/healthz",
                 "method": "GET",
-                "description": "Health check endpoint"
+                "description": "Liveness check; ok as soon as the process is up"
+            },
+            {
+                "path": "/readyz",
+                "method": "GET",
+                "description": "Readiness check; 200 once the model and index are loaded and warmed up"
             },
             {
                 "path": "/query",
@@ -76,9 +652,82 @@ def root():
                 "description": "Query the RAG system with certificate-related questions",
                 "request_body": {
                     "question": "string",
-                    "k": "integer (default: 5)"
+                    "k": "integer, 1 to RAG_MAX_K (default: 5)",
+                    "nprobe": "integer, 1 to RAG_MAX_NPROBE (IVF indexes, default from manifest)",
+                    "ef_search": "integer, 1 to RAG_MAX_EF_SEARCH (HNSW indexes, default from manifest)",
+                    "mode": "auto | dense | lexical | hybrid (default: auto)",
+                    "sources": "list of source names to restrict results to, e.g. [\"cabf-br\"] (default: all)",
+                    "debug": "boolean; also return stage and per-shard timings (default: false)",
+                    "fields": "full | ids (ids, scores and sources only; default: full)",
+                    "max_text_chars": "integer, at least 1; cut each result's text to this many characters (default: no limit)",
+                    "stream": "boolean; return the results as NDJSON, one per line (default: false)"
                 }
             },
+            {
+                "path": "/query/batch",
+                "method": "POST",
+                "description": "Query many questions at once; set stream to get NDJSON lines",
+                "request_body": {
+                    "queries": "list of {question, k, ...} as for /query (per-query stream and debug are ignored)",
+                    "stream": "boolean (default: false)"
+                }
+            },
+            {
+                "path": "/query/certificate",
+                "method": "POST",
+                "description": "Detect a certificate's flaws and retrieve the passages for each, in one batch",
+                "request_body": {
+                    "pem": "string (PEM certificate)",
+                    "k": "integer, passages per flaw, 1 to RAG_MAX_K (default: 5)",
+                    "nprobe, ef_search, mode, sources, fields, max_text_chars": "as for /query"
+                }
+            },
+            {
+                "path": "/index",
+                "method": "GET",
+                "description": "Version, type, size, search parameters and source names of the loaded index"
+            },
+            {
+                "path": "/admin/reload",
+                "method": "POST",
+                "description": "Load the published index version and swap it in; ?force=true reloads the same one",
+                "headers": "X-Admin-Token (the endpoint is disabled unless RAG_ADMIN_TOKEN is set)"
+            },
+            {
+                "path": "/admin/paragraphs",
+                "method": "POST",
+                "description": "Embed and add paragraphs, or replace them by id, without a rebuild",
+                "request_body": {
+                    "paragraphs": "non-empty list of {text, source, id (optional; a new id is assigned if omitted, "
+                                  "at most RAG_MAX_ID_GAP above the next free one)}"
+                },
+                "headers": "X-Admin-Token (the endpoint is disabled unless RAG_ADMIN_TOKEN is set)"
+            },
+            {
+                "path": "/admin/paragraphs/delete",
+                "method": "POST",
+                "description": "Delete paragraphs by id without a rebuild",
+                "request_body": {
+                    "ids": "list of paragraph ids"
+                },
+                "headers": "X-Admin-Token (the endpoint is disabled unless RAG_ADMIN_TOKEN is set)"
+            },
+            {
+                "path": "/admin/compact",
+                "method": "POST",
+                "description": "Fold live edits into a new published index version now",
+                "headers": "X-Admin-Token (the endpoint is disabled unless RAG_ADMIN_TOKEN is set)"
+            },
+            {
+                "path": "/cache/stats",
+                "method": "GET",
+                "description": "Hit/miss counters of the query caches"
+            },
+            {
+                "path": "/metrics",
+                "method": "GET",
+                "description": "Prometheus metrics: request and per-stage latency, k, errors, cache hits"
+            },
             {
                 "path": "/docs",
                 "method": "GET",
@@ -91,18 +740,278 @@ def root():
 def healthz():
     return {"status": "ok"}
 
-@app.post("/query")
-def query_rag(request: QueryRequest):
-    query_embedding = model.encode([request.question], convert_to_numpy=True)
-    D, I = index.search(query_embedding, request.k)
+@app.get("/readyz")
+def readyz():
+    status_code = 200 if readiness["status"] == "ready" else 503
+    return JSONResponse(status_code=status_code, content=readiness)
 
-    results = []
-    for idx in I[0]:
-        item = metadata.get(str(idx))
-        if item:
-            results.append(item)
+@app.get("/index")
+def index_info():
+    require_ready()
+    knowledge_base = kb
+    return {
+        **knowledge_base.manifest,
+        "version": knowledge_base.version,
+        "ntotal": knowledge_base.index.ntotal,
+        "sources": sorted(knowledge_base.source_names()),
+        "citations": len(knowledge_base.citations) if knowledge_base.citations else 0,
+        "live_edits": {
+            "applied": knowledge_base.live.seq,
+            "added": knowledge_base.live.delta.ntotal,
+            "deleted": int(knowledge_base.live.deleted.sum())
+        }
+    }
+
+@app.post("/admin/reload")
+async def admin_reload(force: bool = False, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    require_ready()
+    try:
+        reloaded = await asyncio.get_running_loop().run_in_executor(None, reload_knowledge_base, force)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Reload failed, still serving version {kb.version}: {e}")
+    return {"reloaded": reloaded, "version": kb.version}
+
+def upsert_paragraphs(paragraphs):
+    embeddings = model.encode([paragraph.text for paragraph in paragraphs], convert_to_numpy=True)
+    rows = [(paragraph.id, paragraph.text, paragraph.source, embedding)
+            for paragraph, embedding in zip(paragraphs, embeddings)]
+    return edit_knowledge_base(lambda knowledge_base: knowledge_base.metadata.upsert(rows, max_gap=MAX_ID_GAP))
+
+@app.post("/admin/paragraphs")
+async def admin_upsert(request: UpsertRequest, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    require_ready()
+    require_writable()
+    try:
+        ids, knowledge_base = await asyncio.get_running_loop().run_in_executor(
+            None, upsert_paragraphs, request.paragraphs)
+    except IdOutOfRange as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    return {"ids": ids, "version": knowledge_base.version}
 
+@app.post("/admin/paragraphs/delete")
+async def admin_delete(request: DeleteRequest, x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    require_ready()
+    require_writable()
+    deleted, knowledge_base = await asyncio.get_running_loop().run_in_executor(
+        None, edit_knowledge_base, lambda knowledge_base: knowledge_base.metadata.delete(request.ids))
     return {
-        "question": request.question,
-        "results": results
+        "deleted": deleted,
+        "not_found": sorted(set(request.ids) - set(deleted)),
+        "version": knowledge_base.version
     }
+
+@app.post("/admin/compact")
+async def admin_compact(x_admin_token: Optional[str] = Header(None)):
+    require_admin(x_admin_token)
+    require_ready()
+    require_writable()
+    try:
+        version = await asyncio.get_running_loop().run_in_executor(None, compact_knowledge_base)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Compaction failed, still serving version {kb.version}: {e}")
+    if version is None:
+        raise HTTPException(status_code=409, detail="Another worker is compacting; retry shortly")
+    return {"version": version}
+
+@app.get("/cache/stats")
+def cache_stats():
+    return {
+        "embeddings": embedding_cache.stats(),
+        "results": result_cache.stats(),
+        "semantic": semantic_cache.stats()
+    }
+
+@app.get("/metrics")
+def metrics():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
+
+async def compute_key(key):
+    """Top-k hits and stage timings for one key, from BM25 inline or through the micro-batcher"""
+    timings = {}
+    if key[3] == "lexical":
+        with stage("lexical", timings):
+            hits = search_lexical(key)
+    else:
+        submitted = time.perf_counter()
+        hits, batch_timings = await batcher.submit(key)
+        # Whatever the batch didn't spend encoding and searching was spent waiting for it
+        waited_ms = (time.perf_counter() - submitted) * 1000
+        queue_ms = max(0.0, waited_ms - sum(ms for name, ms in batch_timings.items() if "." not in name))
+        STAGE_SECONDS.labels(stage="queue").observe(queue_ms / 1000)
+        add_timings(timings, {**batch_timings, "queue": queue_ms})
+    cache_result(key, hits)
+    return hits, timings
+
+async def answer_key(key, timings):
+    """Top-k hits for one key: precomputed, cached, or computed once for all identical keys in flight"""
+    hits = precomputed_result(key)
+    if hits is None:
+        hits = result_cache.get(key)
+    if hits is None:
+        hits, key_timings = await singleflight.do(key, lambda: compute_key(key))
+        add_timings(timings, key_timings)
+    return hits
+
+async def stream_hits(knowledge_base, request, hits, timings, release, log_if_slow):
+    """NDJSON lines of a /query's results, STREAM_CHUNK hits' metadata at a time"""
+    try:
+        ids, scores = hits
+        for start in range(0, len(ids), STREAM_CHUNK):
+            chunk = (ids[start:start + STREAM_CHUNK], scores[start:start + STREAM_CHUNK])
+            results = lookup_results(knowledge_base, chunk, timings, request.fields, request.max_text_chars)
+            with stage("serialize", timings):
+                lines = b"".join(dumps(result) + b"\n" for result in results)
+            yield lines
+    finally:
+        release()
+    log_if_slow()
+
+@app.post("/query")
+async def query_rag(request: QueryRequest):
+    started = time.perf_counter()
+    timings = {}
+    require_ready()
+    knowledge_base = kb
+    mode = resolve_mode(request, knowledge_base)
+    key = query_key(request, mode, knowledge_base)
+    QUERY_K.observe(request.k)
+
+    def log_if_slow():
+        record_slow_query("/query", (time.perf_counter() - started) * 1000, timings,
+                          question=request.question, k=request.k, mode=mode, sources=request.sources)
+
+    release = await admit(timings)
+    streaming = False
+    try:
+        hits = await answer_key(key, timings)
+        if not hits[0] and mode == "lexical" and request.mode == "auto":
+            hits = await answer_key(query_key(request, "dense", knowledge_base), timings)
+        if request.stream:
+            # The stream holds the slot until its last line; the background task frees it if it never starts
+            streaming = True
+            return StreamingResponse(stream_hits(knowledge_base, request, hits, timings, release, log_if_slow),
+                                     media_type="application/x-ndjson", background=BackgroundTask(release))
+        results = lookup_results(knowledge_base, hits, timings, request.fields, request.max_text_chars)
+    finally:
+        if not streaming:
+            release()
+
+    content = {"question": request.question, "results": results}
+    if request.debug:
+        content["debug"] = debug_info(knowledge_base, mode, timings)
+    with stage("serialize", timings):
+        response = FastJSONResponse(content=content)
+    log_if_slow()
+    return response
+
+async def answer_batch(queries, keys, timings):
+    """Yield (position, query, results) in request order, one chunk at a time"""
+    loop = asyncio.get_running_loop()
+    for start in range(0, len(queries), QUERY_BATCH_CHUNK):
+        chunk = queries[start:start + QUERY_BATCH_CHUNK]
+        chunk_keys = keys[start:start + QUERY_BATCH_CHUNK]
+        # Encoding blocks, so keep it off the event loop like the micro-batcher does
+        answers = await loop.run_in_executor(None, answer_queries, chunk, chunk_keys, timings)
+        for offset, (query, hits) in enumerate(zip(chunk, answers)):
+            yield start + offset, query, lookup_results(keys[start + offset][5], hits, timings,
+                                                        query.fields, query.max_text_chars)
+
+@app.post("/query/batch")
+async def query_batch(request: BatchQueryRequest):
+    require_ready()
+    if len(request.queries) > QUERY_BATCH_MAX_ITEMS:
+        raise HTTPException(
+            status_code=413,
+            detail=f"At most {QUERY_BATCH_MAX_ITEMS} queries per batch"
+        )
+    started = time.perf_counter()
+    timings = {}
+    # Resolve modes up front so a bad one fails the request before streaming starts
+    knowledge_base = kb
+    keys = [query_key(query, resolve_mode(query, knowledge_base), knowledge_base) for query in request.queries]
+    for query in request.queries:
+        QUERY_K.observe(query.k)
+
+    def log_if_slow():
+        record_slow_query("/query/batch", (time.perf_counter() - started) * 1000, timings,
+                          questions=len(request.queries))
+
+    # A whole batch holds one admission slot until its last answer
+    release = await admit(timings)
+
+    if request.stream:
+        async def ndjson_lines():
+            try:
+                async for position, query, results in answer_batch(request.queries, keys, timings):
+                    line = {"index": position, "question": query.question, "results": results}
+                    with stage("serialize", timings):
+                        line = dumps(line) + b"\n"
+                    yield line
+            finally:
+                release()
+            log_if_slow()
+        # The background task frees the slot if the stream never starts
+        return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson",
+                                 background=BackgroundTask(release))
+
+    answers = []
+    try:
+        async for _, query, results in answer_batch(request.queries, keys, timings):
+            answers.append({"question": query.question, "results": results})
+    finally:
+        release()
+    with stage("serialize", timings):
+        response = FastJSONResponse(content={"results": answers})
+    log_if_slow()
+    return response
+
+@app.post("/query/certificate")
+async def query_certificate(request: CertificateQueryRequest):
+    started = time.perf_counter()
+    timings = {}
+    require_ready()
+    try:
+        certificate = load_certificate(request.pem)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Not a PEM certificate: {e}")
+    with stage("flaws", timings):
+        flaws = get_flaws(certificate)
+
+    knowledge_base = kb
+    queries = [
+        QueryRequest(question=FLAW_QUESTIONS[flaw], k=request.k, nprobe=request.nprobe,
+                     ef_search=request.ef_search, mode=request.mode, sources=request.sources,
+                     fields=request.fields, max_text_chars=request.max_text_chars)
+        for flaw in flaws
+    ]
+    keys = [query_key(query, resolve_mode(query, knowledge_base), knowledge_base) for query in queries]
+    QUERY_K.observe(request.k)
+    results = []
+    if queries:
+        release = await admit(timings)
+        try:
+            # One encode and one multi-row search for every flaw's question not already cached
+            answers = await asyncio.get_running_loop().run_in_executor(
+                None, answer_queries, queries, keys, timings)
+            results = [lookup_results(knowledge_base, hits, timings, request.fields, request.max_text_chars)
+                       for hits in answers]
+        finally:
+            release()
+
+    with stage("serialize", timings):
+        response = FastJSONResponse(content={
+            "flaws": [
+                {"flaw": flaw, "question": query.question, "results": flaw_results}
+                for flaw, query, flaw_results in zip(flaws, queries, results)
+            ]
+        })
+    record_slow_query("/query/certificate", (time.perf_counter() - started) * 1000, timings,
+                      flaws=flaws, k=request.k, sources=request.sources)
+    return response
+
+# Paths reported by name in the request metrics
+METERED_PATHS = {route.path for route in app.routes}
@@ -0,0 +1,309 @@
+"""
+================================================================================
+Paragraph metadata store
+
+Index ids map to {"text", "source"} records in a SQLite file,
+metadata.sqlite, next to the FAISS index. Records are read lazily by integer
+primary key, so startup cost and memory don't grow with the corpus, and
+every worker reading the same file shares the OS page cache (the file is
+also memory-mapped by SQLite). get_by_id can leave the text out, or cut it
+short inside SQLite, for callers that only need ids and sources.
+
+metadata.json, the original dict keyed by stringified ids, is still read if
+no SQLite store exists; convert it with
+
+    python -m app.metastore ../knowledge_base/faiss_index/metadata.json
+
+Live edits (POST /admin/paragraphs) are written to the SQLite store in one
+transaction each: the paragraphs table changes, and every upsert or delete
+is appended, embedding included, to an edits log. Each worker replays the
+log onto its in-memory index (live.py) and compaction folds it into a new
+version; the old store is then sealed, so a late writer gets Sealed
+instead of editing a version nobody will read again. The JSON fallback is
+read-only.
+================================================================================
+"""
+
+import json
+import os
+import sqlite3
+import sys
+import threading
+
+SCHEMA = """
+CREATE TABLE paragraphs (
+    id     INTEGER PRIMARY KEY,
+    text   TEXT NOT NULL,
+    source TEXT NOT NULL
+)
+"""
+
+EDITS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS edits (
+    seq       INTEGER PRIMARY KEY AUTOINCREMENT,
+    id        INTEGER NOT NULL,
+    op        TEXT NOT NULL,
+    text      TEXT,
+    source    TEXT,
+    embedding BLOB
+);
+CREATE TABLE IF NOT EXISTS state (
+    key   TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+MMAP_SIZE = 1 << 30
+MAX_SQL_VARIABLES = 900
+
+
+def write_store(path, records):
+    """
+    Write (id, {"text", "source"}) records to a new SQLite store at path.
+    The store is built under a temporary name and renamed into place.
+    """
+    tmp_path = path + ".tmp"
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    conn = sqlite3.connect(tmp_path)
+    conn.execute(SCHEMA)
+    conn.executemany(
+        "INSERT INTO paragraphs (id, text, source) VALUES (?, ?, ?)",
+        ((int(idx), record["text"], record["source"]) for idx, record in records),
+    )
+    conn.commit()
+    conn.close()
+    os.replace(tmp_path, path)
+
+
+class Sealed(Exception):
+    """The store was compacted into a newer version, which takes the edits instead"""
+
+
+class IdOutOfRange(ValueError):
+    """An upsert picked an id too far above the ones in use"""
+
+
+class MetadataStore:
+    """Thread-safe access to a metadata.sqlite store: lazy reads, transactional edits"""
+
+    writable = True
+
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._count = None
+
+    def _conn(self):
+        # Keyed by pid as well as thread: a connection opened in the gunicorn
+        # master before the fork must not be used by the workers
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True, check_same_thread=False)
+            conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def get_by_id(self, ids, text_chars=None):
+        """
+        {id: record} for the ids that have one. text_chars=0 leaves the
+        text out of the records, any other number keeps only that many
+        characters of it.
+        """
+        wanted = [int(idx) for idx in ids if int(idx) >= 0]
+        if text_chars is None:
+            columns, params = "id, source, text", []
+        elif text_chars > 0:
+            columns, params = "id, source, substr(text, 1, ?)", [text_chars]
+        else:
+            columns, params = "id, source", []
+        found = {}
+        for start in range(0, len(wanted), MAX_SQL_VARIABLES):
+            chunk = wanted[start:start + MAX_SQL_VARIABLES]
+            rows = self._conn().execute(
+                f"SELECT {columns} FROM paragraphs WHERE id IN ({','.join('?' * len(chunk))})",
+                params + chunk,
+            )
+            for row in rows:
+                found[row[0]] = {"text": row[2], "source": row[1]} if len(row) == 3 else {"source": row[1]}
+        return found
+
+    def get_many(self, ids):
+        """Records for ids, in the order given, skipping ids that have none"""
+        found = self.get_by_id(ids)
+        return [found[idx] for idx in (int(idx) for idx in ids) if idx in found]
+
+    def get(self, idx):
+        records = self.get_many([idx])
+        return records[0] if records else None
+
+    def items(self):
+        """All (id, record) pairs in id order"""
+        rows = self._conn().execute("SELECT id, text, source FROM paragraphs ORDER BY id")
+        for idx, text, source in rows:
+            yield idx, {"text": text, "source": source}
+
+    def __len__(self):
+        if self._count is None:
+            self._count = self._conn().execute("SELECT COUNT(*) FROM paragraphs").fetchone()[0]
+        return self._count
+
+    def upsert(self, paragraphs, max_gap=None):
+        """
+        Insert or replace (id, text, source, embedding) paragraphs in one
+        transaction. Paragraphs with id None get new ids, above any this
+        store has ever used; returns the ids, in order. With max_gap, an
+        explicit id more than max_gap above the next new id raises
+        IdOutOfRange and nothing is written: the index's id-indexed arrays
+        would grow to fit it.
+        """
+        def write(conn):
+            next_id = conn.execute(
+                "SELECT MAX(COALESCE((SELECT MAX(id) FROM paragraphs), -1),"
+                " COALESCE((SELECT MAX(id) FROM edits), -1)) + 1"
+            ).fetchone()[0]
+            ids = []
+            for idx, text, source, embedding in paragraphs:
+                if idx is None:
+                    idx, next_id = next_id, next_id + 1
+                elif max_gap is not None and idx > next_id + max_gap:
+                    raise IdOutOfRange(f"Paragraph id {idx} is more than {max_gap} above the next free id {next_id}")
+                conn.execute("INSERT OR REPLACE INTO paragraphs (id, text, source) VALUES (?, ?, ?)",
+                             (idx, text, source))
+                conn.execute("INSERT INTO edits (id, op, text, source, embedding) VALUES (?, 'upsert', ?, ?, ?)",
+                             (idx, text, source, embedding.astype("float32").tobytes()))
+                ids.append(idx)
+            return ids
+        return self._write(write)
+
+    def delete(self, ids):
+        """Delete paragraphs by id in one transaction; returns the ids that existed"""
+        def write(conn):
+            deleted = []
+            for idx in ids:
+                if conn.execute("DELETE FROM paragraphs WHERE id = ?", (idx,)).rowcount:
+                    conn.execute("INSERT INTO edits (id, op) VALUES (?, 'delete')", (idx,))
+                    deleted.append(idx)
+            return deleted
+        return self._write(write)
+
+    def edits_since(self, seq):
+        """Logged edits after seq, oldest first, as (seq, id, op, text, source, embedding)"""
+        conn = self._conn()
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name = 'edits'").fetchone() is None:
+            return []
+        edits = conn.execute(
+            "SELECT seq, id, op, text, source, embedding FROM edits WHERE seq > ? ORDER BY seq", (seq,)
+        ).fetchall()
+        if edits:
+            self._count = None
+        return edits
+
+    def replay(self, edits):
+        """Apply edits read from another store's log (as edits_since returns them) in one transaction"""
+        def write(conn):
+            for _, idx, op, text, source, embedding in edits:
+                if op == "upsert":
+                    conn.execute("INSERT OR REPLACE INTO paragraphs (id, text, source) VALUES (?, ?, ?)",
+                                 (idx, text, source))
+                else:
+                    conn.execute("DELETE FROM paragraphs WHERE id = ?", (idx,))
+                conn.execute("INSERT INTO edits (id, op, text, source, embedding) VALUES (?, ?, ?, ?, ?)",
+                             (idx, op, text, source, embedding))
+        self._write(write)
+
+    def seal(self, sealed_by, since_seq, hand_over):
+        """
+        Close the store to edits for good, in favour of version sealed_by.
+        hand_over(edits) runs inside the sealing transaction with the edits
+        logged after since_seq, so none can slip in between it and the seal.
+        """
+        def write(conn):
+            edits = conn.execute(
+                "SELECT seq, id, op, text, source, embedding FROM edits WHERE seq > ? ORDER BY seq", (since_seq,)
+            ).fetchall()
+            hand_over(edits)
+            conn.execute("INSERT INTO state (key, value) VALUES ('sealed_by', ?)", (sealed_by,))
+        self._write(write)
+
+    def _write(self, write):
+        # A connection per write: BEGIN IMMEDIATE takes SQLite's write lock
+        # up front, which serializes writers across threads and workers.
+        conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            conn.executescript(EDITS_SCHEMA)
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                sealed_by = conn.execute("SELECT value FROM state WHERE key = 'sealed_by'").fetchone()
+                if sealed_by:
+                    raise Sealed(sealed_by[0])
+                result = write(conn)
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+        finally:
+            conn.close()
+        self._count = None
+        return result
+
+
+class JsonMetadata:
+    """The legacy metadata.json, loaded fully into memory, behind the same interface"""
+
+    writable = False
+
+    def __init__(self, path):
+        self.path = path
+        with open(path) as f:
+            self._records = json.load(f)
+
+    def get_by_id(self, ids, text_chars=None):
+        found = {}
+        for idx in ids:
+            record = self._records.get(str(idx))
+            if record is None:
+                continue
+            if text_chars is None:
+                found[int(idx)] = record
+            elif text_chars > 0:
+                found[int(idx)] = {"text": record["text"][:text_chars], "source": record["source"]}
+            else:
+                found[int(idx)] = {"source": record["source"]}
+        return found
+
+    def get_many(self, ids):
+        records = (self._records.get(str(idx)) for idx in ids)
+        return [record for record in records if record]
+
+    def get(self, idx):
+        return self._records.get(str(idx))
+
+    def items(self):
+        return ((int(idx), record) for idx, record in self._records.items())
+
+    def __len__(self):
+        return len(self._records)
+
+    def edits_since(self, seq):
+        return []
+
+
+def open_store(index_dir):
+    """The SQLite store in index_dir, falling back to metadata.json"""
+    sqlite_path = os.path.join(index_dir, "metadata.sqlite")
+    if os.path.exists(sqlite_path):
+        return MetadataStore(sqlite_path)
+    return JsonMetadata(os.path.join(index_dir, "metadata.json"))
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m app.metastore path/to/metadata.json")
+    json_path = sys.argv[1]
+    with open(json_path) as f:
+        metadata = json.load(f)
+    sqlite_path = os.path.join(os.path.dirname(os.path.abspath(json_path)), "metadata.sqlite")
+    write_store(sqlite_path, metadata.items())
+    print(f"✅ Wrote {len(metadata)} records to {sqlite_path}")
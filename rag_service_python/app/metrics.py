@@ -0,0 +1,158 @@
+"""
+================================================================================
+Prometheus metrics and slow-query log for the RAG service
+
+/metrics exposes:
+
+- rag_request_seconds{endpoint,status}  end-to-end latency per endpoint
+- rag_stage_seconds{stage}              time per stage of a query:
+    encode    tokenization + embedding of the questions in one batch
+    search    one FAISS index.search (all shards of a sharded index; each
+              shard's part is in the stage timings as search.shardN)
+    lexical   one BM25 lookup
+    flaws     running the flaw rules on a /query/certificate PEM
+    admission waiting for an admission slot (see admission.py)
+    queue     waiting in the micro-batcher for a batch to form and run
+    metadata  fetching paragraph records for the result ids
+    serialize rendering the JSON response
+- rag_query_k                           distribution of requested k
+- rag_batch_size                        questions per micro-batch
+- rag_errors_total{endpoint,status}     4xx/5xx responses and exceptions
+- rag_cache_lookups_total{cache,result} embedding / result cache and citation table hits and misses
+- rag_slow_queries_total                requests over RAG_SLOW_QUERY_MS
+- rag_coalesced_total                   queries that joined an identical one in flight
+- rag_rejected_total{reason}            requests turned away by admission control
+
+Batched stages are observed once per batch, and every request in the batch
+is charged the batch's time in its own stage breakdown.
+
+A request slower than RAG_SLOW_QUERY_MS (default 500) is logged as one JSON
+line with its question, k, mode and stage timings, appended to
+RAG_SLOW_QUERY_LOG if set and printed otherwise.
+
+Under gunicorn, set PROMETHEUS_MULTIPROC_DIR to an empty directory so
+/metrics aggregates all workers.
+================================================================================
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Histogram,
+                               generate_latest, multiprocess)
+
+SLOW_QUERY_MS = float(os.environ.get("RAG_SLOW_QUERY_MS", "500"))
+SLOW_QUERY_LOG = os.environ.get("RAG_SLOW_QUERY_LOG")
+MULTIPROC_DIR = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+
+REGISTRY = CollectorRegistry()
+
+REQUEST_SECONDS = Histogram(
+    "rag_request_seconds",
+    "End-to-end request latency",
+    ["endpoint", "status"],
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+    registry=REGISTRY,
+)
+STAGE_SECONDS = Histogram(
+    "rag_stage_seconds",
+    "Time spent in one stage of answering a query",
+    ["stage"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+    registry=REGISTRY,
+)
+QUERY_K = Histogram(
+    "rag_query_k",
+    "Number of results requested per question",
+    buckets=(1, 2, 3, 5, 10, 20, 50, 100),
+    registry=REGISTRY,
+)
+BATCH_SIZE = Histogram(
+    "rag_batch_size",
+    "Questions encoded and searched together in one micro-batch",
+    buckets=(1, 2, 4, 8, 16, 32, 64, 128, 256),
+    registry=REGISTRY,
+)
+ERRORS = Counter(
+    "rag_errors_total",
+    "Requests that ended in a 4xx/5xx response or an exception",
+    ["endpoint", "status"],
+    registry=REGISTRY,
+)
+CACHE_LOOKUPS = Counter(
+    "rag_cache_lookups_total",
+    "Query cache lookups",
+    ["cache", "result"],
+    registry=REGISTRY,
+)
+SLOW_QUERIES = Counter(
+    "rag_slow_queries_total",
+    "Requests slower than RAG_SLOW_QUERY_MS",
+    registry=REGISTRY,
+)
+
+COALESCED = Counter(
+    "rag_coalesced_total",
+    "Queries answered by an identical query already in flight",
+    registry=REGISTRY,
+)
+REJECTED = Counter(
+    "rag_rejected_total",
+    "Requests rejected with 503 by admission control",
+    ["reason"],
+    registry=REGISTRY,
+)
+
+_slow_log_lock = threading.Lock()
+
+
+@contextmanager
+def stage(name, timings=None):
+    """Time a block into rag_stage_seconds and, if given, the timings dict (ms)"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - started
+        STAGE_SECONDS.labels(stage=name).observe(elapsed)
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + elapsed * 1000
+
+
+def cache_counter(cache_name):
+    """on_lookup callback for an LRUCache, counting its hits and misses"""
+    hits = CACHE_LOOKUPS.labels(cache=cache_name, result="hit")
+    misses = CACHE_LOOKUPS.labels(cache=cache_name, result="miss")
+    return lambda hit: (hits if hit else misses).inc()
+
+
+def record_slow_query(endpoint, total_ms, timings, **fields):
+    """Log the request if it took longer than RAG_SLOW_QUERY_MS"""
+    if total_ms < SLOW_QUERY_MS:
+        return
+    SLOW_QUERIES.inc()
+    entry = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "endpoint": endpoint,
+        "total_ms": round(total_ms, 2),
+        **fields,
+        "stages_ms": {name: round(ms, 2) for name, ms in timings.items()},
+    }
+    line = json.dumps(entry)
+    if SLOW_QUERY_LOG:
+        with _slow_log_lock, open(SLOW_QUERY_LOG, "a") as f:
+            f.write(line + "\n")
+    else:
+        print(f"🐢 Slow query: {line}")
+
+
+def render_metrics():
+    """(body, content type) for /metrics, aggregated across workers in multiprocess mode"""
+    registry = REGISTRY
+    if MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,305 @@
+"""
+================================================================================
+Sharded vector index, searched scatter-gather across worker processes
+
+build_faiss.py --shards N splits the vectors round-robin into N shards of
+the same index type, each an IndexIDMap2 holding its paragraphs' global ids,
+written next to the manifest as
+
+    shards/shard-000.index, shards/shard-001.index, ...
+
+IVF centroids and scalar-quantizer ranges are trained once on a sample of
+the whole corpus and shared by every shard, so the shards' distances are
+comparable and their top-k lists merge into the global top-k.
+
+In the service, a ShardPool runs one process per shard, each with its shard
+memory-mapped, and sends every search to all of them at once: a query costs
+the slowest shard's search instead of the whole corpus's, plus a pipe round
+trip. Each shard's round trip is recorded in the request's stage timings as
+search.shardN. Source filters and deletions (live.py) travel with the
+search as a packed bitmap over global ids, one bit per paragraph: every
+filtered search pickles ntotal / 8 bytes to each shard. An unfiltered
+search with no deletions sends None instead.
+
+Searches from several threads of a worker are pipelined rather than taking
+turns: each is sent to every shard under a short lock, so each pipe carries
+the searches (and its shard answers them) in the same order, and the
+threads waiting for answers take turns reading the next reply off each pipe
+and handing it to the search it belongs to (ShardProcesses).
+
+The processes are started on the first search in each process that uses
+the pool, so under gunicorn every worker gets its own set (RAG_WORKERS x N
+processes, all mapping the same files) and the preloading master none; the
+FAISS threads a worker has are split between its shards. A shard process
+that dies fails the searches in progress, and the next one starts a new set.
+
+Builds and compaction search shards in-process instead, through a threaded
+faiss.IndexShards (combine_shards).
+================================================================================
+"""
+
+import multiprocessing
+import os
+import threading
+import time
+import weakref
+from collections import deque
+
+import numpy as np
+
+from app.indexes import apply_search_params, create_index, faiss_search_parameters, read_index
+
+SHARDS_DIR = "shards"
+
+
+def shard_path(index_dir, shard):
+    return os.path.join(index_dir, SHARDS_DIR, f"shard-{shard:03d}.index")
+
+
+def build_shards(index_type, params, vectors, ids, num_shards, train_vectors=None, metric="l2", storage="float32"):
+    """
+    num_shards IndexIDMap2 shards holding vectors under ids, dealt out
+    round-robin; one trained empty index is cloned for all of them
+    """
+    import faiss
+
+    template = create_index(index_type, vectors.shape[1], params, train_vectors, metric, storage)
+    shards = []
+    for shard in range(num_shards):
+        positions = np.arange(shard, len(ids), num_shards)
+        index = faiss.IndexIDMap2(faiss.clone_index(template))
+        index.add_with_ids(vectors[positions], ids[positions])
+        shards.append(index)
+    return shards
+
+
+def write_shards(shards, index_dir):
+    """Write shards under index_dir; returns their total size in bytes"""
+    import faiss
+
+    os.makedirs(os.path.join(index_dir, SHARDS_DIR))
+    for shard, index in enumerate(shards):
+        faiss.write_index(index, shard_path(index_dir, shard))
+    return sum(os.path.getsize(shard_path(index_dir, shard)) for shard in range(len(shards)))
+
+
+def read_shards(index_dir, num_shards, index_type, mmap=True):
+    return [read_index(shard_path(index_dir, shard), index_type, mmap=mmap) for shard in range(num_shards)]
+
+
+def combine_shards(shards):
+    """One in-process index searching shards in parallel threads and merging their results by id"""
+    import faiss
+
+    combined = faiss.IndexShards(shards[0].d, True, False)
+    for index in shards:
+        combined.add_shard(index)
+    return combined
+
+
+def merge_results(results, k, metric):
+    """The k nearest of several (distances, ids) results, in the index's own distances"""
+    distances = np.hstack([D for D, _ in results])
+    ids = np.hstack([I for _, I in results])
+    # Inner-product similarities are nearer the larger they are
+    nearness = -distances if metric == "cosine" else distances
+    order = np.argsort(np.where(ids >= 0, nearness, np.inf), axis=1, kind="stable")[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(ids, order, axis=1)
+
+
+def serve_shard(conn, path, index_type, search_params, mmap, threads):
+    """Shard process: load one shard, then answer searches from conn until it closes"""
+    import faiss
+
+    try:
+        faiss.omp_set_num_threads(threads)
+        index = read_index(path, index_type, mmap=mmap)
+        apply_search_params(index, index_type, search_params)
+    except Exception as e:
+        conn.send(("failed", f"{path}: {e}"))
+        return
+    conn.send(("ready", index.ntotal))
+
+    while True:
+        try:
+            request = conn.recv()
+        except EOFError:
+            return
+        if request is None:
+            return
+        embeddings, k, params, bitmap = request
+        try:
+            selector = None
+            if bitmap is not None:
+                selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+            distances, ids = index.search(embeddings, k, params=faiss_search_parameters(index_type, params, selector))
+            conn.send(("ok", distances, ids))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+
+def stop_workers(workers, owner_pid):
+    if os.getpid() != owner_pid:
+        return  # a forked copy; the processes belong to the parent
+    for process, conn in workers:
+        try:
+            conn.send(None)
+        except (BrokenPipeError, OSError):
+            pass
+    for process, conn in workers:
+        process.join(timeout=5)
+        if process.is_alive():
+            process.terminate()
+        conn.close()
+    workers.clear()
+
+
+class ShardFailed(RuntimeError):
+    """A shard process died; the searches in flight on it fail"""
+
+
+class ShardProcesses:
+    """
+    One started set of shard processes, searched by any number of threads
+    at once. Replies come back on each pipe in the order the searches were
+    sent, so the reply at the head of a pipe belongs to the oldest search
+    still waiting on that shard.
+    """
+
+    def __init__(self, workers):
+        self.workers = workers       # (process, connection) per shard
+        self.pid = os.getpid()
+        self.failure = None          # ShardFailed once a shard process is gone
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._next_ticket = 0
+        self._sent = [deque() for _ in workers]   # per shard: tickets awaiting a reply, oldest first
+        self._reading = [False] * len(workers)    # per shard: a thread is reading its pipe
+        self._replies = {}                        # ticket -> {shard: (reply, perf_counter when received)}
+
+    def search(self, request):
+        """Send request to every shard; returns each shard's (reply, time received), in shard order"""
+        with self._send_lock:
+            if self.failure is not None:
+                raise self.failure
+            ticket = self._next_ticket
+            self._next_ticket += 1
+            with self._cond:
+                self._replies[ticket] = {}
+                for sent in self._sent:
+                    sent.append(ticket)
+            try:
+                for _, conn in self.workers:
+                    conn.send(request)
+            except (BrokenPipeError, OSError) as e:
+                self._fail(e)
+                raise self.failure
+
+        with self._cond:
+            while True:
+                if self.failure is not None:
+                    self._replies.pop(ticket, None)
+                    raise self.failure
+                replies = self._replies[ticket]
+                if len(replies) == len(self.workers):
+                    del self._replies[ticket]
+                    return [replies[shard] for shard in range(len(self.workers))]
+                # Read a pipe this search still needs an answer from, unless someone already is
+                shard = next((shard for shard in range(len(self.workers))
+                              if shard not in replies and not self._reading[shard]), None)
+                if shard is None:
+                    self._cond.wait()
+                    continue
+                self._reading[shard] = True
+                self._cond.release()
+                try:
+                    reply = self.workers[shard][1].recv()
+                except (EOFError, OSError) as e:
+                    reply = e
+                finally:
+                    self._cond.acquire()
+                self._reading[shard] = False
+                if isinstance(reply, BaseException):
+                    self._fail(reply)
+                    continue
+                self._replies[self._sent[shard].popleft()][shard] = (reply, time.perf_counter())
+                self._cond.notify_all()
+
+    def _fail(self, error):
+        with self._cond:
+            if self.failure is None:
+                self.failure = ShardFailed(f"Shard process failed, restarting shards on the next search: {error!r}")
+            self._cond.notify_all()
+
+
+class ShardPool:
+    def __init__(self, index_dir, num_shards, index_type, metric, search_params, ntotal, dim, mmap=True):
+        self.dir = index_dir
+        self.num_shards = num_shards
+        self.index_type = index_type
+        self.metric = metric
+        self.search_params = dict(search_params)
+        self.ntotal = ntotal
+        self.d = dim
+        self.mmap = mmap
+        self._processes = None   # ShardProcesses, once started in this process
+        self._lock = threading.Lock()
+
+    def _start(self):
+        """Start one process per shard and wait until each has loaded its shard"""
+        import faiss
+
+        context = multiprocessing.get_context("spawn")
+        threads = max(1, faiss.omp_get_max_threads() // self.num_shards)
+        workers = []
+        started = time.time()
+        try:
+            for shard in range(self.num_shards):
+                conn, child_conn = context.Pipe()
+                process = context.Process(
+                    target=serve_shard, name=f"rag-shard-{shard}", daemon=True,
+                    args=(child_conn, shard_path(self.dir, shard), self.index_type, self.search_params,
+                          self.mmap, threads))
+                process.start()
+                child_conn.close()
+                workers.append((process, conn))
+            for shard, (_, conn) in enumerate(workers):
+                status = conn.recv()
+                if status[0] != "ready":
+                    raise RuntimeError(f"Shard {shard} failed to load: {status[1]}")
+        except BaseException:
+            stop_workers(workers, os.getpid())
+            raise
+        # Stop them when this pool is freed (an old index version released)
+        weakref.finalize(self, stop_workers, workers, os.getpid())
+        print(f"✅ Started {self.num_shards} shard processes for {self.dir} in {time.time() - started:.1f}s")
+        return ShardProcesses(workers)
+
+    def search(self, embeddings, k, params=None, bitmap=None, timings=None):
+        """
+        (distances, ids) of the k nearest vectors over every shard, like
+        faiss's Index.search. params: search params (default the manifest's);
+        bitmap: packed bitmap of the global ids allowed, or None for all;
+        timings: dict to add each shard's round trip to, in ms.
+        """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        params = self.search_params if params is None else params
+        with self._lock:
+            processes = self._processes
+            # None yet in this process (a forked worker's are its parent's), or one has died
+            if processes is None or processes.pid != os.getpid() or processes.failure is not None:
+                if processes is not None:
+                    # Start over with a fresh set
+                    stop_workers(processes.workers, processes.pid)
+                processes = self._processes = self._start()
+        started = time.perf_counter()
+        replies = processes.search((embeddings, k, params, bitmap))
+
+        errors = [f"shard {shard}: {reply[1]}" for shard, (reply, _) in enumerate(replies) if reply[0] != "ok"]
+        if errors:
+            raise RuntimeError("Shard search failed: " + "; ".join(errors))
+        if timings is not None:
+            for shard, (_, received) in enumerate(replies):
+                name = f"search.shard{shard}"
+                timings[name] = timings.get(name, 0.0) + (received - started) * 1000
+        return merge_results([(reply[1], reply[2]) for reply, _ in replies], k, self.metric)
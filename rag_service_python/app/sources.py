@@ -0,0 +1,124 @@
+"""
+================================================================================
+Source ids of the knowledge-base paragraphs, for source-filtered search
+
+Every index id gets the id of the document it came from, under a short name
+that clients filter /query on:
+
+    rfc5280, rfc6818, rfc9549, ...   one per RFC
+    cabf-br                          the CA/Browser Forum Baseline Requirements
+
+A filter becomes a bitmap over index ids, handed to FAISS as an
+IDSelectorBitmap inside the search parameters, so the index only ever
+returns paragraphs from the requested sources: no over-fetching a larger k
+and dropping the rest. Membership is a single bit test per candidate, so a
+filtered flat or IVF search scans exactly what an unfiltered one does; HNSW
+still walks filtered-out nodes, so very narrow filters need a larger
+ef_search to keep recall there. The same bitmap masks the BM25 scores.
+
+Stored next to the FAISS index as source_ids.npy (int16, -1 for ids with no
+paragraph) and sources.json (the names). Build them for an existing index
+directory with
+
+    python -m app.sources ../knowledge_base/faiss_index
+================================================================================
+"""
+
+import json
+import os
+import re
+import sys
+
+import numpy as np
+
+IDS_NAME = "source_ids.npy"
+NAMES_NAME = "sources.json"
+
+RFC_URL_RE = re.compile(r"rfc(\d+)", re.IGNORECASE)
+
+
+def source_name(source):
+    """Short filter name of a paragraph's source URL"""
+    match = RFC_URL_RE.search(source)
+    if match:
+        return f"rfc{match.group(1)}"
+    if "cabforum.org" in source:
+        return "cabf-br"
+    return source
+
+
+class SourceMap:
+    def __init__(self, names, source_ids):
+        self.names = names            # source id -> name
+        self.source_ids = source_ids  # index id -> source id, -1 if none
+        self._selectors = {}
+
+    @classmethod
+    def build(cls, records):
+        """Source ids for (id, {"text", "source"}) records"""
+        by_id = {int(idx): source_name(record["source"]) for idx, record in records}
+        names = sorted(set(by_id.values()))
+        source_ids = np.full(max(by_id, default=-1) + 1, -1, dtype=np.int16)
+        for idx, name in by_id.items():
+            source_ids[idx] = names.index(name)
+        return cls(names, source_ids)
+
+    def save(self, index_dir):
+        np.save(os.path.join(index_dir, IDS_NAME), self.source_ids)
+        with open(os.path.join(index_dir, NAMES_NAME), "w") as f:
+            json.dump(self.names, f, indent=2)
+
+    @classmethod
+    def load(cls, index_dir):
+        """The map in index_dir, or None if it has none"""
+        names_path = os.path.join(index_dir, NAMES_NAME)
+        if not os.path.exists(names_path):
+            return None
+        with open(names_path) as f:
+            names = json.load(f)
+        return cls(names, np.load(os.path.join(index_dir, IDS_NAME), mmap_mode="r"))
+
+    def unknown(self, names):
+        return sorted(set(names) - set(self.names))
+
+    def mask(self, names):
+        """Boolean array over index ids, True for ids from one of names"""
+        return self._filter(names)[0]
+
+    def selector(self, names):
+        """faiss.IDSelectorBitmap accepting only ids from one of names"""
+        return self._filter(names)[2]
+
+    def bitmap(self, names):
+        """The packed bitmap (one bit per index id) that selector(names) tests"""
+        return self._filter(names)[1]
+
+    def _filter(self, names):
+        # Few sources, so few distinct filters: build each once per process.
+        # The bitmap must outlive the selector, which only points at it.
+        key = frozenset(names)
+        cached = self._selectors.get(key)
+        if cached is None:
+            import faiss
+
+            # Names of sources only live edits have (live.py) match no id here
+            wanted = [self.names.index(name) for name in key if name in self.names]
+            mask = np.isin(self.source_ids, wanted)
+            bitmap = np.packbits(mask, bitorder="little")
+            cached = (mask, bitmap, faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap)))
+            self._selectors[key] = cached
+        return cached
+
+
+if __name__ == "__main__":
+    from app.metastore import open_store
+
+    if len(sys.argv) != 2:
+        sys.exit("usage: python -m app.sources path/to/faiss_index")
+    index_dir = sys.argv[1]
+    source_map = SourceMap.build(open_store(index_dir).items())
+    source_map.save(index_dir)
+    counts = np.bincount(source_map.source_ids[source_map.source_ids >= 0], minlength=len(source_map.names))
+    print(f"✅ Wrote source ids of {int(counts.sum())} paragraphs to {index_dir}:")
+    for name, count in zip(source_map.names, counts):
+        print(f"  {name:<10} {count}")
@@ -0,0 +1,82 @@
+"""
+================================================================================
+gunicorn.conf.py - Preload-and-fork multi-worker mode for the RAG service
+
+The master imports app.main and loads the SentenceTransformer weights, the
+FAISS index and the metadata store once, then forks the workers. Workers
+share those read-only pages copy-on-write with the master instead of each
+loading their own copy, so startup time and memory no longer multiply with
+the worker count.
+
+Each worker pins torch, FAISS (OpenMP) and the ONNX Runtime embedding
+backend to RAG_THREADS_PER_WORKER threads, by default the CPU count divided
+by the number of workers, so workers don't oversubscribe the cores between
+them. Warmup queries run in each worker's lifespan handler after the fork,
+never in the master: torch's OpenMP pool is not fork-safe once it has been
+used.
+
+Run from rag_service_python/:
+    RAG_WORKERS=4 gunicorn -c gunicorn.conf.py app.main:app
+
+and measure per-worker memory with:
+    python scripts/worker_memory.py --pidfile /tmp/rag_service.pid
+
+For /metrics to add up every worker's counters, point
+PROMETHEUS_MULTIPROC_DIR at an empty directory before starting:
+    PROMETHEUS_MULTIPROC_DIR=/tmp/rag_metrics RAG_WORKERS=4 gunicorn -c gunicorn.conf.py app.main:app
+
+Author: Mihir Gupta, 2025
+================================================================================
+"""
+
+import gc
+import os
+
+# Tokenizers' own thread pool is not fork-safe once used
+os.environ.setdefault("TOKENIZERS_PARALLELISM", "false")
+
+bind = os.environ.get("RAG_BIND", "0.0.0.0:8000")
+workers = int(os.environ.get("RAG_WORKERS", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+pidfile = os.environ.get("RAG_PIDFILE", "/tmp/rag_service.pid")
+# Loading happens before the fork, so workers come up in seconds
+timeout = 120
+
+threads_per_worker = int(os.environ.get(
+    "RAG_THREADS_PER_WORKER", max(1, (os.cpu_count() or 1) // workers)))
+
+
+def when_ready(server):
+    from app.main import load_state
+
+    load_state()
+    # Move everything loaded so far out of the garbage collector's reach, so
+    # collections in the workers don't write to (and un-share) those pages
+    gc.collect()
+    gc.freeze()
+    server.log.info(f"Model and index loaded once in master {os.getpid()}; forking {workers} workers "
+                    f"with {threads_per_worker} threads each")
+
+
+def post_fork(server, worker):
+    import faiss
+
+    try:
+        import torch
+    except ImportError:
+        # ONNX-only install (RAG_EMBEDDING_BACKEND=onnx): no torch threads to pin
+        pass
+    else:
+        torch.set_num_threads(threads_per_worker)
+    faiss.omp_set_num_threads(threads_per_worker)
+    # Read by the ONNX backend when the worker creates its session
+    os.environ["RAG_EMBEDDING_THREADS"] = str(threads_per_worker)
+
+
+def child_exit(server, worker):
+    # prometheus_client multiprocess-mode housekeeping for a worker that went away
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        from prometheus_client import multiprocess
+
+        multiprocess.mark_process_dead(worker.pid)
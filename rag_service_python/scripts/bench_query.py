@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+================================================================================
+bench_query.py
+
+Load generator for the RAG service: fires /query requests from a pool of
+concurrent clients and reports throughput and latency percentiles.
+
+Compare micro-batching settings by restarting the service between runs:
+
+    RAG_BATCH_MAX_SIZE=1  uvicorn app.main:app     # batching off
+    RAG_BATCH_MAX_SIZE=32 RAG_BATCH_MAX_WAIT_MS=5 uvicorn app.main:app
+    python3 scripts/bench_query.py --concurrency 32 --requests 2000
+
+Author: Mihir Gupta, 2025
+================================================================================
+"""
+
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+QUESTIONS = [
+    "What is the SAN requirement for TLS server certificates?",
+    "Is SHA-1 allowed for certificate signatures?",
+    "What is the minimum RSA key size?",
+    "How many bits of entropy must a certificate serial number contain?",
+    "What is the maximum validity period of a subscriber certificate?",
+    "When must the basicConstraints extension be marked critical?",
+    "What does the keyUsage extension control?",
+    "How are wildcard domain names validated?",
+    "What is the purpose of the authority key identifier?",
+    "Which signature algorithms are permitted by the Baseline Requirements?",
+]
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    rank = min(len(sorted_values) - 1, int(round(pct / 100.0 * (len(sorted_values) - 1))))
+    return sorted_values[rank]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the RAG /query endpoint')
+    parser.add_argument('--url', default='http://127.0.0.1:8000/query')
+    parser.add_argument('--concurrency', type=int, default=16, help='Concurrent clients')
+    parser.add_argument('--requests', type=int, default=1000, help='Total requests to send')
+    parser.add_argument('--k', type=int, default=5)
+    parser.add_argument('--warmup', type=int, default=20, help='Requests sent before measuring')
+    parser.add_argument('--unique', action='store_true',
+                        help='Make every question unique so caches cannot answer it')
+    args = parser.parse_args()
+
+    local = threading.local()
+
+    def session():
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        return local.session
+
+    def one_request(i):
+        question = random.choice(QUESTIONS)
+        if args.unique:
+            question = f"{question} ({i})"
+        started = time.perf_counter()
+        response = session().post(args.url, json={"question": question, "k": args.k}, timeout=60)
+        elapsed = time.perf_counter() - started
+        return elapsed, response.status_code
+
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        list(executor.map(one_request, range(args.warmup)))
+
+        started = time.perf_counter()
+        results = list(executor.map(one_request, range(args.requests)))
+        wall = time.perf_counter() - started
+
+    latencies = sorted(elapsed * 1000 for elapsed, status in results if status == 200)
+    errors = sum(1 for _, status in results if status != 200)
+    report = {
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / wall, 1),
+        "latency_ms": {
+            "mean": round(statistics.mean(latencies), 1) if latencies else 0.0,
+            "p50": round(percentile(latencies, 50), 1),
+            "p95": round(percentile(latencies, 95), 1),
+            "p99": round(percentile(latencies, 99), 1),
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+================================================================================
+check_embedding_backend.py
+
+Accuracy and latency check of the ONNX int8 embedding backend against the
+PyTorch SentenceTransformer it was exported from, on a golden query set:
+
+- cosine similarity of every ONNX vector with its PyTorch vector
+  (must be >= --min-cosine, 0.99 by default)
+- overlap of the top-k paragraphs each backend retrieves from the FAISS
+  index (mean must be >= --min-overlap)
+- single-query encode latency of both backends
+
+Exits non-zero if a threshold is missed. Run from rag_service_python/:
+
+    python -m app.embedding export
+    python3 scripts/check_embedding_backend.py
+
+Author: Mihir Gupta, 2025
+================================================================================
+"""
+
+import argparse
+import json
+import os
+import statistics
+import sys
+import time
+
+import numpy as np
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+PROJECT_ROOT = os.path.abspath(os.path.join(SCRIPT_DIR, "../.."))
+sys.path.insert(0, os.path.join(PROJECT_ROOT, "rag_service_python"))
+
+from app.embedding import OnnxEmbedder, load_embedder
+from app.knowledge_base import KnowledgeBase, current_index_dir
+
+INDEX_ROOT = os.path.join(PROJECT_ROOT, "knowledge_base/faiss_index")
+
+
+def encode_latency_ms(model, questions, repeats):
+    model.encode(questions[:1], convert_to_numpy=True)  # warm up
+    timings = []
+    for _ in range(repeats):
+        for question in questions:
+            started = time.perf_counter()
+            model.encode([question], convert_to_numpy=True)
+            timings.append((time.perf_counter() - started) * 1000)
+    return round(statistics.median(timings), 2)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare the ONNX embedding backend with PyTorch')
+    parser.add_argument('--model', default='all-MiniLM-L6-v2')
+    parser.add_argument('--onnx-dir', default=os.path.join(PROJECT_ROOT, "onnx_model"))
+    parser.add_argument('--fp32', action='store_true', help='Check the fp32 export instead of int8')
+    parser.add_argument('--queries', default=os.path.join(SCRIPT_DIR, "golden_queries.txt"))
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--min-cosine', type=float, default=0.99)
+    parser.add_argument('--min-overlap', type=float, default=0.9)
+    parser.add_argument('--repeats', type=int, default=3, help='Latency passes over the query set')
+    parser.add_argument('--threads', type=int, default=None, help='ONNX Runtime intra-op threads')
+    args = parser.parse_args()
+
+    with open(args.queries) as f:
+        questions = [line.strip() for line in f if line.strip()]
+
+    torch_model = load_embedder("torch", args.model)
+    onnx_model = OnnxEmbedder(args.onnx_dir, quantized=not args.fp32, threads=args.threads)
+
+    reference = torch_model.encode(questions, convert_to_numpy=True)
+    candidate = onnx_model.encode(questions, convert_to_numpy=True)
+    cosines = np.sum(reference * candidate, axis=1) / (
+        np.linalg.norm(reference, axis=1) * np.linalg.norm(candidate, axis=1))
+
+    index = KnowledgeBase(current_index_dir(INDEX_ROOT)).index
+    _, expected = index.search(reference, args.k)
+    _, found = index.search(candidate, args.k)
+    overlaps = [len(set(a) & set(b)) / args.k for a, b in zip(expected, found)]
+
+    report = {
+        "backend": "onnx-fp32" if args.fp32 else "onnx-int8",
+        "queries": len(questions),
+        "cosine": {"min": round(float(cosines.min()), 5), "mean": round(float(cosines.mean()), 5)},
+        f"overlap_at_{args.k}": {"min": round(min(overlaps), 3), "mean": round(statistics.mean(overlaps), 3)},
+        "encode_latency_ms_p50": {
+            "torch": encode_latency_ms(torch_model, questions, args.repeats),
+            "onnx": encode_latency_ms(onnx_model, questions, args.repeats),
+        },
+    }
+    print(json.dumps(report, indent=2))
+
+    failures = []
+    if cosines.min() < args.min_cosine:
+        failures.append(f"min cosine {cosines.min():.4f} < {args.min_cosine}")
+    if statistics.mean(overlaps) < args.min_overlap:
+        failures.append(f"mean overlap@{args.k} {statistics.mean(overlaps):.3f} < {args.min_overlap}")
+    if failures:
+        print("❌ " + "; ".join(failures))
+        sys.exit(1)
+    print("✅ ONNX backend matches PyTorch")
+
+
+if __name__ == "__main__":
+    main()
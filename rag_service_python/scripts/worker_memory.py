@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+================================================================================
+worker_memory.py
+
+Reports memory of a running RAG service master and its workers from
+/proc/<pid>/smaps_rollup (Linux only):
+
+    rss      resident pages, counting shared pages in full for every process
+    pss      proportional share: shared pages divided among the processes
+             mapping them, so the pss column sums to the real total
+    shared   resident pages also mapped by other processes
+    private  pages only this process has (what each extra worker costs)
+
+Run while the service is up:
+
+    python3 scripts/worker_memory.py --pidfile /tmp/rag_service.pid
+
+Author: Mihir Gupta, 2025
+================================================================================
+"""
+
+import argparse
+import json
+import os
+
+FIELDS = {
+    "Rss": "rss",
+    "Pss": "pss",
+    "Shared_Clean": "shared",
+    "Shared_Dirty": "shared",
+    "Private_Clean": "private",
+    "Private_Dirty": "private",
+}
+
+
+def memory_mb(pid):
+    usage = dict.fromkeys(["rss", "pss", "shared", "private"], 0)
+    with open(f"/proc/{pid}/smaps_rollup") as f:
+        for line in f:
+            name, _, rest = line.partition(":")
+            if name in FIELDS:
+                usage[FIELDS[name]] += int(rest.split()[0])
+    return {name: round(kb / 1024, 1) for name, kb in usage.items()}
+
+
+def children(pid):
+    pids = []
+    for tid in os.listdir(f"/proc/{pid}/task"):
+        with open(f"/proc/{pid}/task/{tid}/children") as f:
+            pids.extend(int(child) for child in f.read().split())
+    return pids
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Per-worker memory of the RAG service')
+    parser.add_argument('--pid', type=int, help='Master process id')
+    parser.add_argument('--pidfile', default='/tmp/rag_service.pid', help='File holding the master pid')
+    args = parser.parse_args()
+
+    master = args.pid
+    if master is None:
+        with open(args.pidfile) as f:
+            master = int(f.read().strip())
+
+    workers = children(master)
+    rows = [{"role": "master", "pid": master, **memory_mb(master)}]
+    rows += [{"role": "worker", "pid": pid, **memory_mb(pid)} for pid in workers]
+
+    print(f"{'role':<8} {'pid':>8} {'rss':>9} {'pss':>9} {'shared':>9} {'private':>9}  (MB)")
+    for row in rows:
+        print(f"{row['role']:<8} {row['pid']:>8} {row['rss']:>9} {row['pss']:>9} "
+              f"{row['shared']:>9} {row['private']:>9}")
+
+    total_pss = round(sum(row["pss"] for row in rows), 1)
+    worker_private = [row["private"] for row in rows[1:]]
+    summary = {
+        "workers": len(workers),
+        "total_pss_mb": total_pss,
+        "mean_worker_private_mb": round(sum(worker_private) / len(worker_private), 1) if worker_private else 0.0,
+    }
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,52 @@
+import os
+import sys
+import zlib
+
+import numpy as np
+import pytest
+
+SERVICE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
+sys.path.insert(0, SERVICE_DIR)
+sys.path.insert(0, os.path.join(SERVICE_DIR, "../knowledge_base/scripts"))
+
+DIM = 8
+DOCS = [
+    {"content": "\n\n".join(f"Paragraph {i} about certificate serial numbers, key sizes and SAN entries."
+                            for i in range(6)),
+     "source": "https://datatracker.ietf.org/doc/html/rfc5280"},
+]
+
+
+class HashEmbedder:
+    """Stands in for the sentence-transformers model: a fixed random vector per text"""
+
+    def encode(self, texts, convert_to_numpy=True, **kwargs):
+        return np.vstack([np.random.default_rng(zlib.crc32(text.encode())).random(DIM, dtype=np.float32)
+                          for text in texts])
+
+
+@pytest.fixture
+def index_root(tmp_path, monkeypatch):
+    """An index root that build_faiss.py builds DOCS into with HashEmbedder"""
+    import build_faiss
+
+    monkeypatch.setattr(build_faiss, "INDEX_ROOT", str(tmp_path))
+    monkeypatch.setattr(build_faiss, "EMBEDDINGS_FILE", str(tmp_path / "embeddings.npy"))
+    monkeypatch.setattr(build_faiss, "load_embedder", lambda *args: HashEmbedder())
+    monkeypatch.setattr(build_faiss, "load_documents", lambda: DOCS)
+    return tmp_path
+
+
+@pytest.fixture
+def run_build():
+    """Runs build_faiss.py with the given command line arguments"""
+    import build_faiss
+
+    def run(*args):
+        argv = sys.argv
+        sys.argv = ["build_faiss.py", "--citation-questions", "", *args]
+        try:
+            build_faiss.main()
+        finally:
+            sys.argv = argv
+    return run
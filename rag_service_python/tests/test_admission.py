@@ -0,0 +1,62 @@
+"""Request coalescing and admission control"""
+
+import asyncio
+
+import pytest
+
+from app.admission import AdmissionController, Overloaded, SingleFlight
+
+
+def test_single_flight_shares_one_computation():
+    calls = []
+    coalesced = []
+    flight = SingleFlight(on_coalesced=lambda: coalesced.append(1))
+
+    async def compute():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "result"
+
+    async def main():
+        results = await asyncio.gather(*(flight.do("same question", compute) for _ in range(5)))
+        assert results == ["result"] * 5
+        assert len(flight) == 0
+        # Done calls aren't reused
+        await flight.do("same question", compute)
+
+    asyncio.run(main())
+    assert len(calls) == 2 and len(coalesced) == 4
+
+
+def test_admission_queues_then_rejects():
+    async def main():
+        controller = AdmissionController(max_in_flight=1, max_queue=1, max_queue_wait_ms=50)
+        release = await controller.acquire()
+        queued = asyncio.ensure_future(controller.acquire())
+        await asyncio.sleep(0)
+        assert controller.queued == 1
+
+        with pytest.raises(Overloaded) as rejected:
+            await controller.acquire()
+        assert rejected.value.reason == "queue_full"
+
+        # Releasing twice frees one slot only
+        release()
+        release()
+        release_queued = await queued
+        with pytest.raises(Overloaded) as rejected:
+            await controller.acquire()
+        assert rejected.value.reason == "queue_timeout"
+        release_queued()
+        (await controller.acquire())()
+
+    asyncio.run(main())
+
+
+def test_admission_disabled_admits_everything():
+    async def main():
+        controller = AdmissionController(max_in_flight=0)
+        for _ in range(100):
+            await controller.acquire()
+
+    asyncio.run(main())
@@ -0,0 +1,96 @@
+"""Request checks that run before the model or index is needed"""
+
+from types import SimpleNamespace
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app.main as main
+
+ADMIN_ROUTES = ["/admin/reload", "/admin/paragraphs", "/admin/paragraphs/delete", "/admin/compact"]
+# A valid body for every admin route
+ADMIN_BODY = {"paragraphs": [{"text": "Ballot SC-81", "source": "cabf-br"}], "ids": [1]}
+
+
+@pytest.fixture
+def client():
+    # Not entered as a context manager, so the lifespan handler doesn't load anything
+    return TestClient(main.app)
+
+
+@pytest.mark.parametrize("path", ADMIN_ROUTES)
+def test_admin_disabled_without_token(client, monkeypatch, path):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", None)
+    response = client.post(path, json=ADMIN_BODY)
+    assert response.status_code == 403
+    assert "disabled" in response.json()["detail"]
+
+
+@pytest.mark.parametrize("path", ADMIN_ROUTES)
+def test_admin_rejects_wrong_token(client, monkeypatch, path):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    response = client.post(path, json=ADMIN_BODY, headers={"X-Admin-Token": "guess"})
+    assert response.status_code == 403
+
+
+def test_admin_accepts_token(client, monkeypatch):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    response = client.post("/admin/reload", headers={"X-Admin-Token": "secret"})
+    # Past the token check; the service itself isn't loaded
+    assert response.status_code == 503
+
+
+@pytest.mark.parametrize("k", [0, -1, main.MAX_K + 1])
+def test_query_rejects_k_out_of_range(client, k):
+    assert client.post("/query", json={"question": "Is SHA-1 allowed?", "k": k}).status_code == 422
+
+
+def test_batch_and_certificate_reject_k_out_of_range(client):
+    response = client.post("/query/batch", json={"queries": [{"question": "Is SHA-1 allowed?", "k": 0}]})
+    assert response.status_code == 422
+    response = client.post("/query/certificate", json={"pem": "", "k": main.MAX_K + 1})
+    assert response.status_code == 422
+
+
+def test_query_accepts_max_k(client):
+    # Valid, so it gets as far as the readiness check
+    response = client.post("/query", json={"question": "Is SHA-1 allowed?", "k": main.MAX_K})
+    assert response.status_code == 503
+
+
+@pytest.mark.parametrize("paragraphs", [
+    [],
+    [{"text": "Ballot SC-81", "source": "cabf-br", "id": -3}],
+    [{"text": "Ballot SC-81", "source": "cabf-br", "id": 2**31}],
+])
+def test_upsert_rejects_empty_lists_and_ids_out_of_range(client, monkeypatch, paragraphs):
+    monkeypatch.setattr(main, "ADMIN_TOKEN", "secret")
+    response = client.post("/admin/paragraphs", json={"paragraphs": paragraphs}, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 422
+
+
+@pytest.mark.parametrize("knob,value", [
+    ("nprobe", 0), ("nprobe", main.MAX_NPROBE + 1), ("ef_search", 0), ("ef_search", main.MAX_EF_SEARCH + 1),
+])
+def test_query_rejects_search_knobs_out_of_range(client, knob, value):
+    response = client.post("/query", json={"question": "Is SHA-1 allowed?", knob: value})
+    assert response.status_code == 422
+    response = client.post("/query/certificate", json={"pem": "", knob: value})
+    assert response.status_code == 422
+
+
+def test_nprobe_is_capped_at_nlist():
+    knowledge_base = SimpleNamespace(
+        index_type="ivf_flat", live=SimpleNamespace(generation=0),
+        manifest={"search_params": {"nprobe": 16}, "build_params": {"nlist": 8}})
+    query = main.QueryRequest(question="Is SHA-1 allowed?", nprobe=100)
+    assert main.query_key(query, "dense", knowledge_base)[2] == (("nprobe", 8),)
+
+
+@pytest.mark.parametrize("max_text_chars", [0, -5])
+def test_query_rejects_max_text_chars_below_one(client, max_text_chars):
+    body = {"question": "Is SHA-1 allowed?", "max_text_chars": max_text_chars}
+    assert client.post("/query", json=body).status_code == 422
+    assert client.post("/query/batch", json={"queries": [body]}).status_code == 422
+    response = client.post("/query/certificate", json={"pem": "", "max_text_chars": max_text_chars})
+    assert response.status_code == 422
@@ -0,0 +1,66 @@
+"""Micro-batching of concurrent queries"""
+
+import asyncio
+
+import pytest
+
+from app.batcher import MicroBatcher
+
+
+def test_concurrent_items_share_batches_up_to_the_size_limit():
+    batches = []
+
+    def process(items):
+        batches.append(list(items))
+        return [item * 10 for item in items]
+
+    async def main():
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=20)
+        return await asyncio.gather(*(batcher.submit(item) for item in range(6)))
+
+    assert asyncio.run(main()) == [item * 10 for item in range(6)]
+    assert [len(batch) for batch in batches] == [4, 2]
+
+
+def test_a_lone_item_waits_at_most_max_wait():
+    async def main():
+        batcher = MicroBatcher(lambda items: items, max_batch_size=32, max_wait_ms=5)
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        assert await batcher.submit("only") == "only"
+        return loop.time() - started
+
+    assert asyncio.run(main()) < 1.0
+
+
+def test_a_failed_batch_fails_every_item_in_it():
+    def process(items):
+        raise RuntimeError("encode failed")
+
+    async def main():
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=20)
+        return await asyncio.gather(*(batcher.submit(item) for item in range(3)), return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_cancelled_items_are_not_computed():
+    seen = []
+
+    def process(items):
+        seen.extend(items)
+        return items
+
+    async def main():
+        batcher = MicroBatcher(process, max_batch_size=4, max_wait_ms=50)
+        cancelled = asyncio.ensure_future(batcher.submit("cancelled"))
+        kept = asyncio.ensure_future(batcher.submit("kept"))
+        await asyncio.sleep(0.01)
+        cancelled.cancel()
+        assert await kept == "kept"
+        with pytest.raises(asyncio.CancelledError):
+            await cancelled
+
+    asyncio.run(main())
+    assert seen == ["kept"]
@@ -0,0 +1,44 @@
+"""build_faiss.py run on top of an index directory from before versioned publishing"""
+
+import json
+import os
+
+import faiss
+import numpy as np
+import pytest
+
+from app.knowledge_base import INDEX_NAME, current_index_dir, has_live_edits
+from conftest import DIM
+
+
+@pytest.fixture
+def legacy_root(index_root):
+    """An unversioned index root holding only faiss_index.index, like the one shipped in the repo"""
+    index = faiss.IndexFlatL2(DIM)
+    index.add(np.random.default_rng(0).random((4, DIM), dtype=np.float32))
+    faiss.write_index(index, str(index_root / INDEX_NAME))
+    return index_root
+
+
+def test_legacy_dir_has_no_live_edits(legacy_root):
+    assert not has_live_edits(str(legacy_root))
+
+
+def test_build_over_legacy_dir_without_metadata(legacy_root, run_build):
+    run_build()
+    version_dir = current_index_dir(str(legacy_root))
+    assert version_dir != str(legacy_root)
+    assert os.path.exists(os.path.join(version_dir, "metadata.sqlite"))
+    assert faiss.read_index(os.path.join(version_dir, INDEX_NAME)).ntotal == 6
+
+
+def test_rebuild_from_embeddings_over_legacy_dir(legacy_root, run_build):
+    np.save(legacy_root / "embeddings.npy", np.random.default_rng(1).random((4, DIM), dtype=np.float32))
+    metadata = {str(i): {"text": f"Paragraph {i}", "source": "rfc5280"} for i in range(4)}
+    (legacy_root / "metadata.json").write_text(json.dumps(metadata))
+    run_build("--from-embeddings", "--index-type", "hnsw")
+    version_dir = current_index_dir(str(legacy_root))
+    assert version_dir != str(legacy_root)
+    assert os.path.exists(os.path.join(version_dir, "metadata.json"))
+    with open(os.path.join(version_dir, "manifest.json")) as f:
+        assert json.load(f)["index_type"] == "hnsw"
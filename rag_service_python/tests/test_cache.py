@@ -0,0 +1,33 @@
+"""Semantic cache expiry"""
+
+import numpy as np
+
+import app.cache
+from app.cache import SemanticCache
+
+DIM = 8
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_expired_entries_leave_the_index_and_stop_hiding_live_ones(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app.cache.time, "monotonic", clock)
+    cache = SemanticCache(max_entries=100, threshold=0.9, ttl_seconds=10)
+    base = np.ones(DIM, dtype=np.float32)
+    # More stale near-duplicates than the candidates a lookup checks
+    cache.put_many([("ctx", base, ("stale", i)) for i in range(SemanticCache.CANDIDATES + 2)])
+    clock.now = 20.0
+    paraphrase = base.copy()
+    paraphrase[0] = 0.8
+    cache.put_many([("ctx", paraphrase, "live")])
+
+    assert cache.get_many([("ctx", base)]) == ["live"]
+    assert cache._index.ntotal == 1
+    assert cache.stats()["size"] == 1
@@ -0,0 +1,68 @@
+"""BM25 scoring, lexical query detection and hybrid fusion"""
+
+import numpy as np
+import pytest
+
+from app.lexical import LexicalIndex, fuse, is_lexical_query
+
+RECORDS = [
+    (0, {"text": "The subjectAltName extension 2.5.29.17 lists the DNS names.",
+         "source": "https://datatracker.ietf.org/doc/html/rfc5280"}),
+    (1, {"text": "Serial numbers must contain at least 64 bits of output from a CSPRNG.",
+         "source": "https://cabforum.org/baseline-requirements"}),
+    (3, {"text": "The id-kp-serverAuth purpose marks TLS server certificates.",
+         "source": "https://datatracker.ietf.org/doc/html/rfc5280"}),
+]
+
+
+@pytest.fixture
+def lexical_index():
+    return LexicalIndex.build(RECORDS)
+
+
+def test_exact_terms_rank_their_paragraph_first(lexical_index):
+    ids, scores = lexical_index.search("2.5.29.17", 3)
+    assert list(ids) == [0] and scores[0] > 0
+    assert list(lexical_index.search("serverauth", 3)[0]) == [3]
+    # The RFC number of the source is a token of its paragraphs
+    assert sorted(lexical_index.search("RFC 5280", 3)[0]) == [0, 3]
+    assert len(lexical_index.search("ocsp stapling", 3)[0]) == 0
+
+
+def test_allowed_mask_zeroes_other_ids(lexical_index):
+    allowed = np.array([False, True, True, False])
+    assert len(lexical_index.search("RFC 5280", 3, allowed)[0]) == 0
+    assert list(lexical_index.search("CSPRNG serial", 3, allowed)[0]) == [1]
+
+
+def test_save_and_load_round_trip(lexical_index, tmp_path):
+    assert LexicalIndex.load(str(tmp_path)) is None
+    lexical_index.save(str(tmp_path))
+    loaded = LexicalIndex.load(str(tmp_path))
+    np.testing.assert_allclose(loaded.scores("dns names"), lexical_index.scores("dns names"))
+
+
+@pytest.mark.parametrize("question,lexical", [
+    ("RFC 5280 4.2.1.6", True),
+    ("What is 2.5.29.17?", True),
+    ("id-kp-serverAuth", True),
+    ("basicConstraints", True),
+    ("How many bits of entropy must a serial number have?", False),
+])
+def test_is_lexical_query(question, lexical):
+    assert is_lexical_query(question) == lexical
+
+
+def test_fuse_weights_dense_against_lexical():
+    dense_ids = np.array([5, 6, 4, -1])
+    dense_distances = np.array([0.1, 0.2, 0.5, np.inf], dtype=np.float32)
+    lexical_scores = np.zeros(8, dtype=np.float32)
+    lexical_scores[6] = 2.0
+    lexical_scores[7] = 4.0
+
+    assert fuse(lexical_scores, dense_ids, dense_distances, 2, alpha=1.0)[0] == [5, 6]
+    ids, scores = fuse(lexical_scores, dense_ids, dense_distances, 2, alpha=0.0)
+    # 7 is only a lexical match, and still joins the candidates
+    assert ids == [7, 6] and scores == pytest.approx([1.0, 0.5])
+    ids, scores = fuse(lexical_scores, dense_ids, dense_distances, 3, alpha=0.5)
+    assert ids[0] == 6 and set(ids) == {5, 6, 7} and scores[0] == pytest.approx(0.625)
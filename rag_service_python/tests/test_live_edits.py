@@ -0,0 +1,79 @@
+"""Live upserts and deletes, and compacting them into a new version"""
+
+import numpy as np
+import pytest
+
+from app.knowledge_base import KnowledgeBase, compact, current_index_dir
+from app.metastore import Sealed
+from conftest import HashEmbedder
+
+NEW_TEXT = "Ballot SC-81 shortens certificate validity periods."
+REPLACED_TEXT = "Internal policy: serial numbers carry at least 64 bits from a CSPRNG."
+
+
+def search_all(knowledge_base, vectors, sources=None):
+    """Every paragraph each vector can reach, nearest first, as (ids, distances)"""
+    distances, ids = knowledge_base.search(vectors, 10, knowledge_base.manifest["search_params"], sources)
+    found = ids >= 0
+    return ([[int(idx) for idx in row[keep]] for row, keep in zip(ids, found)],
+            [row[keep].tolist() for row, keep in zip(distances, found)])
+
+
+@pytest.fixture
+def edited(index_root, run_build):
+    """A built version with one paragraph added, one replaced and one deleted through the live path"""
+    run_build()
+    knowledge_base = KnowledgeBase(current_index_dir(str(index_root)), mmap=False)
+    embedder = HashEmbedder()
+    [new_id, replaced_id] = knowledge_base.metadata.upsert([
+        (None, NEW_TEXT, "internal-policy", embedder.encode([NEW_TEXT])[0]),
+        (2, REPLACED_TEXT, "internal-policy", embedder.encode([REPLACED_TEXT])[0]),
+    ])
+    assert knowledge_base.metadata.delete([4, 99]) == [4]
+    knowledge_base.live.sync(knowledge_base.metadata)
+    return knowledge_base, new_id, replaced_id
+
+
+def test_edits_are_searchable_before_compaction(edited):
+    knowledge_base, new_id, replaced_id = edited
+    embedder = HashEmbedder()
+    vectors = embedder.encode([NEW_TEXT, REPLACED_TEXT, "Paragraph 4 about certificate serial numbers, key sizes "
+                                                        "and SAN entries."])
+    ids, distances = search_all(knowledge_base, vectors)
+    assert ids[0][0] == new_id and distances[0][0] == pytest.approx(0)
+    assert ids[1][0] == replaced_id and distances[1][0] == pytest.approx(0)
+    assert 4 not in ids[2]
+    assert sorted(ids[0]) == [0, 1, 2, 3, 5, new_id]
+
+    ids, _ = search_all(knowledge_base, vectors, sources=("internal-policy",))
+    assert all(sorted(row) == sorted([new_id, replaced_id]) for row in ids)
+
+
+def test_compaction_keeps_results_and_sources(index_root, edited):
+    knowledge_base, new_id, replaced_id = edited
+    texts = [record["text"] for _, record in knowledge_base.metadata.items()]
+    vectors = HashEmbedder().encode(texts)
+    before = search_all(knowledge_base, vectors)
+    before_filtered = search_all(knowledge_base, vectors, sources=("internal-policy",))
+
+    version_dir = compact(knowledge_base, str(index_root), keep_versions=3)
+    assert current_index_dir(str(index_root)) == version_dir
+    compacted = KnowledgeBase(version_dir, mmap=False)
+    assert compacted.live.delta.ntotal == 0 and not compacted.live.deleted.any()
+    assert compacted.index.ntotal == 6
+
+    after = search_all(compacted, vectors)
+    assert after[0] == before[0]
+    for after_row, before_row in zip(after[1], before[1]):
+        np.testing.assert_allclose(after_row, before_row, rtol=1e-5, atol=1e-6)
+    assert search_all(compacted, vectors, sources=("internal-policy",))[0] == before_filtered[0]
+
+    assert compacted.source_names() == {"rfc5280", "internal-policy"}
+    assert compacted.metadata.get(replaced_id) == {"text": REPLACED_TEXT, "source": "internal-policy"}
+    assert compacted.metadata.get(4) is None
+    # BM25 is rebuilt with the new text
+    lexical_ids, _ = compacted.lexical_index.search("ballot validity", 3)
+    assert list(lexical_ids) == [new_id]
+
+    with pytest.raises(Sealed):
+        knowledge_base.metadata.delete([0])
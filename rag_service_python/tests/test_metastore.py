@@ -0,0 +1,41 @@
+"""Metadata store connections and id checks"""
+
+import os
+
+import numpy as np
+import pytest
+
+from app.metastore import IdOutOfRange, MetadataStore, write_store
+
+
+def test_forked_child_opens_its_own_connection(tmp_path):
+    path = str(tmp_path / "metadata.sqlite")
+    write_store(path, [(0, {"text": "SHA-1 is not allowed", "source": "br"})])
+    store = MetadataStore(path)
+    # Opened before the fork, as load_state does in the gunicorn master
+    parent_conn = store._conn()
+
+    read_fd, write_fd = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        ok = store._conn() is not parent_conn and store.get(0)["source"] == "br"
+        os.write(write_fd, b"1" if ok else b"0")
+        os._exit(0)
+    os.close(write_fd)
+    assert os.read(read_fd, 1) == b"1"
+    os.waitpid(pid, 0)
+    assert store._conn() is parent_conn
+
+
+def test_upsert_rejects_ids_far_above_the_next_free_one(tmp_path):
+    path = str(tmp_path / "metadata.sqlite")
+    write_store(path, [(idx, {"text": f"paragraph {idx}", "source": "br"}) for idx in range(3)])
+    store = MetadataStore(path)
+    embedding = np.zeros(4, dtype=np.float32)
+
+    with pytest.raises(IdOutOfRange):
+        store.upsert([(None, "new", "br", embedding), (10_000_000, "far", "br", embedding)], max_gap=100)
+    # Nothing from the rejected transaction was written
+    assert len(store) == 3 and not store.edits_since(0)
+
+    assert store.upsert([(None, "new", "br", embedding), (103, "near", "br", embedding)], max_gap=100) == [3, 103]
@@ -0,0 +1,79 @@
+"""Scatter-gather search over shard processes"""
+
+import os
+import signal
+import threading
+
+import faiss
+import numpy as np
+import pytest
+
+from app.shards import ShardFailed, ShardPool, build_shards, write_shards
+
+DIM = 16
+NTOTAL = 500
+NUM_SHARDS = 3
+
+
+@pytest.fixture(scope="module")
+def vectors():
+    return np.random.default_rng(0).random((NTOTAL, DIM), dtype=np.float32)
+
+
+@pytest.fixture
+def pool(tmp_path, vectors):
+    shards = build_shards("flat", {}, vectors, np.arange(NTOTAL, dtype=np.int64), NUM_SHARDS)
+    write_shards(shards, str(tmp_path))
+    pool = ShardPool(str(tmp_path), NUM_SHARDS, "flat", "l2", {}, NTOTAL, DIM)
+    yield pool
+    del pool
+
+
+def exact(vectors, queries, k, allowed=None):
+    index = faiss.IndexIDMap2(faiss.IndexFlatL2(DIM))
+    ids = np.arange(NTOTAL, dtype=np.int64) if allowed is None else np.flatnonzero(allowed)
+    index.add_with_ids(vectors[ids], ids)
+    return index.search(queries, k)
+
+
+def test_matches_exact_search(pool, vectors):
+    timings = {}
+    distances, _ = pool.search(vectors[:20], 10, timings=timings)
+    assert np.allclose(distances, exact(vectors, vectors[:20], 10)[0], atol=1e-5)
+    assert sorted(timings) == [f"search.shard{shard}" for shard in range(NUM_SHARDS)]
+
+
+def test_bitmap_filter(pool, vectors):
+    allowed = np.zeros(NTOTAL, dtype=bool)
+    allowed[::7] = True
+    _, ids = pool.search(vectors[:5], 10, bitmap=np.packbits(allowed, bitorder="little"))
+    assert allowed[ids.ravel()].all()
+
+
+def test_concurrent_searches(pool, vectors):
+    expected = exact(vectors, vectors, 5)[0]
+    errors = []
+
+    def search(rows):
+        for row in rows:
+            distances, _ = pool.search(vectors[row:row + 1], 5)
+            if not np.allclose(distances[0], expected[row], atol=1e-5):
+                errors.append(row)
+
+    threads = [threading.Thread(target=search, args=(range(start, NTOTAL, 8),)) for start in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+
+
+def test_dead_shard_fails_search_then_restarts(pool, vectors):
+    pool.search(vectors[:1], 5)
+    process = pool._processes.workers[1][0]
+    os.kill(process.pid, signal.SIGKILL)
+    process.join()
+    with pytest.raises(ShardFailed):
+        pool.search(vectors[:1], 5)
+    distances, _ = pool.search(vectors[:1], 5)
+    assert np.allclose(distances, exact(vectors, vectors[:1], 5)[0], atol=1e-5)